@@ -0,0 +1,249 @@
+"""
+Локальный индекс архива постов Константина для подбора примеров тона.
+
+Вектор поста — хэшированные символьные n-граммы (без сети и моделей),
+матрица лежит на диске как float32 и читается через np.memmap.
+Индекс дописывается инкрементально: уже известные посты пропускаются.
+
+Сборка / дозаливка:
+    python archive_index.py ingest --file archive.txt
+    python archive_index.py ingest --from-db
+Проверка:
+    python archive_index.py query "премьера новой песни"
+"""
+
+import os
+import sys
+import json
+import zlib
+import hashlib
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+ARCHIVE_INDEX_DIR = Path(
+    os.getenv("ARCHIVE_INDEX_DIR", Path(__file__).parent / "archive_index")
+)
+# Размерность хэш-пространства: 512 * 4 байта = 2 КБ на пост
+DEFAULT_DIM = 512
+NGRAM_RANGE = (3, 5)
+
+VECTORS_FILE = "vectors.f32"
+POSTS_FILE = "posts.jsonl"
+META_FILE = "meta.json"
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().replace("ё", "е").split())
+
+
+def embed(text: str, dim: int = DEFAULT_DIM) -> np.ndarray:
+    """Символьные n-граммы → знаковый хэш в dim корзин → log-TF → L2."""
+    vec = np.zeros(dim, dtype=np.float32)
+    padded = f" {normalize_text(text)} "
+    for n in range(NGRAM_RANGE[0], NGRAM_RANGE[1] + 1):
+        for i in range(len(padded) - n + 1):
+            h = zlib.crc32(padded[i : i + n].encode("utf-8"))
+            # Старший бит хэша — знак, чтобы коллизии гасили друг друга
+            vec[h % dim] += 1.0 if h & 0x80000000 else -1.0
+    vec = np.sign(vec) * np.log1p(np.abs(vec))
+    norm = np.linalg.norm(vec)
+    if norm > 0:
+        vec /= norm
+    return vec
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class ArchiveIndex:
+    """Матрица векторов (memmap) + тексты постов, выровненные по строкам."""
+
+    def __init__(self, path: Path = ARCHIVE_INDEX_DIR):
+        self.path = Path(path)
+        self.dim = DEFAULT_DIM
+        self.count = 0
+        self.vectors: np.ndarray | None = None
+        self.posts: list[str] = []
+        self.post_keys: list[str] = []
+        self.keys: set[str] = set()
+        # Длина валидной части posts.jsonl в байтах: за ней только хвост сбоя
+        self._posts_size = 0
+        self._meta_mtime = 0.0
+
+    @property
+    def meta_path(self) -> Path:
+        return self.path / META_FILE
+
+    def exists(self) -> bool:
+        return self.meta_path.exists()
+
+    def load(self) -> "ArchiveIndex":
+        meta = json.loads(self.meta_path.read_text(encoding="utf-8"))
+        self.dim = meta["dim"]
+        self.count = meta["count"]
+        self._meta_mtime = self.meta_path.stat().st_mtime
+
+        self.posts = []
+        self.post_keys = []
+        self._posts_size = 0
+        with open(self.path / POSTS_FILE, "rb") as f:
+            for line in f:
+                if len(self.posts) >= self.count:
+                    break
+                record = json.loads(line)
+                self.posts.append(record["text"])
+                self.post_keys.append(record["key"])
+                self._posts_size += len(line)
+        self.keys = set(self.post_keys)
+        self._open_vectors()
+        return self
+
+    def _open_vectors(self):
+        self.vectors = (
+            np.memmap(
+                self.path / VECTORS_FILE,
+                dtype=np.float32,
+                mode="r",
+                shape=(self.count, self.dim),
+            )
+            if self.count
+            else np.zeros((0, self.dim), dtype=np.float32)
+        )
+
+    def reload_if_changed(self) -> "ArchiveIndex":
+        """Подхватываем дозаливку, сделанную другим процессом."""
+        try:
+            mtime = self.meta_path.stat().st_mtime
+        except FileNotFoundError:
+            return self
+        if mtime != self._meta_mtime:
+            self.load()
+        return self
+
+    def add(self, texts: list[str]) -> int:
+        """Дописывает новые посты в конец индекса; возвращает сколько добавлено."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        if self.exists():
+            self.load()
+
+        fresh = []
+        for text in texts:
+            text = text.strip()
+            key = text_key(text)
+            if text and key not in self.keys:
+                self.keys.add(key)
+                fresh.append((key, text))
+        if not fresh:
+            return 0
+
+        # Хвост от прерванной дозаливки за пределами count отбрасываем,
+        # валидные строки не переписываем — только дописываем новые
+        vectors_path = self.path / VECTORS_FILE
+        posts_path = self.path / POSTS_FILE
+        if vectors_path.exists():
+            os.truncate(vectors_path, self.count * self.dim * 4)
+        if posts_path.exists():
+            os.truncate(posts_path, self._posts_size)
+
+        matrix = np.stack([embed(text, self.dim) for _, text in fresh])
+        with open(vectors_path, "ab") as f:
+            f.write(matrix.astype(np.float32).tobytes())
+        with open(posts_path, "ab") as f:
+            for key, text in fresh:
+                line = json.dumps({"key": key, "text": text}, ensure_ascii=False)
+                data = (line + "\n").encode("utf-8")
+                f.write(data)
+                self._posts_size += len(data)
+
+        # meta пишется последним и атомарно: count — граница валидных строк
+        tmp = self.meta_path.with_suffix(".tmp")
+        tmp.write_text(
+            json.dumps({"dim": self.dim, "count": self.count + len(fresh)}),
+            encoding="utf-8",
+        )
+        os.replace(tmp, self.meta_path)
+
+        # Старые строки уже в памяти: дописываем к ним, не перечитывая файл
+        self.count += len(fresh)
+        self.post_keys.extend(key for key, _ in fresh)
+        self.posts.extend(text for _, text in fresh)
+        self._meta_mtime = self.meta_path.stat().st_mtime
+        self._open_vectors()
+        return len(fresh)
+
+    def query(self, text: str, k: int) -> list[str]:
+        if not self.count or k <= 0:
+            return []
+        scores = self.vectors @ embed(text, self.dim)
+        k = min(k, self.count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.posts[i] for i in top]
+
+
+# ===================== ИСТОЧНИКИ ПОСТОВ =====================
+
+
+def read_posts_file(path: Path) -> list[str]:
+    """.jsonl с полем text, .json со списком строк или .txt через пустую строку."""
+    raw = path.read_text(encoding="utf-8")
+    if path.suffix == ".jsonl":
+        lines = [line for line in raw.splitlines() if line.strip()]
+        return [json.loads(line)["text"] for line in lines]
+    if path.suffix == ".json":
+        items = json.loads(raw)
+        return [item if isinstance(item, str) else item["text"] for item in items]
+    return [block for block in raw.split("\n\n") if block.strip()]
+
+
+def read_posts_db(db_url: str) -> list[str]:
+    import psycopg
+
+    with psycopg.connect(db_url) as conn:
+        rows = conn.execute(
+            "SELECT coalesce(post_text, raw_output) FROM myasnik_posts "
+            "WHERE raw_output NOT LIKE 'Не удалось сгенерировать пост%' "
+            "ORDER BY created_at"
+        ).fetchall()
+    return [row[0] for row in rows if row[0]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Индекс архива постов")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    ingest = sub.add_parser("ingest", help="добавить посты в индекс")
+    source = ingest.add_mutually_exclusive_group(required=True)
+    source.add_argument("--file", type=Path)
+    source.add_argument("--from-db", action="store_true")
+
+    query = sub.add_parser("query", help="найти похожие посты")
+    query.add_argument("text")
+    query.add_argument("-k", type=int, default=3)
+
+    args = parser.parse_args()
+    index = ArchiveIndex()
+
+    if args.command == "ingest":
+        if args.from_db:
+            db_url = os.getenv("DATABASE_URL")
+            if not db_url:
+                sys.exit("Нужно задать DATABASE_URL")
+            texts = read_posts_db(db_url)
+        else:
+            texts = read_posts_file(args.file)
+        added = index.add(texts)
+        print(f"Добавлено {added} из {len(texts)}, всего в индексе {index.count}")
+        return
+
+    if not index.exists():
+        sys.exit(f"Индекс не найден: {index.path}")
+    for i, text in enumerate(index.load().query(args.text, args.k), 1):
+        print(f"{i}. {text}\n")
+
+
+if __name__ == "__main__":
+    main()
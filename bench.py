@@ -0,0 +1,488 @@
+"""
+Нагрузочный прогон полного сценария бота без сети.
+
+Поднимает в отдельном потоке локальные заглушки OpenAI Responses API
+(с настраиваемой задержкой и разбросом) и Telegram Bot API, затем гонит
+через dp.feed_update синтетические апдейты для множества пользователей:
+/start → инфоповод → тема → фото → «Создать пост».
+«Создать пост» только ставит задание, поэтому время фазы генерации
+меряется до момента, когда воркеры заданий доставят все посты.
+
+Пример:
+    python bench.py --users 50 --latency 1.5 --jitter 0.5 --photos 1
+
+Хеджи, переходы по цепочке моделей и автомат проверяются так:
+    python bench.py --routes 2 --error-rate 0.2
+Повторы отправки после 429 от Telegram (retry_after):
+    python bench.py --flood-rate 0.1
+Сколько стоят по времени N черновиков против одного поста:
+    python bench.py --users 1 --variants 3
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import statistics
+import tracemalloc
+from io import BytesIO
+
+from aiohttp import web
+
+
+FAKE_POST = (
+    "TOPIC: Семья и дети\n\n"
+    "POST_TEXT:\n"
+    "Вчера вечером сидели с сыном на кухне, пили чай и молчали о важном. "
+    "Знаете, иногда тишина говорит громче любых слов. Я понял одно — "
+    "время с детьми не возвращается, его можно только прожить. "
+    "Позвоните своим родным сегодня. Просто так. Без повода.\n"
+    "HASHTAGS:\n"
+    "#константинмясник #отецисын #позвонитесвоимдетям #ятакчувствую"
+)
+
+
+# ===================== ЗАГЛУШКИ СЕРВЕРОВ ====================
+
+
+def fake_response(text: str) -> dict:
+    return {
+        "id": "resp_bench",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": "bench",
+        "status": "completed",
+        "output": [
+            {
+                "type": "message",
+                "id": "msg_bench",
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }
+        ],
+        "usage": {
+            "input_tokens": 7000,
+            "input_tokens_details": {"cached_tokens": 6912},
+            "output_tokens": 250,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": 7250,
+        },
+    }
+
+
+def build_fake_app(args, photo_bytes: bytes) -> web.Application:
+    message_ids = iter(range(1, 10**9))
+
+    async def responses(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        delay = max(0.0, random.gauss(args.latency, args.jitter))
+        if random.random() < args.error_rate:
+            await asyncio.sleep(delay / 3)
+            return web.json_response(
+                {"error": {"message": "bench error", "type": "server_error"}},
+                status=500,
+            )
+
+        if not body.get("stream"):
+            await asyncio.sleep(delay)
+            return web.json_response(fake_response(FAKE_POST))
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        # Первый токен — после трети задержки, остальное равномерно
+        chunks = [FAKE_POST[i : i + 40] for i in range(0, len(FAKE_POST), 40)]
+        await asyncio.sleep(delay / 3)
+        for seq, chunk in enumerate(chunks):
+            event = {
+                "type": "response.output_text.delta",
+                "item_id": "msg_bench",
+                "output_index": 0,
+                "content_index": 0,
+                "delta": chunk,
+                "sequence_number": seq,
+            }
+            await resp.write(
+                f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
+            )
+            await asyncio.sleep(delay * 2 / 3 / len(chunks))
+        done = {
+            "type": "response.completed",
+            "response": fake_response(FAKE_POST),
+            "sequence_number": len(chunks),
+        }
+        await resp.write(
+            f"event: {done['type']}\ndata: {json.dumps(done)}\n\n".encode()
+        )
+        await resp.write_eof()
+        return resp
+
+    async def telegram(request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        form = await request.post()
+        chat = {"id": int(form.get("chat_id") or 0), "type": "private"}
+
+        if method in ("sendmessage", "editmessagetext"):
+            if random.random() < args.flood_rate:
+                return web.json_response(
+                    {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": "Too Many Requests: retry after 1",
+                        "parameters": {"retry_after": 1},
+                    },
+                    status=429,
+                )
+            message_id = int(form.get("message_id") or next(message_ids))
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": chat,
+                "text": form.get("text", ""),
+            }
+        elif method == "getfile":
+            file_id = form["file_id"]
+            result = {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_path": f"photos/{file_id}.jpg",
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def telegram_file(request: web.Request) -> web.Response:
+        return web.Response(body=photo_bytes, content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_post("/v1/responses", responses)
+    app.router.add_post("/bot{token}/{method}", telegram)
+    app.router.add_get("/file/bot{token}/{path:.+}", telegram_file)
+    return app
+
+
+def start_fake_servers(args, photo_bytes: bytes) -> str:
+    """Заглушки живут в своём потоке, чтобы не мешать замеру лагов цикла."""
+    ready = threading.Event()
+    address = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(build_fake_app(args, photo_bytes))
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        loop.run_until_complete(site.start())
+        address["url"] = "http://127.0.0.1:%d" % runner.addresses[0][1]
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return address["url"]
+
+
+def make_photo_bytes() -> bytes:
+    from PIL import Image
+
+    out = BytesIO()
+    Image.new("RGB", (1280, 960), (120, 140, 160)).save(out, format="JPEG")
+    return out.getvalue()
+
+
+# ===================== СИНТЕТИЧЕСКИЕ АПДЕЙТЫ ================
+
+_update_ids = iter(range(1, 10**9))
+
+
+def make_update(user_id: int, text: str | None = None, photo_id: str | None = None):
+    from aiogram.types import Update
+
+    message = {
+        "message_id": next(_update_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": "Bench",
+            "username": "dkokhel",
+        },
+    }
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(text)}
+            ]
+    if photo_id is not None:
+        message["photo"] = [
+            {
+                "file_id": photo_id,
+                "file_unique_id": photo_id,
+                "width": 1280,
+                "height": 960,
+            }
+        ]
+    return Update.model_validate({"update_id": next(_update_ids), "message": message})
+
+
+# ===================== ЗАМЕРЫ ===============================
+
+# Заявка для замера вариантов: та же, что собирают prepare_session
+BENCH_REQUEST = {
+    "infopovod": None,
+    "topic": "Семья и дети",
+    "link": None,
+    "release_type": None,
+    "photos": [],
+}
+
+
+async def feed(main, bot, update, latencies: list[float]):
+    started = time.perf_counter()
+    await main.dp.feed_update(bot, update)
+    latencies.append(time.perf_counter() - started)
+
+
+async def prepare_session(main, bot, user_id: int, photos: int, latencies: list):
+    await feed(main, bot, make_update(user_id, "/start"), latencies)
+    await feed(main, bot, make_update(user_id, "Без инфоповода"), latencies)
+    await feed(main, bot, make_update(user_id, "Семья и дети"), latencies)
+    for i in range(photos):
+        await feed(
+            main, bot, make_update(user_id, photo_id=f"p{user_id}_{i}"), latencies
+        )
+
+
+async def time_job(main, bot, user_id: int, variants: int) -> tuple[float, float]:
+    """
+    Одно задание мимо кэша генераций: время до доставки и время генерации
+    (от начала первого вызова модели до конца последнего).
+    """
+    spans: list[tuple[float, float]] = []
+    generate = main.generate_post_with_writer
+
+    async def timed_generate(**kwargs):
+        began = time.perf_counter()
+        try:
+            return await generate(**kwargs)
+        finally:
+            spans.append((began, time.perf_counter()))
+
+    main.generate_post_with_writer = timed_generate
+    try:
+        placeholder = await bot.send_message(user_id, main.JOB_ACCEPTED_TEXT)
+        started = time.perf_counter()
+        await main.job_queue.enqueue(
+            main.PostJob(
+                chat_id=user_id,
+                user_id=user_id,
+                username="dkokhel",
+                post_request=BENCH_REQUEST,
+                placeholder_id=placeholder.message_id,
+                # Одиночный пост иначе взялся бы из кэша; черновики идут мимо него
+                regenerate=variants == 1,
+                variants=variants,
+            )
+        )
+        await main.job_queue.join()
+        wall = time.perf_counter() - started
+    finally:
+        main.generate_post_with_writer = generate
+    generation = max(end for _, end in spans) - min(began for began, _ in spans)
+    return wall, generation
+
+
+async def measure_variants(main, bot, variants: int, samples: int) -> dict:
+    """
+    Один пост против variants черновиков, задания по одному. Варианты
+    генерируются параллельно: их время — максимум из N задержек, а не сумма.
+    В доставку входит лимит Telegram на чат: N сообщений вместо одного.
+    """
+    runs: dict[int, list[tuple[float, float]]] = {1: [], variants: []}
+    for _ in range(samples):
+        for count in runs:
+            runs[count].append(await time_job(main, bot, 99999, count))
+    report = {"variants": variants, "samples": samples}
+    for name, count in (("single", 1), ("multi", variants)):
+        report[name] = {
+            "wall": percentiles([wall for wall, _ in runs[count]]),
+            "generation": percentiles([gen for _, gen in runs[count]]),
+        }
+    report["ratio_wall_p50"] = (
+        report["multi"]["wall"]["p50"] / report["single"]["wall"]["p50"]
+    )
+    report["ratio_generation_p50"] = (
+        report["multi"]["generation"]["p50"] / report["single"]["generation"]["p50"]
+    )
+    return report
+
+
+async def sample_loop_lag(samples: list[float], interval: float = 0.01):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started - interval)
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if len(values) < 2:
+        value = values[0] if values else 0.0
+        return {"p50": value, "p95": value, "p99": value, "max": value}
+    q = statistics.quantiles(values, n=100)
+    return {"p50": q[49], "p95": q[94], "p99": q[98], "max": max(values)}
+
+
+def format_ms(stats: dict[str, float]) -> str:
+    return "  ".join(f"{k}={v * 1000:.1f}ms" for k, v in stats.items())
+
+
+async def run(args) -> dict:
+    import main
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    bot = Bot(
+        token="123456:BENCH",
+        session=AiohttpSession(api=TelegramAPIServer.from_base(args.base_url)),
+    )
+    bot.session.middleware(main.outbound_limiter)
+    if args.database_url:
+        await main.post_log_writer.start(args.database_url)
+    main.dp.fsm.storage = await main.build_fsm_storage()
+    main.job_queue.start(bot, main.JOB_WORKERS)
+
+    lag: list[float] = []
+    lag_task = asyncio.create_task(sample_loop_lag(lag))
+    user_ids = [100000 + i for i in range(args.users)]
+
+    # Фаза 1: все пользователи доходят до шага фото — замеряем память сессий
+    setup_latencies: list[float] = []
+    tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    await asyncio.gather(
+        *(
+            prepare_session(main, bot, uid, args.photos, setup_latencies)
+            for uid in user_ids
+        )
+    )
+    mem_after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # Фаза 2: все одновременно жмут «Создать пост» и ждут доставки постов
+    create_latencies: list[float] = []
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(
+            feed(main, bot, make_update(uid, "Создать пост"), create_latencies)
+            for uid in user_ids
+        )
+    )
+    await main.job_queue.join()
+    create_wall = time.perf_counter() - started
+
+    # Фаза 3 (по желанию): N вариантов против одного поста
+    variants = None
+    if args.variants > 1:
+        variants = await measure_variants(
+            main, bot, args.variants, args.variant_samples
+        )
+
+    lag_task.cancel()
+    await main.job_queue.stop()
+    await main.post_log_writer.stop()
+    await bot.session.close()
+    await main.model_router.close()
+
+    all_latencies = setup_latencies + create_latencies
+    return {
+        "users": args.users,
+        "updates": len(all_latencies),
+        "setup_latency": percentiles(setup_latencies),
+        "create_latency": percentiles(create_latencies),
+        "create_wall_s": create_wall,
+        "create_throughput_posts_s": args.users / create_wall,
+        "loop_lag": percentiles(lag),
+        "memory_per_session_kb": (mem_after - mem_before) / args.users / 1024,
+        "variants": variants,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=1.0, help="сек, средняя")
+    parser.add_argument("--jitter", type=float, default=0.3, help="сек, σ")
+    parser.add_argument("--photos", type=int, default=1, choices=range(0, 4))
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="доля ответов OpenAI с 500"
+    )
+    parser.add_argument(
+        "--flood-rate", type=float, default=0.0, help="доля 429 от Telegram"
+    )
+    parser.add_argument(
+        "--routes", type=int, default=0, help="звеньев MODEL_ROUTES на заглушке"
+    )
+    parser.add_argument(
+        "--variants", type=int, default=0, help="сравнить N черновиков с одним"
+    )
+    parser.add_argument(
+        "--variant-samples", type=int, default=5, help="заданий на каждый замер"
+    )
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"))
+    parser.add_argument("--json", help="куда дополнительно записать отчёт")
+    args = parser.parse_args()
+
+    args.base_url = start_fake_servers(args, make_photo_bytes())
+
+    # main.py читает настройки при импорте, поэтому окружение — до него
+    os.environ["OPENAI_API_KEY"] = "bench"
+    os.environ["OPENAI_BASE_URL"] = args.base_url + "/v1"
+    os.environ.setdefault("FSM_STORAGE", "memory")
+    if args.routes:
+        os.environ["MODEL_ROUTES"] = json.dumps(
+            [
+                {
+                    "name": f"bench-{i}",
+                    "model": "bench",
+                    "base_url": args.base_url + "/v1",
+                }
+                for i in range(args.routes)
+            ]
+        )
+
+    report = asyncio.run(run(args))
+
+    print(f"users={report['users']} updates={report['updates']}")
+    print("setup handlers :", format_ms(report["setup_latency"]))
+    print("create handler :", format_ms(report["create_latency"]))
+    print(
+        f"create wall    : {report['create_wall_s']:.2f}s "
+        f"({report['create_throughput_posts_s']:.1f} posts/s)"
+    )
+    print("event loop lag :", format_ms(report["loop_lag"]))
+    print(f"memory/session : {report['memory_per_session_kb']:.1f} KiB")
+    variants = report["variants"]
+    if variants:
+        n = variants["variants"]
+        for part, label in (("generation", "gen"), ("wall", "wall")):
+            print(f"{'1 post ' + label:<15}:", format_ms(variants["single"][part]))
+            print(f"{f'{n} drafts ' + label:<15}:", format_ms(variants["multi"][part]))
+        print(
+            f"drafts/post    : gen {variants['ratio_generation_p50']:.2f}x"
+            f"  wall {variants['ratio_wall_p50']:.2f}x (p50)"
+        )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
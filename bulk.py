@@ -0,0 +1,414 @@
+"""
+Пакетная генерация контент-плана: неделя постов одним запуском.
+
+На входе CSV (с заголовком) или JSON-список строк с полями
+infopovod / topic / link / release_type. Посты пишутся тем же промптом
+и теми же сообщениями, что и в боте (main.build_writer_messages):
+  - batch — через OpenAI Batch API: вдвое дешевле и без лимитов на
+    поток запросов, результат приходит в течение суток;
+  - async — обычными вызовами с ограниченной параллельностью. Это же
+    запасной путь для строк, которые batch не вернул, и режим для
+    заглушки/совместимого сервера (OPENAI_BASE_URL, MODEL_ROUTES).
+
+Прогресс лежит в файле состояния рядом с планом, поэтому прерванный
+запуск продолжается с места остановки: отправленный batch дожидается,
+готовые строки заново не генерируются, в myasnik_posts (пачкой через
+COPY) каждая строка пишется один раз. Итоговый CSV отправляется в чат.
+
+    python bulk.py plan.csv --chat-id 123456
+    python bulk.py plan.json --chat-id 123456 --mode async --concurrency 8
+"""
+
+import os
+import sys
+import csv
+import json
+import asyncio
+import hashlib
+import argparse
+from pathlib import Path
+from dataclasses import asdict
+
+from aiogram import Bot
+from aiogram.types import FSInputFile
+from openai.types.responses import Response
+
+import main
+
+PLAN_FIELDS = ("infopovod", "topic", "link", "release_type")
+# Batch API тарифицируется со скидкой 50% к обычным вызовам
+BATCH_DISCOUNT = 0.5
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+# ===================== ПЛАН И СОСТОЯНИЕ =====================
+
+
+def read_plan(path: Path) -> list[dict]:
+    """Строки плана; пустые значения — None, как в интерактивном сценарии."""
+    raw = path.read_text(encoding="utf-8-sig")
+    if path.suffix == ".json":
+        items = json.loads(raw)
+    else:
+        items = list(csv.DictReader(raw.splitlines()))
+    rows = []
+    for i, item in enumerate(items):
+        row = {name: (item.get(name) or "").strip() or None for name in PLAN_FIELDS}
+        if not row["infopovod"] and not row["topic"]:
+            print(f"[Bulk] строка {i + 1} без инфоповода и темы — пропускаю")
+            continue
+        key = hashlib.sha1(json.dumps(row, ensure_ascii=False).encode()).hexdigest()
+        row["custom_id"] = f"row-{i}-{key[:8]}"
+        rows.append(row)
+    return rows
+
+
+def load_state(path: Path, plan: list[dict]) -> dict:
+    """Состояние прошлого запуска; строки сверяются по custom_id."""
+    state = {"batch_id": None, "rows": []}
+    if path.exists():
+        state = json.loads(path.read_text(encoding="utf-8"))
+    known = {row["custom_id"]: row for row in state["rows"]}
+    state["rows"] = [
+        known.get(row["custom_id"])
+        or dict(row, output=None, usage=None, prompt_version=None, logged=False)
+        for row in plan
+    ]
+    return state
+
+
+def save_state(path: Path, state: dict):
+    # Пишем атомарно: обрыв посреди записи не должен терять прогресс
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(json.dumps(state, ensure_ascii=False, indent=1), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def is_done(row: dict) -> bool:
+    output = row["output"]
+    return bool(output) and not output.startswith(main.GENERATION_ERROR_PREFIX)
+
+
+def writer_messages(prompt: main.PromptVersion, row: dict) -> tuple[list[dict], int]:
+    return main.build_writer_messages(
+        prompt,
+        row["infopovod"],
+        row["topic"],
+        row["link"],
+        row["release_type"],
+        photos_count=0,
+        link_info=row.get("link_info"),
+    )
+
+
+async def describe_links(args, state: dict):
+    """Метаданные ссылок всех строк разом; результат хранится в состоянии."""
+    rows = [row for row in state["rows"] if row["link"] and "link_info" not in row]
+    if not rows:
+        return
+    infos = await asyncio.gather(
+        *(
+            main.link_previews.describe(row["link"], main.LINK_FETCH_TIMEOUT)
+            for row in rows
+        )
+    )
+    for row, info in zip(rows, infos):
+        row["link_info"] = info
+    save_state(args.state, state)
+
+
+# ===================== BATCH API ============================
+
+
+async def submit_batch(
+    route: main.ModelRoute, prompt: main.PromptVersion, rows: list[dict]
+) -> str:
+    lines = []
+    for row in rows:
+        messages, _ = writer_messages(prompt, row)
+        body = {
+            "model": route.model,
+            "input": messages,
+            "max_output_tokens": route.max_output_tokens,
+            # Общий префикс у всех строк — ключ тот же, что у бота
+            "prompt_cache_key": prompt.cache_key,
+        }
+        request = {
+            "custom_id": row["custom_id"],
+            "method": "POST",
+            "url": "/v1/responses",
+            "body": body,
+        }
+        lines.append(json.dumps(request, ensure_ascii=False))
+        row["prompt_version"] = prompt.version
+
+    batch_file = await route.client.files.create(
+        file=("content_plan.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
+    )
+    batch = await route.client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/responses",
+        completion_window="24h",
+    )
+    print(f"[Bulk] batch {batch.id}: отправлено строк {len(rows)}")
+    return batch.id
+
+
+async def wait_batch(route: main.ModelRoute, batch_id: str, poll_interval: float):
+    while True:
+        batch = await route.client.batches.retrieve(batch_id)
+        if batch.status in BATCH_FINAL_STATUSES:
+            return batch
+        counts = batch.request_counts
+        done = f"{counts.completed}/{counts.total}" if counts else "?"
+        print(f"[Bulk] batch {batch_id}: {batch.status}, готово {done}")
+        await asyncio.sleep(poll_interval)
+
+
+async def collect_batch(route: main.ModelRoute, batch, rows: dict[str, dict]) -> int:
+    """Разбирает output-файл batch в строки состояния; возвращает сколько готово."""
+    if not batch.output_file_id:
+        return 0
+    content = await route.client.files.content(batch.output_file_id)
+    collected = 0
+    for line in content.text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        row = rows.get(item["custom_id"])
+        answer = item.get("response") or {}
+        if row is None or item.get("error") or answer.get("status_code") != 200:
+            print(f"[Bulk] {item['custom_id']}: ошибка batch {item.get('error')}")
+            continue
+        response = Response.model_validate(answer["body"])
+        usage = main.record_usage(response, 0.0, route)
+        usage.cost_usd *= BATCH_DISCOUNT
+        row["output"] = main.extract_response_text(response)
+        row["usage"] = asdict(usage)
+        row["logged"] = False
+        collected += 1
+    return collected
+
+
+async def repair_rows(prompt: main.PromptVersion, rows: list[dict], concurrency: int):
+    """Ответы batch с нарушениями формата чиним тем же ремонтом, что в боте."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def repair(row: dict):
+        parsed = main.parse_post_output(row["output"])
+        if not main.validate_post(parsed):
+            return
+        messages, estimated_tokens = writer_messages(prompt, row)
+        usage = main.GenerationUsage(**row["usage"])
+        async with semaphore:
+            row["output"] = await main.repair_post_format(
+                messages, row["output"], estimated_tokens, prompt, usage
+            )
+        row["usage"] = asdict(usage)
+
+    await asyncio.gather(*(repair(row) for row in rows if is_done(row)))
+
+
+async def run_batch(args, state: dict, prompt: main.PromptVersion):
+    route = main.model_router.routes[0]
+    pending = [row for row in state["rows"] if not is_done(row)]
+    if not state["batch_id"]:
+        if not pending:
+            return
+        try:
+            state["batch_id"] = await submit_batch(route, prompt, pending)
+        except Exception as e:
+            # Batch недоступен — все строки уйдут обычными вызовами
+            print(f"[Bulk] batch не отправлен: {e}")
+            return
+        save_state(args.state, state)
+
+    batch = await wait_batch(route, state["batch_id"], args.poll_interval)
+    by_id = {row["custom_id"]: row for row in pending}
+    collected = await collect_batch(route, batch, by_id)
+    print(f"[Bulk] batch {batch.id}: {batch.status}, получено {collected}")
+    # Строки без ответа догенерирует async-проход, batch больше не ждём
+    state["batch_id"] = None
+    save_state(args.state, state)
+
+    await repair_rows(prompt, list(by_id.values()), args.concurrency)
+    save_state(args.state, state)
+
+
+# ===================== ASYNC-ГЕНЕРАЦИЯ ======================
+
+
+async def run_async(args, state: dict, prompt: main.PromptVersion):
+    pending = [row for row in state["rows"] if not is_done(row)]
+    if not pending:
+        return
+    print(f"[Bulk] async: строк {len(pending)}, параллельно {args.concurrency}")
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def generate(row: dict):
+        usage = main.GenerationUsage()
+        async with semaphore:
+            row["output"] = await main.generate_post_with_writer(
+                row["infopovod"],
+                row["topic"],
+                row["link"],
+                row["release_type"],
+                photos_count=0,
+                prompt=prompt,
+                usage=usage,
+                link_info=row.get("link_info"),
+            )
+        row["usage"] = asdict(usage)
+        row["prompt_version"] = prompt.version
+        row["logged"] = False
+        # Состояние после каждой строки: обрыв теряет только летящие вызовы
+        save_state(args.state, state)
+
+    await asyncio.gather(*(generate(row) for row in pending))
+
+
+# ===================== РЕЗУЛЬТАТЫ ===========================
+
+
+async def log_rows(args, state: dict):
+    """Готовые строки — в myasnik_posts одной пачкой и в сводку расходов."""
+    db_url = os.getenv("DATABASE_URL")
+    # Ответы-ошибки в журнал постов не пишем: их перегенерирует следующий запуск
+    rows = [row for row in state["rows"] if is_done(row) and not row["logged"]]
+    if not db_url or not rows:
+        return
+    model = main.model_router.routes[0].model
+    await main.post_log_writer.start(db_url)
+    await main.usage_ledger.start(main.post_log_writer.pool)
+    try:
+        # Прямой COPY, а не очередь логгера: ошибку записи видно здесь,
+        # и logged ставится, только если строки действительно в базе
+        await main.post_log_writer.write(
+            [
+                main.post_log_row(
+                    tg_user_id=args.user_id,
+                    tg_username=args.username,
+                    infopovod=row["infopovod"],
+                    topic=row["topic"],
+                    link=row["link"],
+                    release_type=row["release_type"],
+                    photos_count=0,
+                    model=model,
+                    raw_output=row["output"],
+                    prompt_version=row["prompt_version"],
+                    usage=main.GenerationUsage(**row["usage"])
+                    if row["usage"]
+                    else None,
+                )
+                for row in rows
+            ]
+        )
+    except Exception as e:
+        print(f"[DB error] не удалось записать {len(rows)} строк: {e}")
+    else:
+        for row in rows:
+            row["logged"] = True
+            if row["usage"]:
+                main.usage_ledger.record(
+                    args.user_id,
+                    args.username,
+                    main.usage_topic(row, row["output"]),
+                    main.GenerationUsage(**row["usage"]),
+                )
+        save_state(args.state, state)
+    finally:
+        await main.usage_ledger.stop()
+        await main.post_log_writer.stop()
+
+
+def write_summary(path: Path, rows: list[dict]):
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            PLAN_FIELDS + ("model_topic", "post_text", "hashtags", "problems")
+        )
+        for row in rows:
+            parsed = main.parse_post_output(row["output"] or "")
+            if parsed is None:
+                problems = row["output"] or "нет ответа"
+            else:
+                problems = "; ".join(main.validate_post(parsed))
+            writer.writerow(
+                [row[name] or "" for name in PLAN_FIELDS]
+                + [
+                    (parsed.topic or "") if parsed else "",
+                    parsed.post_text if parsed else "",
+                    " ".join(parsed.hashtags) if parsed else "",
+                    problems,
+                ]
+            )
+
+
+async def send_summary(args, path: Path, rows: list[dict]):
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not token or args.chat_id is None:
+        print(f"[Bulk] итог: {path}")
+        return
+    done = sum(is_done(row) for row in rows)
+    cost = sum(row["usage"]["cost_usd"] for row in rows if row["usage"])
+    async with Bot(token=token) as bot:
+        await bot.send_document(
+            args.chat_id,
+            FSInputFile(path),
+            caption=f"Контент-план: готово {done} из {len(rows)}, ${cost:.2f}",
+        )
+    print(f"[Bulk] итог отправлен в чат {args.chat_id}: {path}")
+
+
+async def run(args):
+    prompt = main.prompt_registry.current
+    if prompt is None:
+        sys.exit(f"Не удалось загрузить системный промпт из {main.PROMPT_PATH}")
+    if any(route.client is None for route in main.model_router.routes):
+        sys.exit("Нужно задать OPENAI_API_KEY для моделей OpenAI")
+    plan = read_plan(args.plan)
+    if not plan:
+        sys.exit("В плане нет строк")
+    state = load_state(args.state, plan)
+    save_state(args.state, state)
+
+    try:
+        await describe_links(args, state)
+        # Batch API есть только у OpenAI; прочие маршруты — обычными вызовами
+        if args.mode == "batch" and main.model_router.routes[0].uses_openai:
+            await run_batch(args, state, prompt)
+        await run_async(args, state, prompt)
+        await log_rows(args, state)
+    finally:
+        await main.model_router.close()
+        await main.link_previews.close()
+
+    write_summary(args.summary, state["rows"])
+    await send_summary(args, args.summary, state["rows"])
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("plan", type=Path, help="CSV или JSON с контент-планом")
+    parser.add_argument("--chat-id", type=int, help="куда отправить итог")
+    parser.add_argument("--user-id", type=int, help="автор в myasnik_posts")
+    parser.add_argument("--username", help="ник автора в myasnik_posts")
+    parser.add_argument("--mode", choices=("batch", "async"), default="batch")
+    parser.add_argument("--concurrency", type=int, default=main.GEN_WORKERS)
+    parser.add_argument(
+        "--poll-interval", type=float, default=60, help="сек между опросами batch"
+    )
+    parser.add_argument("--state", type=Path, help="файл состояния для продолжения")
+    parser.add_argument("--summary", type=Path, help="куда записать итоговый CSV")
+    args = parser.parse_args()
+
+    args.state = args.state or args.plan.with_name(args.plan.name + ".state.json")
+    args.summary = args.summary or args.plan.with_name(args.plan.stem + ".posts.csv")
+    if args.user_id is None:
+        args.user_id = args.chat_id or 0
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,62 +1,376 @@
 import os
+import copy
+import json
+import time
+import heapq
+import random
+import hashlib
+import importlib
+import itertools
+import base64
 import asyncio
+import re
+import statistics
+import threading
+from io import BytesIO
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import Context, ContextVar, copy_context
+from dataclasses import asdict, dataclass, field, fields
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Mapping
 from pathlib import Path
-from datetime import datetime, timezone
+from datetime import date, datetime, timedelta, timezone
 
-import psycopg
+# Отсюда меряется импорт сторонних зависимостей (отчёт о холодном старте).
+# PIL и numpy (индекс архива) на старте не нужны и грузятся в warm_up
+_IMPORTS_STARTED = time.perf_counter()
+
+import httpx
+from aiohttp import ClientSession, ClientTimeout, web
+from psycopg_pool import AsyncConnectionPool
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import (
+    CallbackQuery,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
     Message,
     ReplyKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardRemove,
+    User,
+)
+from aiogram.filters import Command, CommandStart
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+)
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.methods.base import Response, TelegramMethod
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.memory import SimpleEventIsolation
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import (
+    BaseStorage,
+    DefaultKeyBuilder,
+    StateType,
+    StorageKey,
 )
-from aiogram.filters import CommandStart
-from openai import OpenAI
+from psycopg.types.json import Jsonb
+from openai import (
+    APIConnectionError,
+    AsyncOpenAI,
+    AuthenticationError,
+    DefaultAsyncHttpxClient,
+    InternalServerError,
+    RateLimitError,
+)
+from opentelemetry import propagate, trace
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+from migrations import ensure_post_partitions, migrate
+from reports import refresh_rollups
+
+if TYPE_CHECKING:
+    from archive_index import ArchiveIndex
+
+IMPORT_SECONDS = time.perf_counter() - _IMPORTS_STARTED
 
 # ===================== НАСТРОЙКИ МОДЕЛИ =====================
 
 # Модель 5-й серии, качественная, через Responses API
-MODEL_NAME = "gpt-5.1"
-
-# Глобальный клиент OpenAI (ключ берём из окружения)
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+MODEL_NAME = os.getenv("MODEL_NAME", "gpt-5.1")
+MAX_OUTPUT_TOKENS = 400
+
+# Таймаут одного запроса к OpenAI, секунды
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+
+# Цепочка моделей по приоритету, JSON-список; по умолчанию одна MODEL_NAME.
+# Звено: {"model", "name", "base_url", "api_key_env", "timeout",
+# "max_output_tokens", "prices": [вход, кэш, выход], "slow_p95"};
+# base_url — OpenAI-совместимый сервер (локальный или заглушка для тестов)
+MODEL_ROUTES = os.getenv("MODEL_ROUTES", "")
+# Хедж: не ответила за p95 своей задержки — параллельно спрашиваем следующую
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "1") == "1"
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "2"))
+# Задержка хеджа, пока замеров меньше ROUTE_MIN_SAMPLES
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "15"))
+ROUTE_LATENCY_WINDOW = 200
+ROUTE_MIN_SAMPLES = 20
+# Автомат: после стольких временных ошибок подряд звено пропускается
+ROUTE_FAILURE_THRESHOLD = int(os.getenv("ROUTE_FAILURE_THRESHOLD", "5"))
+ROUTE_COOLDOWN = float(os.getenv("ROUTE_COOLDOWN", "30"))
+# Звено с p95 дольше этого (сек) уходит в конец цепочки; "slow_p95" звена
+# переопределяет, 0 — не переставлять
+ROUTE_SLOW_P95 = float(os.getenv("ROUTE_SLOW_P95", "20"))
+# Сколько генераций может идти одновременно
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+# Лимиты провайдера в минуту (0 — не ограничивать)
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+
+# Потоковая генерация с постепенной правкой сообщения в Telegram
+STREAM_POSTS = os.getenv("STREAM_POSTS", "1") == "1"
+# Минимальный интервал между правками одного сообщения, секунды
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+# Лимиты Telegram на исходящие: сообщений в секунду всего и в один чат
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+# Сколько сообщений в один чат можно отправить подряд без паузы
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+# Сколько раз повторять запрос после 429 с retry_after
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "5"))
+
+# Сколько вариантов поста генерировать параллельно на одно нажатие
+POST_VARIANTS = max(1, int(os.getenv("POST_VARIANTS", "1")))
+
+# Фото для модели: длинная сторона ужимается до этого размера
+PHOTO_MAX_SIDE = int(os.getenv("PHOTO_MAX_SIDE", "1024"))
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", "85"))
+# Сколько подготовленных фото держим в памяти (по file_unique_id)
+PHOTO_CACHE_SIZE = int(os.getenv("PHOTO_CACHE_SIZE", "64"))
+
+# Метаданные ссылки из инфоповода (OpenGraph/oEmbed) для промпта
+LINK_FETCH_TIMEOUT = float(os.getenv("LINK_FETCH_TIMEOUT", "4"))
+LINK_MAX_BYTES = int(os.getenv("LINK_MAX_BYTES", str(512 * 1024)))
+LINK_CACHE_SIZE = int(os.getenv("LINK_CACHE_SIZE", "256"))
+LINK_CACHE_TTL = float(os.getenv("LINK_CACHE_TTL", "3600"))
+# Сколько генерация ждёт метаданные, если они ещё грузятся (0 — не ждёт)
+LINK_PREVIEW_WAIT = float(os.getenv("LINK_PREVIEW_WAIT", "0"))
+
+# Фиксированный пул воркеров генерации и ограниченная очередь к нему
+GEN_WORKERS = int(os.getenv("GEN_WORKERS", str(OPENAI_MAX_CONCURRENCY)))
+GEN_QUEUE_SIZE = int(os.getenv("GEN_QUEUE_SIZE", "100"))
+
+# Кэш готовых постов для одинаковых входных данных
+GEN_CACHE_SIZE = int(os.getenv("GEN_CACHE_SIZE", "256"))
+GEN_CACHE_TTL = float(os.getenv("GEN_CACHE_TTL", "3600"))
+
+# Цены модели за 1M токенов, $ — для учёта стоимости генераций
+OPENAI_PRICE_INPUT = float(os.getenv("OPENAI_PRICE_INPUT", "1.25"))
+OPENAI_PRICE_CACHED = float(os.getenv("OPENAI_PRICE_CACHED", "0.125"))
+OPENAI_PRICE_OUTPUT = float(os.getenv("OPENAI_PRICE_OUTPUT", "10.0"))
+# Бюджеты на одного пользователя, $ (0 — без ограничения)
+USER_DAILY_BUDGET_USD = float(os.getenv("USER_DAILY_BUDGET_USD", "0"))
+USER_MONTHLY_BUDGET_USD = float(os.getenv("USER_MONTHLY_BUDGET_USD", "0"))
+
+# ===================== НАСТРОЙКИ БД =========================
+
+# Пул соединений с Postgres и фоновая пачечная запись логов
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "4"))
+# Сколько строк держим в очереди, прежде чем начать их отбрасывать
+DB_QUEUE_MAXSIZE = int(os.getenv("DB_QUEUE_MAXSIZE", "1000"))
+# Сбрасываем пачку, когда набралось столько строк...
+DB_FLUSH_BATCH_SIZE = int(os.getenv("DB_FLUSH_BATCH_SIZE", "50"))
+# ...или когда прошло столько секунд с первой строки в пачке
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "2.0"))
+# Как часто дописывать недельные сводки и заготавливать секции, секунды
+DB_MAINTENANCE_INTERVAL = float(os.getenv("DB_MAINTENANCE_INTERVAL", "3600"))
+
+# ===================== НАСТРОЙКИ FSM ========================
+
+# Где хранить состояние диалога: memory | redis | postgres
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory").lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Через сколько секунд бездействия недописанный пост забывается
+FSM_TTL = int(os.getenv("FSM_TTL", str(24 * 60 * 60)))
+# Как часто чистить протухшие сессии (memory / postgres), секунды
+FSM_PURGE_INTERVAL = float(os.getenv("FSM_PURGE_INTERVAL", "600"))
+
+# ===================== НАСТРОЙКИ ЗАДАНИЙ ====================
+
+# Воркеры фоновых заданий генерации в этом процессе (0 — только ставить)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(GEN_WORKERS)))
+# Сколько заданий может ждать воркера; сверх этого — вежливый отказ
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", str(GEN_QUEUE_SIZE)))
+# Сколько раз пробовать задание при временных ошибках OpenAI
+JOB_MAX_ATTEMPTS = max(1, int(os.getenv("JOB_MAX_ATTEMPTS", "4")))
+# Пауза перед повтором: base * 2^(попытка-1), но не больше max, секунды
+JOB_RETRY_BASE_DELAY = float(os.getenv("JOB_RETRY_BASE_DELAY", "5"))
+JOB_RETRY_MAX_DELAY = float(os.getenv("JOB_RETRY_MAX_DELAY", "120"))
+# Как часто свободный воркер заглядывает в очередь без пробуждения, секунды
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+# Задание упавшего воркера снова выдаётся через столько секунд
+JOB_LEASE = float(os.getenv("JOB_LEASE", "600"))
+
+# ===================== РЕЖИМ ЗАПУСКА ========================
+
+# polling — долгий опрос; webhook — aiohttp-сервер за балансировщиком;
+# worker — только воркеры заданий из Postgres, без приёма апдейтов
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Публичный адрес, на который Telegram шлёт апдейты (без пути)
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Telegram присылает его в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+# В режимах polling и worker /metrics и /health живут на этом порту (0 — нет)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Сколько ждать прогрева соединений при старте, секунды
+STARTUP_WARMUP_TIMEOUT = float(os.getenv("STARTUP_WARMUP_TIMEOUT", "10"))
 
 # ===================== ДОСТУП К БОТУ ========================
 
 ALLOWED_USERNAMES = {"dkokhel", "kochelme"}  # ты и сестра
+# Кому доступна /stats
+ADMIN_USERNAMES = {"dkokhel"}
 
 
-def is_allowed(message: Message) -> bool:
+def is_allowed(message: Message | CallbackQuery) -> bool:
     username = (message.from_user.username or "").lower()
     return username in ALLOWED_USERNAMES
 
 
+def is_admin(message: Message) -> bool:
+    return (message.from_user.username or "").lower() in ADMIN_USERNAMES
+
+
 # ===================== ПРОМПТ ИЗ ФАЙЛА ======================
 
 PROMPT_PATH = Path(__file__).parent / "myasnik_prompt.txt"
+# Как часто проверять, не изменился ли файл промпта, секунды
+PROMPT_RELOAD_INTERVAL = float(os.getenv("PROMPT_RELOAD_INTERVAL", "5"))
+
+
+@dataclass(frozen=True)
+class PromptVersion:
+    text: str
+    # Короткий хэш текста: пишется в myasnik_posts для сравнения версий
+    version: str
+
+    @property
+    def cache_key(self) -> str:
+        # Ключ кэширования префикса на стороне OpenAI: одинаковый для всех
+        # запросов с этим промптом, меняется только вместе с текстом
+        return f"myasnik-writer-{self.version}"
+
+
+class PromptRegistry:
+    """
+    Текущая версия системного промпта. Файл опрашивается по mtime,
+    новая версия проверяется и подменяется одной операцией присваивания;
+    битый или пропавший файл оставляет в работе предыдущую версию.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.current: PromptVersion | None = None
+        self._stamp: tuple[float, int] | None = None
+
+    @staticmethod
+    def validate(text: str):
+        if not text.strip():
+            raise ValueError("файл промпта пустой")
+        if "OUTPUT FORMAT" not in text:
+            raise ValueError("в промпте нет раздела OUTPUT FORMAT")
+
+    def load(self) -> PromptVersion:
+        stat = self.path.stat()
+        text = self.path.read_text(encoding="utf-8")
+        self.validate(text)
+        version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+        self._stamp = (stat.st_mtime, stat.st_size)
+        if self.current is None or self.current.version != version:
+            self.current = PromptVersion(text=text, version=version)
+            print(f"[Prompt] загружена версия {version}")
+        return self.current
+
+    def check(self):
+        try:
+            stat = self.path.stat()
+            if (stat.st_mtime, stat.st_size) != self._stamp:
+                self.load()
+        except (OSError, ValueError) as e:
+            kept = self.current.version if self.current else None
+            print(f"[Prompt error] оставляю версию {kept}: {e}")
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(PROMPT_RELOAD_INTERVAL)
+            self.check()
+
+
+prompt_registry = PromptRegistry(PROMPT_PATH)
 try:
-    WRITER_SYSTEM_PROMPT = PROMPT_PATH.read_text(encoding="utf-8")
-except FileNotFoundError:
-    WRITER_SYSTEM_PROMPT = "ERROR: myasnik_prompt.txt not found"
+    prompt_registry.load()
+except (OSError, ValueError) as e:
+    # main() не даст стартовать без промпта
+    print(f"[Prompt error] {e}")
+
+
+# Сколько похожих постов из архива подкладывать как примеры тона (0 — нет)
+ARCHIVE_TOP_K = int(os.getenv("ARCHIVE_TOP_K", "3"))
+# Индекс тянет numpy, поэтому создаётся при первом обращении (или в warm_up)
+_archive_index = None
+# Запросы идут из потоков: перечитка не должна подменить индекс посреди запроса
+_archive_lock = threading.Lock()
+
+
+def get_archive_index() -> "ArchiveIndex":
+    global _archive_index
+    if _archive_index is None:
+        from archive_index import ArchiveIndex
+
+        _archive_index = ArchiveIndex()
+    return _archive_index
+
+
+def archive_query(infopovod: str | None, topic: str | None) -> str:
+    return " ".join(filter(None, [infopovod, topic]))
+
+
+def archive_examples(query: str) -> list[str]:
+    """
+    Топ-k похожих постов архива; пустой список, если индекса нет.
+    Блокирует: перечитка индекса — это разбор всего posts.jsonl, поэтому
+    из бота функция вызывается через asyncio.to_thread.
+    """
+    if ARCHIVE_TOP_K <= 0 or not query.strip():
+        return []
+    index = get_archive_index()
+    if not index.exists():
+        return []
+    try:
+        with _archive_lock:
+            return index.reload_if_changed().query(query, ARCHIVE_TOP_K)
+    except Exception as e:
+        print(f"[Archive error] {e}")
+        return []
 
 
 # ===================== FSM СОСТОЯНИЯ ========================
 
-waiting_infopovod = set()
-waiting_topic_choice = set()
-waiting_topic_custom = set()
-waiting_release_type = set()
-waiting_photo_or_create = set()
 
-# Персональные данные по пользователю
-user_infopovod: dict[int, str | None] = {}
-user_topic: dict[int, str | None] = {}
-user_link: dict[int, str | None] = {}
-user_release_type: dict[int, str | None] = {}
-user_photo: dict[int, list[str]] = {}
+class PostForm(StatesGroup):
+    """Шаги сценария. Данные поста лежат рядом в FSM data:
+    infopovod, topic, link, release_type, photos."""
+
+    infopovod = State()
+    topic_choice = State()
+    topic_custom = State()
+    release_type = State()
+    photo_or_create = State()
 
-dp = Dispatcher()
+
+# Хранилище подставляется в main() по FSM_STORAGE.
+# Изоляция событий: апдейты одного пользователя обрабатываются строго
+# по очереди (двойной клик по «Создать пост», альбом из трёх фото).
+dp = Dispatcher(events_isolation=SimpleEventIsolation())
 
 # ===================== КЛАВИАТУРЫ ===========================
 
@@ -83,207 +397,2877 @@ def topic_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
-def release_type_keyboard() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Да, премьера")],
-            [KeyboardButton(text="Нет, уже вышло")],
-        ],
-        resize_keyboard=True,
+def release_type_keyboard() -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="Да, премьера")],
+            [KeyboardButton(text="Нет, уже вышло")],
+        ],
+        resize_keyboard=True,
+    )
+
+
+def create_post_keyboard() -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="Создать пост")],
+        ],
+        resize_keyboard=True,
+    )
+
+
+def regenerate_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(
+                    text="Сгенерировать заново", callback_data="regenerate"
+                )
+            ],
+        ]
+    )
+
+
+def pick_draft_keyboard(index: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(
+                    text=f"Выбрать вариант {index + 1}",
+                    callback_data=f"pick:{index}",
+                )
+            ],
+        ]
+    )
+
+
+# ===================== ВСПОМОГАТЕЛЬНОЕ ======================
+
+
+def extract_link(text: str) -> str | None:
+    """Достаём первую ссылку из текста, если есть."""
+    for part in text.split():
+        if part.startswith("http://") or part.startswith("https://"):
+            return part
+    return None
+
+
+OUTPUT_FIELDS = ("INFOPOVOD", "TOPIC", "POST_TEXT", "HASHTAGS")
+
+# Правила из «Требований к посту» в myasnik_prompt.txt
+POST_MIN_LEN = 200
+POST_MAX_LEN = 300
+# В промпте «Количество: 2-3»; лишний тег-другой не стоит платной починки
+HASHTAGS_MIN = 2
+HASHTAGS_MAX = 6
+HASHTAG_RE = re.compile(r"#\w+")
+
+
+@dataclass
+class ParsedPost:
+    """Поля ответа модели по OUTPUT FORMAT."""
+
+    infopovod: str | None
+    topic: str | None
+    post_text: str
+    hashtags: list[str]
+
+    def display_text(self) -> str:
+        if not self.hashtags:
+            return self.post_text
+        return self.post_text + "\n\n" + " ".join(self.hashtags)
+
+
+def parse_post_output(text: str) -> ParsedPost | None:
+    """
+    Разбираем ответ по OUTPUT FORMAT из промпта:
+    поле начинается с «ИМЯ:», значение — до следующего поля.
+    Возвращаем None, если POST_TEXT не нашёлся.
+    """
+    fields: dict[str, list[str]] = {}
+    current = None
+    for line in text.splitlines():
+        name, sep, rest = line.partition(":")
+        if sep and name.strip().upper() in OUTPUT_FIELDS:
+            current = name.strip().upper()
+            fields[current] = [rest.strip()]
+        elif current is not None:
+            fields[current].append(line)
+
+    parsed = {name: "\n".join(lines).strip() for name, lines in fields.items()}
+    if not parsed.get("POST_TEXT"):
+        return None
+    return ParsedPost(
+        infopovod=parsed.get("INFOPOVOD") or None,
+        topic=parsed.get("TOPIC") or None,
+        post_text=parsed["POST_TEXT"],
+        hashtags=parsed.get("HASHTAGS", "").replace(",", " ").split(),
+    )
+
+
+def validate_post(parsed: ParsedPost | None) -> list[str]:
+    """Список нарушений формата — в том виде, в каком их увидит модель."""
+    if parsed is None:
+        return ["нет блока POST_TEXT — ответ должен быть строго в OUTPUT FORMAT"]
+
+    problems = []
+    length = len(parsed.post_text)
+    if not POST_MIN_LEN <= length <= POST_MAX_LEN:
+        problems.append(
+            f"длина POST_TEXT {length} знаков, нужно {POST_MIN_LEN}-{POST_MAX_LEN}"
+        )
+    if "\n" in parsed.post_text:
+        problems.append("POST_TEXT должен быть одним абзацем без переносов строк")
+    if not HASHTAGS_MIN <= len(parsed.hashtags) <= HASHTAGS_MAX:
+        problems.append(
+            f"хэштегов {len(parsed.hashtags)}, нужно {HASHTAGS_MIN}-{HASHTAGS_MAX}"
+        )
+    if any(not HASHTAG_RE.fullmatch(tag) for tag in parsed.hashtags):
+        problems.append("каждый хэштег должен быть вида #слово, без пробелов")
+    return problems
+
+
+async def go_to_photo_step(state: FSMContext, message: Message):
+    """Переход к шагу загрузки фото."""
+    await state.set_state(PostForm.photo_or_create)
+    await state.update_data(photos=[])
+
+    text = (
+        "Теперь можно отправить фото для поста.\n"
+        "Можно прикрепить не более 3 фотографий.\n"
+        "Если фото не нужно — нажмите «Создать пост»."
+    )
+    await message.answer(text, reply_markup=create_post_keyboard())
+
+
+class StreamingEditor:
+    """
+    Постепенно дописывает сообщение-заглушку через edit_message_text.
+    Промежуточные обновления склеиваются: в Telegram уходит не чаще
+    одной правки за STREAM_EDIT_INTERVAL и только последний текст.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: int, text: str = ""):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self._shown = text
+        self._pending = self._shown
+        self._last_edit = 0.0
+        self._task: asyncio.Task | None = None
+
+    def push(self, text: str):
+        self._pending = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def finish(self, text: str, reply_markup: InlineKeyboardMarkup = None):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        with telegram_outbound(PRIORITY_POST):
+            if not await self._edit(text, reply_markup):
+                # Заглушку удалили или её нельзя править: готовый текст
+                # не теряем, а присылаем отдельным сообщением
+                await self.bot.send_message(
+                    self.chat_id, text[:4096], reply_markup=reply_markup
+                )
+
+    async def _flush_loop(self):
+        # Промежуточные правки уступают очередь всем остальным сообщениям
+        with telegram_outbound(PRIORITY_PROGRESS):
+            while self._pending != self._shown:
+                delay = self._last_edit + STREAM_EDIT_INTERVAL - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self._edit(self._pending)
+
+    async def _edit(
+        self, text: str, reply_markup: InlineKeyboardMarkup = None
+    ) -> bool:
+        """False — Telegram отказался править сообщение."""
+        # Лимит Telegram на длину сообщения
+        text = text[:4096]
+        if not text.strip() or (text == self._shown and reply_markup is None):
+            return True
+        self._shown = text
+        self._last_edit = time.monotonic()
+        try:
+            await self.bot.edit_message_text(
+                text=text,
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                reply_markup=reply_markup,
+            )
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return True
+            print(f"[Telegram edit error] {e}")
+            return False
+        return True
+
+
+# ===================== МЕТРИКИ И ТРАССИРОВКА ================
+
+# Спаны уходят туда, куда настроен OpenTelemetry SDK (без него — no-op)
+tracer = trace.get_tracer("myasnik_bot")
+
+OPENAI_LATENCY = Histogram(
+    "myasnik_openai_request_seconds",
+    "Время одного запроса к OpenAI",
+    ["model", "status"],
+    buckets=(0.5, 1, 2, 4, 8, 15, 30, 60, 120),
+)
+OPENAI_TOKENS = Histogram(
+    "myasnik_openai_tokens",
+    "Токены на один запрос к OpenAI",
+    ["model", "kind"],
+    buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000),
+)
+DB_FLUSH_LATENCY = Histogram(
+    "myasnik_db_flush_seconds",
+    "Время записи одной пачки в myasnik_posts",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+DB_ROWS = Counter(
+    "myasnik_db_rows_total",
+    "Строки myasnik_posts по результату записи",
+    ["result"],
+)
+HANDLER_LATENCY = Histogram(
+    "myasnik_handler_seconds",
+    "Время работы хэндлера Telegram",
+    ["handler"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+FSM_SESSIONS = Gauge(
+    "myasnik_fsm_sessions",
+    "Активные FSM-сессии по шагу сценария",
+    ["state"],
+)
+ROUTER_EVENTS = Counter(
+    "myasnik_router_events_total",
+    "Хеджи, переходы по цепочке, срабатывания автомата и пустые ответы",
+    ["model", "event"],
+)
+JOBS = Counter(
+    "myasnik_jobs_total",
+    "Фоновые задания генерации по результату",
+    ["result"],
+)
+GENERATION_CACHE = Counter(
+    "myasnik_generation_cache_total",
+    "Запросы к кэшу постов: hit, miss и coalesced (ждал общий вызов)",
+    ["result"],
+)
+TELEGRAM_REQUESTS = Counter(
+    "myasnik_telegram_requests_total",
+    "Исходящие запросы к Telegram: отправлены, склеены, 429 и отказы",
+    ["result"],
+)
+LINK_PREVIEWS = Counter(
+    "myasnik_link_previews_total",
+    "Загрузки метаданных ссылок по результату",
+    ["result"],
+)
+STARTUP_SECONDS = Gauge(
+    "myasnik_startup_seconds",
+    "Длительность фаз холодного старта",
+    ["phase"],
+)
+LOOP_LAG = Histogram(
+    "myasnik_event_loop_lag_seconds",
+    "Опоздание event loop относительно запланированного пробуждения",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+# Как часто обновлять счётчик сессий и мерить лаг цикла, секунды
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "15"))
+LOOP_LAG_INTERVAL = 0.5
+
+
+async def loop_lag_monitor():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, loop.time() - started - LOOP_LAG_INTERVAL))
+
+
+async def fsm_sessions_monitor(storage: BaseStorage):
+    known: set[str] = set()
+    while True:
+        try:
+            counts = await storage.count_states()
+        except Exception as e:
+            print(f"[Metrics] не удалось посчитать сессии: {e}")
+        else:
+            for state in known - counts.keys():
+                FSM_SESSIONS.labels(state).set(0)
+            for state, count in counts.items():
+                FSM_SESSIONS.labels(state).set(count)
+            known |= counts.keys()
+        await asyncio.sleep(METRICS_INTERVAL)
+
+
+@dp.update.outer_middleware()
+async def trace_update(handler, event, data):
+    # Корневой спан апдейта: вызов модели и запись в БД линкуются к нему
+    with tracer.start_as_current_span(
+        "telegram.update",
+        attributes={"telegram.update_id": event.update_id},
+    ):
+        return await handler(event, data)
+
+
+async def measure_handler(handler, event, data):
+    name = data["handler"].callback.__name__
+    started = time.perf_counter()
+    try:
+        with tracer.start_as_current_span(f"handler.{name}"):
+            return await handler(event, data)
+    finally:
+        HANDLER_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+
+dp.message.middleware(measure_handler)
+dp.callback_query.middleware(measure_handler)
+
+
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST}
+    )
+
+
+# ===================== УЧЁТ РАСХОДОВ ========================
+
+
+@dataclass
+class GenerationUsage:
+    """Токены, время и стоимость вызовов модели на одну генерацию."""
+
+    api_calls: int = 0
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    output_tokens: int = 0
+    # Уже входят в output_tokens, храним отдельно для анализа
+    reasoning_tokens: int = 0
+    generation_seconds: float = 0.0
+    cost_usd: float = 0.0
+
+    def add(self, other: "GenerationUsage"):
+        for name in USAGE_FIELDS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+
+USAGE_FIELDS = tuple(f.name for f in fields(GenerationUsage))
+
+
+@dataclass
+class UsageRollup(GenerationUsage):
+    generations: int = 0
+
+
+ROLLUP_FIELDS = ("generations",) + USAGE_FIELDS
+
+
+def usage_topic(post_request: dict, raw_output: str) -> str:
+    """Тема для сводок: выбранная пользователем или та, что дала модель."""
+    if post_request["topic"]:
+        return post_request["topic"]
+    parsed = parse_post_output(raw_output)
+    return parsed.topic if parsed and parsed.topic else "без темы"
+
+
+class UsageLedger:
+    """
+    Расходы в памяти процесса по (день UTC, пользователь, тема): из них
+    проверяются бюджеты перед вызовом модели. Приращения раз в
+    DB_FLUSH_INTERVAL дописываются в сводную таблицу myasnik_usage_daily,
+    при старте текущий месяц поднимается оттуда же.
+    """
+
+    def __init__(self):
+        self.pool: AsyncConnectionPool | None = None
+        self._rollups: dict[tuple[date, int, str], UsageRollup] = {}
+        self._pending: dict[tuple[date, int, str], UsageRollup] = {}
+        self._usernames: dict[int, str | None] = {}
+        self._task: asyncio.Task | None = None
+
+    async def start(self, pool: AsyncConnectionPool):
+        self.pool = pool
+        async with pool.connection() as conn:
+            cur = await conn.execute(
+                "SELECT day, tg_user_id, topic, tg_username, "
+                f"{', '.join(ROLLUP_FIELDS)} FROM myasnik_usage_daily "
+                "WHERE day >= %s",
+                (month_start(),),
+            )
+            for day, user_id, topic, username, *values in await cur.fetchall():
+                self._rollups[(day, user_id, topic)] = UsageRollup(
+                    **dict(zip(ROLLUP_FIELDS, values))
+                )
+                self._usernames.setdefault(user_id, username)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            await self.flush()
+
+    def record(
+        self,
+        user_id: int,
+        username: str | None,
+        topic: str,
+        usage: GenerationUsage,
+    ):
+        key = (utc_today(), user_id, topic)
+        for rollups in (self._rollups, self._pending):
+            rollup = rollups.setdefault(key, UsageRollup())
+            rollup.add(usage)
+            rollup.generations += 1
+        self._usernames[user_id] = username
+
+    def spent(self, user_id: int) -> tuple[float, float]:
+        """Сколько пользователь потратил сегодня и с начала месяца, $."""
+        today, since = utc_today(), month_start()
+        day_cost = month_cost = 0.0
+        for (day, uid, _), rollup in self._rollups.items():
+            if uid != user_id or day < since:
+                continue
+            month_cost += rollup.cost_usd
+            if day == today:
+                day_cost += rollup.cost_usd
+        return day_cost, month_cost
+
+    def check_budget(self, user_id: int) -> str | None:
+        """Текст отказа, если бюджет пользователя исчерпан, иначе None."""
+        day_cost, month_cost = self.spent(user_id)
+        if USER_DAILY_BUDGET_USD and day_cost >= USER_DAILY_BUDGET_USD:
+            return (
+                f"Дневной лимит на генерации исчерпан (${day_cost:.2f} из "
+                f"${USER_DAILY_BUDGET_USD:.2f}). Попробуй завтра."
+            )
+        if USER_MONTHLY_BUDGET_USD and month_cost >= USER_MONTHLY_BUDGET_USD:
+            return (
+                f"Месячный лимит на генерации исчерпан (${month_cost:.2f} из "
+                f"${USER_MONTHLY_BUDGET_USD:.2f})."
+            )
+        return None
+
+    async def summary(
+        self, since: date
+    ) -> tuple[dict[tuple[int, str], UsageRollup], dict[int, str | None]]:
+        """Сводки (пользователь, тема) с даты since и известные username."""
+        totals: dict[tuple[int, str], UsageRollup] = {}
+        usernames = dict(self._usernames)
+        if self.pool is None:
+            rows = [
+                (uid, topic, [getattr(rollup, f) for f in ROLLUP_FIELDS])
+                for (day, uid, topic), rollup in self._rollups.items()
+                if day >= since
+            ]
+        else:
+            # Сводная таблица общая для всех процессов, поэтому читаем её
+            await self.flush()
+            async with self.pool.connection() as conn:
+                cur = await conn.execute(
+                    f"SELECT tg_user_id, topic, max(tg_username), "
+                    f"{', '.join(f'sum({f})' for f in ROLLUP_FIELDS)} "
+                    "FROM myasnik_usage_daily WHERE day >= %s "
+                    "GROUP BY tg_user_id, topic",
+                    (since,),
+                )
+                rows = []
+                for uid, topic, username, *values in await cur.fetchall():
+                    usernames.setdefault(uid, username)
+                    rows.append((uid, topic, values))
+        for uid, topic, values in rows:
+            rollup = totals.setdefault((uid, topic), UsageRollup())
+            for name, value in zip(ROLLUP_FIELDS, values):
+                setattr(rollup, name, getattr(rollup, name) + value)
+        return totals, usernames
+
+    async def flush(self):
+        if self.pool is None or not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        columns = ("day", "tg_user_id", "topic", "tg_username") + ROLLUP_FIELDS
+        updates = ", ".join(
+            f"{f} = myasnik_usage_daily.{f} + EXCLUDED.{f}" for f in ROLLUP_FIELDS
+        )
+        try:
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.executemany(
+                        f"INSERT INTO myasnik_usage_daily ({', '.join(columns)}) "
+                        f"VALUES ({', '.join(['%s'] * len(columns))}) "
+                        "ON CONFLICT (day, tg_user_id, topic) DO UPDATE SET "
+                        "tg_username = coalesce(EXCLUDED.tg_username, "
+                        f"myasnik_usage_daily.tg_username), {updates}",
+                        [
+                            (day, uid, topic, self._usernames.get(uid))
+                            + tuple(getattr(rollup, f) for f in ROLLUP_FIELDS)
+                            for (day, uid, topic), rollup in pending.items()
+                        ],
+                    )
+        except Exception as e:
+            print(f"[DB error] не удалось записать сводку расходов: {e}")
+            # Вернём приращения, чтобы дописать их следующей попыткой
+            for key, rollup in pending.items():
+                merged = self._pending.setdefault(key, UsageRollup())
+                merged.add(rollup)
+                merged.generations += rollup.generations
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(DB_FLUSH_INTERVAL)
+            await self.flush()
+            # Прошлые месяцы для бюджетов не нужны
+            since = month_start()
+            for key in [k for k in self._rollups if k[0] < since]:
+                del self._rollups[key]
+
+
+def utc_today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def month_start() -> date:
+    return utc_today().replace(day=1)
+
+
+usage_ledger = UsageLedger()
+
+
+# ===================== ЛОГИРОВАНИЕ В БД =====================
+
+
+POST_LOG_COLUMNS = (
+    "created_at",
+    "tg_user_id",
+    "tg_username",
+    "infopovod",
+    "topic",
+    "link",
+    "release_type",
+    "photos_count",
+    "model",
+    "raw_output",
+    "post_text",
+    "hashtags",
+    "post_length",
+    "prompt_version",
+) + USAGE_FIELDS
+
+
+class PostLogWriter:
+    """
+    Долгоживущий пул соединений + фоновая запись строк myasnik_posts.
+    Хэндлеры только кладут строку в очередь, а отдельная задача
+    сбрасывает накопленное одним COPY по размеру пачки или по таймеру.
+    """
+
+    def __init__(self):
+        self.pool: AsyncConnectionPool | None = None
+        # Элемент очереди: (строка, контекст спана апдейта) или None
+        self._queue: asyncio.Queue[tuple | None] | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._queue is not None
+
+    async def start(self, db_url: str):
+        # Схему всех таблиц бота ведут миграции (migrations.py)
+        await migrate(db_url)
+        self.pool = AsyncConnectionPool(
+            db_url,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            open=False,
+        )
+        await self.pool.open()
+        self._queue = asyncio.Queue(maxsize=DB_QUEUE_MAXSIZE)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._queue is not None:
+            # None — сигнал задаче дописать остаток и выйти
+            await self._queue.put(None)
+            await self._task
+            self._queue = None
+            self._task = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    def submit(self, row: tuple):
+        span_context = trace.get_current_span().get_span_context()
+        try:
+            self._queue.put_nowait((row, span_context))
+        except asyncio.QueueFull:
+            DB_ROWS.labels("dropped").inc()
+            print("[DB] очередь логов переполнена, строка отброшена")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            row = await self._queue.get()
+            if row is None:
+                return
+
+            batch = [row]
+            stop = False
+            deadline = loop.time() + DB_FLUSH_INTERVAL
+            while len(batch) < DB_FLUSH_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    stop = True
+                    break
+                batch.append(row)
+
+            await self._flush(batch)
+            if stop:
+                return
+
+    async def write(self, rows: list[tuple]):
+        """Сразу пишет строки одним COPY в одной транзакции, ошибка — наружу."""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                async with cur.copy(
+                    f"COPY myasnik_posts ({', '.join(POST_LOG_COLUMNS)}) FROM STDIN"
+                ) as copy:
+                    for row in rows:
+                        await copy.write_row(row)
+
+    async def _flush(self, batch: list[tuple]):
+        # Одна пачка — один спан, связанный со спанами всех её апдейтов
+        links = [trace.Link(ctx) for _, ctx in batch if ctx.is_valid]
+        started = time.perf_counter()
+        with tracer.start_as_current_span(
+            "db.copy_myasnik_posts",
+            links=links,
+            attributes={"db.rows": len(batch)},
+        ):
+            try:
+                await self.write([row for row, _ in batch])
+            except Exception as e:
+                DB_ROWS.labels("error").inc(len(batch))
+                print(f"[DB error] не удалось записать {len(batch)} строк: {e}")
+            else:
+                DB_ROWS.labels("ok").inc(len(batch))
+            finally:
+                DB_FLUSH_LATENCY.observe(time.perf_counter() - started)
+
+
+post_log_writer = PostLogWriter()
+
+
+def post_log_row(
+    tg_user_id: int,
+    tg_username: str | None,
+    infopovod: str | None,
+    topic: str | None,
+    link: str | None,
+    release_type: str | None,
+    photos_count: int,
+    model: str,
+    raw_output: str,
+    prompt_version: str | None = None,
+    usage: GenerationUsage | None = None,
+) -> tuple:
+    """Строка myasnik_posts в порядке POST_LOG_COLUMNS."""
+    parsed = parse_post_output(raw_output)
+    return (
+        (
+            datetime.now(timezone.utc),
+            tg_user_id,
+            tg_username,
+            infopovod,
+            topic,
+            link,
+            release_type,
+            photos_count,
+            model,
+            raw_output,
+            parsed.post_text if parsed else None,
+            " ".join(parsed.hashtags) if parsed else None,
+            len(parsed.post_text) if parsed else None,
+            prompt_version,
+        )
+        + tuple(getattr(usage, f) if usage else None for f in USAGE_FIELDS)
+    )
+
+
+async def log_post_event(**fields):
+    """Ставит строку myasnik_posts в очередь; поля — как у post_log_row."""
+    if not post_log_writer.enabled:
+        return
+    post_log_writer.submit(post_log_row(**fields))
+
+
+async def db_maintenance_loop(pool: AsyncConnectionPool):
+    """Секции myasnik_posts на месяцы вперёд и свежие недельные сводки."""
+    while True:
+        try:
+            async with pool.connection() as conn:
+                await ensure_post_partitions(conn)
+                await refresh_rollups(conn)
+        except Exception as e:
+            print(f"[DB error] не удалось обслужить таблицы: {e}")
+        await asyncio.sleep(DB_MAINTENANCE_INTERVAL)
+
+
+# ===================== ХРАНИЛИЩЕ FSM ========================
+
+
+class TTLMemoryStorage(BaseStorage):
+    """
+    Хранилище в памяти процесса: одна запись (state, data, срок) на ключ.
+    Брошенные сессии протухают через FSM_TTL и вычищаются purge_expired().
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._records: dict[StorageKey, list] = {}
+
+    def _live(self, key: StorageKey) -> list | None:
+        record = self._records.get(key)
+        if record is not None and record[2] <= time.monotonic():
+            del self._records[key]
+            return None
+        return record
+
+    def _touch(self, key: StorageKey) -> list:
+        record = self._live(key)
+        if record is None:
+            record = [None, {}, 0.0]
+            self._records[key] = record
+        record[2] = time.monotonic() + self.ttl
+        return record
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._touch(key)[0] = state.state if isinstance(state, State) else state
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        record = self._live(key)
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        self._touch(key)[1] = copy.deepcopy(dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        record = self._live(key)
+        return copy.deepcopy(record[1]) if record else {}
+
+    async def purge_expired(self):
+        now = time.monotonic()
+        for key in [k for k, r in self._records.items() if r[2] <= now]:
+            del self._records[key]
+
+    async def count_states(self) -> dict[str, int]:
+        now = time.monotonic()
+        counts: dict[str, int] = {}
+        for state, _, expires_at in self._records.values():
+            if expires_at > now:
+                counts[state or "none"] = counts.get(state or "none", 0) + 1
+        return counts
+
+    async def close(self) -> None:
+        self._records.clear()
+
+
+class PostgresStorage(BaseStorage):
+    """FSM в таблице myasnik_fsm: переживает рестарты и общая для всех реплик."""
+
+    def __init__(self, pool: AsyncConnectionPool, ttl: int):
+        self.pool = pool
+        self.ttl = timedelta(seconds=ttl)
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+
+    async def _upsert(self, key: StorageKey, column: str, value):
+        # Протухшая запись при обновлении начинается с чистого листа
+        other = "data" if column == "state" else "state"
+        empty = "'{}'::jsonb" if other == "data" else "NULL"
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                f"""
+                INSERT INTO myasnik_fsm (key, {column}, expires_at)
+                VALUES (%s, %s, now() + %s)
+                ON CONFLICT (key) DO UPDATE SET
+                    {column} = EXCLUDED.{column},
+                    {other} = CASE
+                        WHEN myasnik_fsm.expires_at <= now() THEN {empty}
+                        ELSE myasnik_fsm.{other}
+                    END,
+                    expires_at = EXCLUDED.expires_at
+                """,
+                (self.key_builder.build(key), value, self.ttl),
+            )
+
+    async def _select(self, key: StorageKey, column: str):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(
+                f"SELECT {column} FROM myasnik_fsm "
+                "WHERE key = %s AND expires_at > now()",
+                (self.key_builder.build(key),),
+            )
+            row = await cur.fetchone()
+        return row[0] if row else None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self._upsert(key, "state", value)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return await self._select(key, "state")
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._upsert(key, "data", Jsonb(dict(data)))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return await self._select(key, "data") or {}
+
+    async def purge_expired(self):
+        async with self.pool.connection() as conn:
+            await conn.execute("DELETE FROM myasnik_fsm WHERE expires_at <= now()")
+
+    async def count_states(self) -> dict[str, int]:
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(
+                "SELECT coalesce(state, 'none'), count(*) FROM myasnik_fsm "
+                "WHERE expires_at > now() GROUP BY 1"
+            )
+            return dict(await cur.fetchall())
+
+    async def close(self) -> None:
+        # Пул принадлежит post_log_writer и закрывается вместе с ним
+        pass
+
+
+async def build_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "redis":
+        # redis нужен только для этого бэкенда
+        from aiogram.fsm.storage.redis import RedisEventIsolation, RedisStorage
+
+        storage = RedisStorage.from_url(
+            REDIS_URL, state_ttl=FSM_TTL, data_ttl=FSM_TTL
+        )
+        # Несколько реплик: блокировка пользователя тоже должна быть общей
+        dp.fsm.events_isolation = RedisEventIsolation(redis=storage.redis)
+        return storage
+
+    if FSM_STORAGE == "postgres":
+        if post_log_writer.pool is None:
+            raise RuntimeError("Для FSM_STORAGE=postgres нужен DATABASE_URL")
+        return PostgresStorage(post_log_writer.pool, FSM_TTL)
+
+    return TTLMemoryStorage(FSM_TTL)
+
+
+async def purge_fsm_loop(storage: BaseStorage):
+    """Периодически вычищаем брошенные сессии (у Redis свой TTL)."""
+    while True:
+        await asyncio.sleep(FSM_PURGE_INTERVAL)
+        try:
+            await storage.purge_expired()
+        except Exception as e:
+            print(f"[FSM] не удалось почистить сессии: {e}")
+
+
+# ===================== ФОТО ДЛЯ МОДЕЛИ ======================
+
+
+def encode_photo(raw: bytes) -> str:
+    """Ужимаем фото до PHOTO_MAX_SIDE и отдаём JPEG как data URL."""
+    # Импорт здесь, а не в начале модуля: на старте PIL не нужна
+    from PIL import Image, ImageOps
+
+    with Image.open(BytesIO(raw)) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        img.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+        out = BytesIO()
+        img.save(out, format="JPEG", quality=PHOTO_JPEG_QUALITY, optimize=True)
+    return "data:image/jpeg;base64," + base64.b64encode(out.getvalue()).decode()
+
+
+class PhotoStore:
+    """
+    Подготовленные фото по file_unique_id. Скачивание и пережатие
+    стартуют сразу при получении фото, пока пользователь идёт дальше
+    по сценарию; повторная генерация берёт готовый результат.
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._items: OrderedDict[str, asyncio.Task[str]] = OrderedDict()
+
+    def prefetch(self, bot: Bot, file_id: str, unique_id: str) -> asyncio.Task[str]:
+        task = self._items.get(unique_id)
+        if task is None or (
+            task.done() and (task.cancelled() or task.exception() is not None)
+        ):
+            task = asyncio.create_task(self._load(bot, file_id))
+            self._items[unique_id] = task
+        self._items.move_to_end(unique_id)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+        return task
+
+    async def load_many(self, bot: Bot, photos: list[dict]) -> list[str]:
+        tasks = [
+            self.prefetch(bot, p["file_id"], p["unique_id"]) for p in photos
+        ]
+        # shield: отмена одного хэндлера не должна ломать общую загрузку
+        results = await asyncio.gather(
+            *(asyncio.shield(t) for t in tasks), return_exceptions=True
+        )
+        images = []
+        for result in results:
+            if isinstance(result, BaseException):
+                print(f"[Photo error] {result}")
+                continue
+            images.append(result)
+        return images
+
+    async def _load(self, bot: Bot, file_id: str) -> str:
+        buf = await bot.download(file_id)
+        return await asyncio.to_thread(encode_photo, buf.getvalue())
+
+
+photo_store = PhotoStore(PHOTO_CACHE_SIZE)
+
+
+# ===================== МЕТАДАННЫЕ ССЫЛОК ====================
+
+# Одно поле метаданных в промпте не длиннее этого
+LINK_FIELD_MAX = 200
+
+
+@dataclass
+class LinkPreview:
+    title: str | None = None
+    artist: str | None = None
+    # Секунды
+    duration: int | None = None
+    site: str | None = None
+
+    def describe(self) -> str:
+        parts = []
+        if self.artist:
+            parts.append(f"исполнитель — {self.artist}")
+        if self.title:
+            parts.append(f"название — «{self.title}»")
+        if self.duration:
+            minutes, seconds = divmod(self.duration, 60)
+            parts.append(f"длительность — {minutes}:{seconds:02d}")
+        if self.site:
+            parts.append(f"площадка — {self.site}")
+        return "; ".join(parts)
+
+
+class LinkMetaParser(HTMLParser):
+    """Собирает <meta> (OpenGraph, twitter, itemprop), <title> и oEmbed-ссылку."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.meta: dict[str, str] = {}
+        self.title = ""
+        self.oembed_url: str | None = None
+        self._in_title = False
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]):
+        values = {name: value for name, value in attrs if value is not None}
+        if tag == "meta":
+            key = values.get("property") or values.get("name") or values.get("itemprop")
+            if key and values.get("content"):
+                self.meta.setdefault(key.lower(), values["content"])
+        elif tag == "link" and values.get("type") == "application/json+oembed":
+            self.oembed_url = self.oembed_url or values.get("href")
+        elif tag == "title":
+            self._in_title = True
+
+    def handle_endtag(self, tag: str):
+        if tag == "title":
+            self._in_title = False
+
+    def handle_data(self, data: str):
+        if self._in_title:
+            self.title += data
+
+
+def clip_field(value: Any) -> str | None:
+    value = " ".join(str(value).split()) if value else ""
+    return value[:LINK_FIELD_MAX] or None
+
+
+def parse_duration(value: str | None) -> int | None:
+    """Секунды из «225» или ISO 8601 «PT3M45S»."""
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    match = re.fullmatch(r"PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?", value.strip())
+    if not match:
+        return None
+    hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return hours * 3600 + minutes * 60 + seconds or None
+
+
+def parse_link_page(page: str) -> tuple[LinkPreview, str | None]:
+    """Метаданные страницы и адрес её oEmbed, если он объявлен."""
+    parser = LinkMetaParser()
+    parser.feed(page)
+    meta = parser.meta
+
+    def first(*keys: str) -> str | None:
+        return next((clip_field(meta[k]) for k in keys if meta.get(k)), None)
+
+    preview = LinkPreview(
+        title=first("og:title", "twitter:title") or clip_field(parser.title),
+        artist=first(
+            "music:musician_description",
+            "og:audio:artist",
+            "twitter:audio:artist_name",
+        ),
+        duration=parse_duration(
+            first("music:duration", "og:video:duration", "video:duration", "duration")
+        ),
+        site=first("og:site_name"),
+    )
+    return preview, parser.oembed_url
+
+
+class LinkPreviewStore:
+    """
+    Метаданные ссылок по URL с TTL. Загрузка стартует, как только ссылка
+    найдена в инфоповоде, и идёт, пока пользователь отвечает про премьеру
+    и шлёт фото; генерация берёт то, что успело прийти, и не ждёт.
+    """
+
+    def __init__(self, max_items: int, ttl: float):
+        self.max_items = max_items
+        self.ttl = ttl
+        # url -> (до какого момента верить, загрузка)
+        self._items: OrderedDict[str, tuple[float, asyncio.Task]] = OrderedDict()
+        self._session: ClientSession | None = None
+
+    def prefetch(self, url: str) -> asyncio.Task[LinkPreview | None]:
+        now = time.monotonic()
+        entry = self._items.get(url)
+        if entry is None or entry[0] < now or self._failed(entry[1]):
+            entry = (now + self.ttl, asyncio.create_task(self._load(url)))
+            self._items[url] = entry
+        self._items.move_to_end(url)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+        return entry[1]
+
+    async def describe(self, url: str | None, wait: float = 0.0) -> str | None:
+        """Строка для промпта, если метаданные готовы (ждём не дольше wait)."""
+        if not url:
+            return None
+        task = self.prefetch(url)
+        if not task.done() and wait > 0:
+            # shield не нужен: asyncio.wait саму загрузку не отменяет
+            await asyncio.wait({task}, timeout=wait)
+        if not task.done() or task.cancelled() or task.result() is None:
+            return None
+        return task.result().describe()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @staticmethod
+    def _failed(task: asyncio.Task) -> bool:
+        # Неудачу не кэшируем: следующий запрос попробует ещё раз
+        return task.done() and (task.cancelled() or task.result() is None)
+
+    async def _load(self, url: str) -> LinkPreview | None:
+        try:
+            preview = await asyncio.wait_for(self._fetch(url), LINK_FETCH_TIMEOUT)
+        except Exception as e:
+            LINK_PREVIEWS.labels("error").inc()
+            print(f"[Link error] {url}: {e!r}")
+            return None
+        LINK_PREVIEWS.labels("ok" if preview else "empty").inc()
+        return preview
+
+    async def _fetch(self, url: str) -> LinkPreview | None:
+        page, content_type = await self._read(url)
+        if content_type != "text/html":
+            return None
+        preview, oembed_url = await asyncio.to_thread(parse_link_page, page)
+        if oembed_url and not (preview.artist and preview.title):
+            try:
+                raw, _ = await self._read(urljoin(url, oembed_url))
+                oembed = json.loads(raw)
+                preview.artist = preview.artist or clip_field(oembed.get("author_name"))
+                preview.title = preview.title or clip_field(oembed.get("title"))
+                preview.site = preview.site or clip_field(oembed.get("provider_name"))
+            except Exception as e:
+                # Без oEmbed остаётся то, что нашлось в OpenGraph
+                print(f"[Link error] oEmbed {oembed_url}: {e!r}")
+        return preview if preview.describe() else None
+
+    async def _read(self, url: str) -> tuple[str, str]:
+        """Начало ответа не длиннее LINK_MAX_BYTES и его content-type."""
+        if self._session is None:
+            self._session = ClientSession(
+                timeout=ClientTimeout(total=LINK_FETCH_TIMEOUT),
+                headers={"User-Agent": "Mozilla/5.0 (compatible; MyasnikBot/1.0)"},
+            )
+        async with self._session.get(url, max_redirects=3) as resp:
+            resp.raise_for_status()
+            body = bytearray()
+            async for chunk in resp.content.iter_chunked(64 * 1024):
+                body += chunk
+                if len(body) >= LINK_MAX_BYTES:
+                    break
+            text = bytes(body[:LINK_MAX_BYTES]).decode(
+                resp.charset or "utf-8", errors="replace"
+            )
+            return text, resp.content_type
+
+
+link_previews = LinkPreviewStore(LINK_CACHE_SIZE, LINK_CACHE_TTL)
+
+
+# ===================== ЛИМИТЫ OPENAI =======================
+
+
+class TokenBucket:
+    """Ведро токенов, которое равномерно пополняется до per_minute за минуту."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float):
+        # Запрос крупнее всего ведра всё равно должен когда-то пройти
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class OpenAILimiter:
+    """Ограничение параллельности + RPM/TPM перед каждым запросом."""
+
+    def __init__(self, max_concurrency: int, rpm: int, tpm: int):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._rpm = TokenBucket(rpm) if rpm > 0 else None
+        self._tpm = TokenBucket(tpm) if tpm > 0 else None
+
+    @asynccontextmanager
+    async def slot(self, estimated_tokens: int):
+        async with self._semaphore:
+            if self._rpm is not None:
+                await self._rpm.acquire(1)
+            if self._tpm is not None:
+                await self._tpm.acquire(estimated_tokens)
+            yield
+
+
+openai_limiter = OpenAILimiter(
+    OPENAI_MAX_CONCURRENCY, OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка: кириллица в среднем ~2 символа на токен."""
+    return len(text) // 2 + 1
+
+
+# Картинка до PHOTO_MAX_SIDE с detail=auto обходится примерно во столько
+IMAGE_TOKENS_ESTIMATE = 1000
+
+
+# ===================== ОТПРАВКА В TELEGRAM ==================
+
+# Приоритет исходящих (меньше — раньше): готовый пост уже оплачен,
+# поэтому обгоняет подсказки и промежуточные правки стриминга
+PRIORITY_POST = 0
+PRIORITY_REPLY = 1
+PRIORITY_PROGRESS = 2
+
+_outbound_priority: ContextVar[int] = ContextVar(
+    "outbound_priority", default=PRIORITY_REPLY
+)
+_outbound_coalesce: ContextVar[str | None] = ContextVar(
+    "outbound_coalesce", default=None
+)
+
+
+@contextmanager
+def telegram_outbound(priority: int = PRIORITY_REPLY, coalesce: str | None = None):
+    """
+    Параметры исходящих запросов внутри блока. coalesce — ключ склейки:
+    из ещё не отправленных сообщений с одним ключом в один чат уходит
+    только последнее, а его ответ получают и все склеенные.
+    """
+    priority_token = _outbound_priority.set(priority)
+    coalesce_token = _outbound_coalesce.set(coalesce)
+    try:
+        yield
+    finally:
+        _outbound_priority.reset(priority_token)
+        _outbound_coalesce.reset(coalesce_token)
+
+
+class RateLimiter:
+    """
+    Ровный темп per_second с запасом burst запросов подряд (GCRA)
+    и очередью ожидающих по приоритету. acquire возвращает future:
+    True — можно отправлять, False — ожидание снято склейкой.
+    """
+
+    def __init__(self, per_second: float, burst: int = 1):
+        self.interval = 1.0 / per_second
+        self.tolerance = self.interval * (max(1, burst) - 1)
+        # Теоретическое время следующей отправки
+        self._tat = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def idle(self) -> bool:
+        return not self._waiters and self._tat <= time.monotonic()
+
+    def acquire(self, priority: int) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), waiter))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._grant_loop())
+        return waiter
+
+    def pause(self, seconds: float):
+        """Ничего не выдавать ближайшие seconds (ответ 429 от Telegram)."""
+        self._tat = max(self._tat, time.monotonic() + seconds + self.tolerance)
+
+    async def _grant_loop(self):
+        while self._waiters:
+            now = time.monotonic()
+            delay = self._tat - self.tolerance - now
+            if delay > 0:
+                # Пока спим, в голову очереди может встать более срочный
+                await asyncio.sleep(delay)
+                continue
+            _, _, waiter = heapq.heappop(self._waiters)
+            if waiter.done():
+                # Склеен с более новым или отменён вместе с хэндлером
+                continue
+            self._tat = max(self._tat, now) + self.interval
+            waiter.set_result(True)
+
+
+@dataclass
+class CoalescedSend:
+    # Разрешение лимитера чата и ответ Telegram для склеенных
+    waiter: asyncio.Future
+    result: asyncio.Future
+    newer: "CoalescedSend | None" = None
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """
+    Middleware сессии бота. Запрос с chat_id ждёт своей очереди сначала
+    в лимите чата, потом в общем; на 429 чат встаёт на паузу retry_after,
+    и запрос повторяется. Запросы без чата (getFile, ответы на колбэки)
+    лимиты сообщений не тратят, но 429 обрабатывают так же.
+    """
+
+    # Больше чатов не помним: простаивающие лимитеры выбрасываются
+    MAX_CHATS = 1024
+
+    def __init__(
+        self,
+        global_rate: float,
+        chat_rate: float,
+        chat_burst: int,
+        max_retries: int,
+    ):
+        self.global_limiter = RateLimiter(global_rate, burst=int(global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats: dict[int | str, RateLimiter] = {}
+        self._coalescing: dict[tuple[int | str, str], CoalescedSend] = {}
+
+    def chat_limiter(self, chat_id: int | str) -> RateLimiter:
+        limiter = self._chats.get(chat_id)
+        if limiter is None:
+            if len(self._chats) >= self.MAX_CHATS:
+                self._chats = {
+                    key: chat for key, chat in self._chats.items() if not chat.idle
+                }
+            limiter = RateLimiter(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = limiter
+        return limiter
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ) -> Response:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await self._request(make_request, bot, method)
+
+        limiter = self.chat_limiter(chat_id)
+        priority = _outbound_priority.get()
+        key = _outbound_coalesce.get()
+        if key is None:
+            await limiter.acquire(priority)
+            await self.global_limiter.acquire(priority)
+            return await self._request(make_request, bot, method, limiter, priority)
+
+        slot = (chat_id, key)
+        send = CoalescedSend(
+            limiter.acquire(priority), asyncio.get_running_loop().create_future()
+        )
+        previous = self._coalescing.get(slot)
+        if previous is not None and not previous.waiter.done():
+            previous.newer = send
+            previous.waiter.set_result(False)
+        self._coalescing[slot] = send
+        try:
+            if await send.waiter:
+                if self._coalescing.get(slot) is send:
+                    del self._coalescing[slot]
+                await self.global_limiter.acquire(priority)
+                response = await self._request(
+                    make_request, bot, method, limiter, priority
+                )
+            else:
+                TELEGRAM_REQUESTS.labels("coalesced").inc()
+                response = await asyncio.shield(send.newer.result)
+        except asyncio.CancelledError:
+            send.result.cancel()
+            raise
+        except Exception as e:
+            send.result.set_exception(e)
+            # Склеенных может и не быть: помечаем ошибку прочитанной
+            send.result.exception()
+            raise
+        finally:
+            if self._coalescing.get(slot) is send:
+                del self._coalescing[slot]
+        send.result.set_result(response)
+        return response
+
+    async def _request(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+        limiter: RateLimiter | None = None,
+        priority: int = PRIORITY_REPLY,
+    ) -> Response:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    TELEGRAM_REQUESTS.labels("failed").inc()
+                    raise
+                TELEGRAM_REQUESTS.labels("retry_after").inc()
+                print(
+                    f"[Telegram] 429 на {type(method).__name__}, "
+                    f"повтор через {e.retry_after}s"
+                )
+                if limiter is None:
+                    await asyncio.sleep(e.retry_after)
+                else:
+                    # Пауза на весь чат: остальные его сообщения тоже ждут
+                    limiter.pause(e.retry_after)
+                    await limiter.acquire(priority)
+                continue
+            TELEGRAM_REQUESTS.labels("sent").inc()
+            return response
+
+
+outbound_limiter = OutboundLimiter(
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_MAX_RETRIES
+)
+
+
+# ===================== МАРШРУТИЗАЦИЯ МОДЕЛЕЙ ================
+
+
+class ModelsUnavailableError(Exception):
+    """Все модели цепочки временно отключены автоматом."""
+
+
+class StreamFailedError(Exception):
+    """Поток Responses API закончился ошибкой, а не response.completed."""
+
+
+# Ошибки, после которых есть смысл повторить запрос чуть позже
+TRANSIENT_OPENAI_ERRORS = (
+    APIConnectionError,
+    RateLimitError,
+    InternalServerError,
+    ModelsUnavailableError,
+    StreamFailedError,
+)
+
+
+@dataclass
+class ModelRoute:
+    """Одно звено цепочки: клиент, таймаут, цены и наблюдаемое здоровье."""
+
+    name: str
+    model: str
+    # None — звено OpenAI без OPENAI_API_KEY (такой конфиг не пройдёт проверку)
+    client: AsyncOpenAI | None
+    timeout: float
+    max_output_tokens: int
+    # Цены за 1M токенов: вход, кэшированный вход, выход
+    prices: tuple[float, float, float]
+    # Лимиты RPM/TPM считаем только для запросов в сам OpenAI
+    uses_openai: bool = True
+    # Если p95 выше этого (сек), звено уходит в конец цепочки (0 — нет)
+    slow_p95: float = ROUTE_SLOW_P95
+    failures: int = 0
+    open_until: float = 0.0
+    latencies: dict[str, deque] = field(
+        default_factory=lambda: {
+            "total": deque(maxlen=ROUTE_LATENCY_WINDOW),
+            "first_token": deque(maxlen=ROUTE_LATENCY_WINDOW),
+        }
+    )
+
+    def p95(self, kind: str) -> float | None:
+        samples = self.latencies[kind]
+        if len(samples) < ROUTE_MIN_SAMPLES:
+            return None
+        return statistics.quantiles(samples, n=20)[18]
+
+    def available(self) -> bool:
+        # Открытый автомат после паузы пропускает пробный запрос
+        return self.open_until <= time.monotonic()
+
+    def is_slow(self) -> bool:
+        p95 = self.p95("total")
+        return bool(self.slow_p95 and p95 is not None and p95 > self.slow_p95)
+
+    def hedge_delay(self, streaming: bool) -> float:
+        # В стриминге пользователь ждёт первого токена, а не всего ответа
+        p95 = self.p95("first_token" if streaming else "total")
+        return HEDGE_DEFAULT_DELAY if p95 is None else max(HEDGE_MIN_DELAY, p95)
+
+    def record_success(self, elapsed: float):
+        self.latencies["total"].append(elapsed)
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= ROUTE_FAILURE_THRESHOLD:
+            self.open_until = time.monotonic() + ROUTE_COOLDOWN
+            ROUTER_EVENTS.labels(self.name, "breaker_open").inc()
+            print(f"[Router] {self.name} отключена на {ROUTE_COOLDOWN:.0f}s")
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "available": self.available(),
+            "failures": self.failures,
+            "p95": self.p95("total"),
+            "p95_first_token": self.p95("first_token"),
+        }
+
+
+def build_openai_client() -> AsyncOpenAI | None:
+    """
+    Общий асинхронный клиент OpenAI с одним пулом HTTP-соединений на все
+    генерации. Без ключа SDK падает прямо в конструкторе, поэтому клиента
+    тогда нет вовсе: об этом при старте скажет validate_config.
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return None
+    return AsyncOpenAI(
+        api_key=api_key,
+        timeout=OPENAI_TIMEOUT,
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONCURRENCY,
+                max_keepalive_connections=OPENAI_MAX_CONCURRENCY,
+            ),
+        ),
+    )
+
+
+def build_model_routes() -> list[ModelRoute]:
+    configs = json.loads(MODEL_ROUTES) if MODEL_ROUTES else [{"model": MODEL_NAME}]
+    routes = []
+    # Клиент OpenAI создаётся, только если в цепочке есть звено без base_url
+    openai_client = None
+    for config in configs:
+        base_url = config.get("base_url")
+        timeout = float(config.get("timeout", OPENAI_TIMEOUT))
+        if base_url:
+            # OpenAI-совместимый сервер: свой клиент, по умолчанию бесплатный
+            api_key_env = config.get("api_key_env")
+            client = AsyncOpenAI(
+                base_url=base_url,
+                api_key=(os.getenv(api_key_env) if api_key_env else None) or "local",
+                timeout=timeout,
+            )
+            prices = (0.0, 0.0, 0.0)
+        else:
+            openai_client = openai_client or build_openai_client()
+            client = openai_client
+            prices = (OPENAI_PRICE_INPUT, OPENAI_PRICE_CACHED, OPENAI_PRICE_OUTPUT)
+        routes.append(
+            ModelRoute(
+                name=config.get("name", config["model"]),
+                model=config["model"],
+                client=client,
+                timeout=timeout,
+                max_output_tokens=int(
+                    config.get("max_output_tokens", MAX_OUTPUT_TOKENS)
+                ),
+                prices=tuple(config.get("prices", prices)),
+                uses_openai=not base_url,
+                slow_p95=float(config.get("slow_p95", ROUTE_SLOW_P95)),
+            )
+        )
+    return routes
+
+
+class ModelRouter:
+    """Цепочка моделей по приоритету с учётом автоматов и задержек."""
+
+    def __init__(self, routes: list[ModelRoute]):
+        self.routes = routes
+
+    def candidates(self) -> list[ModelRoute]:
+        available = [route for route in self.routes if route.available()]
+        # Сортировка стабильная: среди быстрых порядок остаётся как в конфиге
+        return sorted(available, key=lambda route: route.is_slow())
+
+    def stats(self) -> list[dict]:
+        return [route.stats() for route in self.routes]
+
+    async def close(self):
+        clients = {
+            id(route.client): route.client
+            for route in self.routes
+            if route.client is not None
+        }
+        for client in clients.values():
+            await client.close()
+
+
+model_router = ModelRouter(build_model_routes())
+
+
+# ===================== МЕТРИКИ ВЫЗОВОВ ======================
+
+# Накопительные счётчики с момента старта процесса
+usage_totals = {
+    "calls": 0,
+    "input_tokens": 0,
+    "cached_tokens": 0,
+    "output_tokens": 0,
+}
+
+
+def record_usage(response, elapsed: float, route: ModelRoute) -> GenerationUsage:
+    """Логируем токены (в т.ч. закэшированные) и время одного вызова."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        print(f"[OpenAI usage] model={route.name} latency={elapsed:.2f}s")
+        return GenerationUsage(api_calls=1, generation_seconds=elapsed)
+
+    details = getattr(usage, "input_tokens_details", None)
+    input_tokens = getattr(usage, "input_tokens", 0) or 0
+    cached_tokens = getattr(details, "cached_tokens", 0) or 0
+    output_tokens = getattr(usage, "output_tokens", 0) or 0
+    output_details = getattr(usage, "output_tokens_details", None)
+    reasoning_tokens = getattr(output_details, "reasoning_tokens", 0) or 0
+    price_input, price_cached, price_output = route.prices
+    cost = (
+        (input_tokens - cached_tokens) * price_input
+        + cached_tokens * price_cached
+        + output_tokens * price_output
+    ) / 1_000_000
+
+    usage_totals["calls"] += 1
+    usage_totals["input_tokens"] += input_tokens
+    usage_totals["cached_tokens"] += cached_tokens
+    usage_totals["output_tokens"] += output_tokens
+
+    OPENAI_TOKENS.labels(route.name, "input").observe(input_tokens)
+    OPENAI_TOKENS.labels(route.name, "cached").observe(cached_tokens)
+    OPENAI_TOKENS.labels(route.name, "output").observe(output_tokens)
+
+    hit_ratio = cached_tokens / input_tokens if input_tokens else 0.0
+    total_ratio = (
+        usage_totals["cached_tokens"] / usage_totals["input_tokens"]
+        if usage_totals["input_tokens"]
+        else 0.0
+    )
+    print(
+        f"[OpenAI usage] model={route.name} latency={elapsed:.2f}s "
+        f"input={input_tokens} cached={cached_tokens} ({hit_ratio:.0%}) "
+        f"output={output_tokens} total_cached={total_ratio:.0%} cost=${cost:.4f}"
+    )
+    return GenerationUsage(
+        api_calls=1,
+        input_tokens=input_tokens,
+        cached_tokens=cached_tokens,
+        output_tokens=output_tokens,
+        reasoning_tokens=reasoning_tokens,
+        generation_seconds=elapsed,
+        cost_usd=cost,
+    )
+
+
+# ===================== ВЫЗОВ МОДЕЛИ =========================
+
+
+def extract_response_text(response) -> str:
+    """Пытаемся вытащить текст из ответа Responses API максимально надёжно."""
+
+    text = ""
+
+    # 1) output_text (если SDK это заполняет)
+    ot = getattr(response, "output_text", None)
+    if isinstance(ot, str):
+        text = ot.strip()
+    elif ot is not None:
+        t_candidate = getattr(ot, "text", None) or getattr(ot, "value", None)
+        if isinstance(t_candidate, str):
+            text = t_candidate.strip()
+
+    # 2) Разбор response.output[*].content[*]
+    if not text:
+        out_list = getattr(response, "output", None)
+        if out_list:
+            parts: list[str] = []
+            for out_item in out_list:
+                content_list = getattr(out_item, "content", None)
+                if not content_list:
+                    continue
+                for c in content_list:
+                    t_candidate = getattr(c, "text", None) or getattr(
+                        c, "value", None
+                    )
+                    if isinstance(t_candidate, str):
+                        parts.append(t_candidate)
+            if parts:
+                text = "\n".join(parts).strip()
+
+    return text
+
+
+# События, которыми поток заканчивается без готового ответа
+STREAM_FAILURE_EVENTS = ("response.failed", "response.incomplete", "error")
+
+
+def stream_failure_reason(event) -> str:
+    """Причина обрыва потока для лога и текста ошибки."""
+    if event.type == "error":
+        code = f" {event.code}" if event.code else ""
+        return f"error{code}: {event.message}"
+    response = event.response
+    if event.type == "response.incomplete":
+        details = response.incomplete_details
+        return f"incomplete: {details.reason if details else 'unknown'}"
+    error = response.error
+    return f"failed: {error.message if error else response.status}"
+
+
+async def call_model(
+    route: ModelRoute,
+    messages: list[dict],
+    estimated_tokens: int,
+    prompt_cache_key: str,
+    on_text: Callable[[str], None] | None = None,
+    usage: GenerationUsage | None = None,
+):
+    """
+    Один запрос к Responses API одного звена; возвращает (текст, ответ).
+    Токены и стоимость вызова прибавляются к usage, если он передан.
+    """
+    limiter = (
+        openai_limiter.slot(estimated_tokens) if route.uses_openai else nullcontext()
+    )
+    async with limiter:
+        request = dict(
+            model=route.model,
+            input=messages,
+            max_output_tokens=route.max_output_tokens,
+            prompt_cache_key=prompt_cache_key,
+            timeout=route.timeout,
+        )
+        started = time.monotonic()
+        status = "error"
+
+        with tracer.start_as_current_span(
+            "openai.responses.create",
+            attributes={"llm.model": route.name, "llm.stream": on_text is not None},
+        ):
+            try:
+                if on_text is None:
+                    response = await route.client.responses.create(**request)
+                    text = extract_response_text(response)
+                else:
+                    response = None
+                    failure = None
+                    streamed = ""
+                    stream = await route.client.responses.create(
+                        **request, stream=True
+                    )
+                    async for event in stream:
+                        if event.type == "response.output_text.delta":
+                            if not streamed:
+                                route.latencies["first_token"].append(
+                                    time.monotonic() - started
+                                )
+                            streamed += event.delta
+                            on_text(streamed)
+                        elif event.type == "response.completed":
+                            response = event.response
+                        elif event.type in STREAM_FAILURE_EVENTS:
+                            failure = event
+                            break
+                    if failure is not None:
+                        # Токены оборванного ответа тоже оплачены
+                        failed = getattr(failure, "response", None)
+                        if failed is not None:
+                            call_usage = record_usage(
+                                failed, time.monotonic() - started, route
+                            )
+                            if usage is not None:
+                                usage.add(call_usage)
+                        raise StreamFailedError(stream_failure_reason(failure))
+                    text = extract_response_text(response) if response else ""
+                    text = text or streamed.strip()
+                status = "ok"
+            except TRANSIENT_OPENAI_ERRORS:
+                route.record_failure()
+                raise
+            finally:
+                OPENAI_LATENCY.labels(route.name, status).observe(
+                    time.monotonic() - started
+                )
+
+        elapsed = time.monotonic() - started
+        route.record_success(elapsed)
+        call_usage = record_usage(response, elapsed, route)
+        if usage is not None:
+            usage.add(call_usage)
+    return text, response
+
+
+async def call_writer(
+    messages: list[dict],
+    estimated_tokens: int,
+    prompt_cache_key: str,
+    on_text: Callable[[str], None] | None = None,
+    usage: GenerationUsage | None = None,
+):
+    """
+    Запрос через цепочку моделей; возвращает (текст, ответ).
+    Первым идёт лучшее доступное звено. Молчит дольше своего p95 —
+    параллельно запускаем следующее (хедж), ошибка — идём дальше
+    по цепочке. Побеждает первый непустой ответ, остальные отменяются;
+    при стриминге на экран идёт только поток, первым давший текст.
+    """
+    routes = model_router.candidates()
+    if not routes:
+        raise ModelsUnavailableError("все модели временно отключены после ошибок")
+
+    tasks: dict[asyncio.Task, ModelRoute] = {}
+    shown: ModelRoute | None = None
+    empty = None
+    last_error: Exception | None = None
+
+    def launch(route: ModelRoute):
+        def relay(text: str):
+            nonlocal shown
+            if shown is None:
+                shown = route
+                # Поток уже на экране — запасные запросы больше не нужны
+                for task, other in tasks.items():
+                    if other is not route:
+                        task.cancel()
+            if shown is route:
+                on_text(text)
+
+        task = asyncio.create_task(
+            call_model(
+                route,
+                messages,
+                estimated_tokens,
+                prompt_cache_key,
+                relay if on_text is not None else None,
+                usage,
+            )
+        )
+        tasks[task] = route
+
+    launch(routes.pop(0))
+    try:
+        while tasks:
+            hedge = HEDGE_REQUESTS and routes and shown is None and len(tasks) == 1
+            timeout = (
+                next(iter(tasks.values())).hedge_delay(on_text is not None)
+                if hedge
+                else None
+            )
+            done, _ = await asyncio.wait(
+                tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                ROUTER_EVENTS.labels(routes[0].name, "hedge").inc()
+                launch(routes.pop(0))
+                continue
+
+            for task in done:
+                route = tasks.pop(task)
+                if shown is route:
+                    shown = None
+                if task.cancelled():
+                    continue
+                if task.exception() is not None:
+                    last_error = task.exception()
+                    print(f"[Router] {route.name}: {last_error}")
+                    continue
+                text, response = task.result()
+                if text:
+                    return text, response
+                ROUTER_EVENTS.labels(route.name, "empty").inc()
+                print(
+                    f"[Router] {route.name}: пустой ответ "
+                    f"id={getattr(response, 'id', None)} "
+                    f"status={getattr(response, 'status', None)}"
+                )
+                empty = (text, response)
+
+            if not tasks and routes:
+                ROUTER_EVENTS.labels(routes[0].name, "fallback").inc()
+                launch(routes.pop(0))
+
+        if empty is not None:
+            return empty
+        raise last_error or ModelsUnavailableError("ни одна модель не ответила")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def build_writer_messages(
+    prompt: PromptVersion,
+    infopovod: str | None,
+    topic: str | None,
+    link: str | None,
+    release_type: str | None,
+    photos_count: int,
+    images: list[str] | None = None,
+    link_info: str | None = None,
+    examples: list[str] | None = None,
+) -> tuple[list[dict], int]:
+    """
+    Сообщения system+user для писателя и оценка токенов запроса.
+    Общие для интерактивной генерации и пакетного контент-плана.
+    examples — готовые примеры из архива; без них индекс опрашивается
+    здесь же, синхронно (так делает пакетный bulk.py).
+    """
+    infopovod_str = infopovod or "нет"
+    topic_str = topic or "нет"
+    link_str = link or "нет"
+    release_type_str = release_type or "нет"
+    photos_flag = "есть" if photos_count > 0 else "нет"
+
+    user_prompt = (
+        f"ИНФОПОВОД: {infopovod_str}\n"
+        f"ТЕМА: {topic_str}\n"
+        f"ССЫЛКА: {link_str}\n"
+    )
+    if link_info:
+        # Метаданные страницы по ссылке, если успели загрузиться
+        user_prompt += f"О ССЫЛКЕ: {link_info}\n"
+    user_prompt += (
+        f"ТИП РЕЛИЗА: {release_type_str}\n"
+        f"ФОТО: {photos_flag} (количество: {photos_count})\n\n"
+    )
+
+    # Примеры из архива идут после неизменного system-префикса,
+    # поэтому кэш промптов они не ломают
+    if examples is None:
+        examples = archive_examples(archive_query(infopovod, topic))
+    if examples:
+        user_prompt += (
+            "ПРИМЕРЫ ИЗ АРХИВА КОНСТАНТИНА (ориентир по тону, не копировать):\n"
+            + "\n".join(f"— {example}" for example in examples)
+            + "\n\n"
+        )
+
+    user_prompt += (
+        "Сгенерируй пост строго по инструкциям из SYSTEM-промпта.\n"
+        "Соблюдай формат OUTPUT FORMAT."
+    )
+
+    user_content: str | list[dict] = user_prompt
+    if images:
+        user_content = [{"type": "input_text", "text": user_prompt}] + [
+            {"type": "input_image", "image_url": url, "detail": "auto"}
+            for url in images
+        ]
+
+    estimated_tokens = (
+        estimate_tokens(prompt.text)
+        + estimate_tokens(user_prompt)
+        + IMAGE_TOKENS_ESTIMATE * len(images or [])
+        + MAX_OUTPUT_TOKENS
+    )
+
+    # ВАЖНО: system-промпт передаём как отдельное сообщение и всегда
+    # первым — неизменный префикс попадает в кэш промптов OpenAI.
+    # Всё, что меняется от запроса к запросу, идёт только после него.
+    messages = [
+        {"role": "system", "content": prompt.text},
+        {"role": "user", "content": user_content},
+    ]
+    return messages, estimated_tokens
+
+
+async def repair_post_format(
+    messages: list[dict],
+    text: str,
+    estimated_tokens: int,
+    prompt: PromptVersion,
+    usage: GenerationUsage | None = None,
+) -> str:
+    """
+    Один дешёвый точечный ремонт вместо полной перегенерации: префикс
+    тот же (кэшируется), модели показываем только нарушения формата.
+    Возвращает исправленный текст, если он лучше исходного.
+    """
+    problems = validate_post(parse_post_output(text))
+    if not problems:
+        return text
+
+    print(f"[Format] нарушения: {'; '.join(problems)} — чиним")
+    repair_messages = messages + [
+        {"role": "assistant", "content": text},
+        {
+            "role": "user",
+            "content": (
+                "Исправь только эти нарушения, сохранив смысл и стиль:\n- "
+                + "\n- ".join(problems)
+                + "\nВерни ответ целиком строго в формате OUTPUT FORMAT."
+            ),
+        },
+    ]
+    try:
+        repaired, _ = await call_writer(
+            repair_messages,
+            estimated_tokens + estimate_tokens(text) + MAX_OUTPUT_TOKENS,
+            prompt.cache_key,
+            usage=usage,
+        )
+    except Exception as e:
+        # Не починили — отдаём исходный текст, он лучше ошибки
+        print(f"[OpenAI error] ремонт не удался: {e}")
+        return text
+    remaining = validate_post(parse_post_output(repaired)) if repaired else None
+    if remaining is not None and len(remaining) < len(problems):
+        return repaired
+    return text
+
+
+async def generate_post_with_writer(
+    infopovod: str | None,
+    topic: str | None,
+    link: str | None,
+    release_type: str | None,
+    photos_count: int,
+    on_text: Callable[[str], None] | None = None,
+    images: list[str] | None = None,
+    prompt: PromptVersion | None = None,
+    retry_transient: bool = False,
+    usage: GenerationUsage | None = None,
+    link_info: str | None = None,
+) -> str:
+    """
+    Генерирует пост через OpenAI Responses API (модель gpt-5.1).
+    Используем system+user в input и стараемся максимально надёжно
+    вытащить текст из ответа.
+    Если передан on_text — запрос идёт в режиме stream=True, и колбэк
+    получает накопленный текст по мере прихода токенов.
+    images — подготовленные фото (data URL), уходят в user-сообщение.
+    prompt — снимок версии промпта; по умолчанию текущая из реестра.
+    retry_transient=True пробрасывает временные ошибки OpenAI наружу,
+    чтобы фоновое задание повторили позже, а не отдали ошибку сразу.
+    usage накапливает токены и стоимость всех вызовов этой генерации.
+    link_info — описание страницы по ссылке (LinkPreviewStore.describe).
+    """
+
+    prompt = prompt or prompt_registry.current
+    if prompt is None:
+        return (
+            "Не удалось сгенерировать пост: системный промпт не загружен.\n"
+            "Проверь файл myasnik_prompt.txt."
+        )
+
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key and any(route.uses_openai for route in model_router.routes):
+        return (
+            "Не удалось сгенерировать пост: отсутствует API-ключ OpenAI.\n"
+            "Проверь переменную OPENAI_API_KEY в Railway."
+        )
+
+    # Индекс архива перечитывается и опрашивается в потоке, не на цикле событий
+    examples = await asyncio.to_thread(
+        archive_examples, archive_query(infopovod, topic)
+    )
+    messages, estimated_tokens = build_writer_messages(
+        prompt,
+        infopovod,
+        topic,
+        link,
+        release_type,
+        photos_count,
+        images,
+        link_info,
+        examples,
+    )
+
+    try:
+        text, _ = await call_writer(
+            messages, estimated_tokens, prompt.cache_key, on_text, usage
+        )
+
+        if not text:
+            # Звено, id и статус ответа уже в логе и метрике call_writer
+            return (
+                "Не удалось сгенерировать пост: модель не вернула текст.\n"
+                "Попробуй ещё раз — я перепроверю формат."
+            )
+
+        return await repair_post_format(
+            messages, text, estimated_tokens, prompt, usage
+        )
+
+    except Exception as e:
+        if retry_transient and isinstance(e, TRANSIENT_OPENAI_ERRORS):
+            raise
+        err = str(e)
+        print(f"[OpenAI error] {err}")
+        return (
+            "Не удалось сгенерировать пост: "
+            f"техническая ошибка OpenAI ({err}).\n"
+            "Попробуй ещё раз или пришли скрин ошибки."
+        )
+
+
+# ===================== ОЧЕРЕДЬ ГЕНЕРАЦИЙ ===================
+
+# Так начинаются все ответы-ошибки generate_post_with_writer, их не кэшируем
+GENERATION_ERROR_PREFIX = "Не удалось сгенерировать пост"
+
+
+class GenerationQueue:
+    """
+    Ограниченная очередь + фиксированный пул воркеров для вызовов модели.
+    Больше GEN_WORKERS генераций одновременно не идёт; остальные ждут
+    в очереди и получают свою позицию, переполнение — вежливый отказ.
+    Заявка выполняется в контексте того, кто её поставил (спан апдейта
+    или задания), а не в контексте воркера.
+    """
+
+    def __init__(self, workers: int, max_size: int):
+        self.workers = workers
+        self.max_size = max_size
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._busy = 0
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        # Чистый контекст: иначе воркеры навсегда унаследуют спан того,
+        # кто их запустил, и чужие вызовы модели попадут в его трейс
+        self._tasks = [
+            asyncio.create_task(self._worker(), context=Context())
+            for _ in range(self.workers)
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    async def run(
+        self,
+        factory: Callable[[], Awaitable[str]],
+        on_queued: Callable[[int], None] | None = None,
+    ) -> str:
+        if self._queue is None:
+            self.start()
+        if self._queue.full():
+            return (
+                f"{GENERATION_ERROR_PREFIX}: сейчас слишком много заявок.\n"
+                "Попробуй ещё раз через пару минут."
+            )
+
+        # Все воркеры заняты — сообщаем, сколько заявок впереди
+        position = self._queue.qsize() + 1 if self._busy >= self.workers else 0
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((factory, future, copy_context()))
+        if position and on_queued is not None:
+            on_queued(position)
+        return await future
+
+    async def _worker(self):
+        while True:
+            factory, future, context = await self._queue.get()
+            if future.cancelled():
+                # Тот, кто ждал результат, уже ушёл
+                continue
+            self._busy += 1
+            try:
+                result = await asyncio.create_task(factory(), context=context)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._busy -= 1
+
+
+generation_queue = GenerationQueue(GEN_WORKERS, GEN_QUEUE_SIZE)
+
+
+# ===================== КЭШ ГЕНЕРАЦИЙ =======================
+
+
+class GenerationCache:
+    """
+    LRU + TTL кэш готовых постов и single-flight: одинаковые запросы,
+    пришедшие одновременно, ждут один общий вызов модели.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+        }
+
+    def _get(self, key: str) -> str | None:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def _put(self, key: str, value: str):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    async def get_or_create(
+        self,
+        key: str,
+        factory: Callable[[], Awaitable[str]],
+        bypass: bool = False,
+    ) -> str:
+        if not bypass:
+            cached = self._get(key)
+            if cached is not None:
+                self.hits += 1
+                GENERATION_CACHE.labels("hit").inc()
+                return cached
+            inflight = self._inflight.get(key)
+            if inflight is not None:
+                self.shared += 1
+                GENERATION_CACHE.labels("coalesced").inc()
+                return await asyncio.shield(inflight)
+
+        self.misses += 1
+        GENERATION_CACHE.labels("miss").inc()
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await factory()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Помечаем исключение прочитанным, даже если ждущих не было
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            if not value.startswith(GENERATION_ERROR_PREFIX):
+                self._put(key, value)
+            return value
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+
+generation_cache = GenerationCache(GEN_CACHE_SIZE, GEN_CACHE_TTL)
+
+
+def _normalize(value: str | None) -> str | None:
+    return " ".join(value.split()) if value else None
+
+
+def generation_cache_key(post_request: dict, prompt: PromptVersion | None) -> str:
+    payload = json.dumps(
+        [
+            _normalize(post_request["infopovod"]),
+            _normalize(post_request["topic"]),
+            _normalize(post_request["link"]),
+            _normalize(post_request["release_type"]),
+            [p["unique_id"] for p in post_request["photos"]],
+            MODEL_NAME,
+            prompt.version if prompt else None,
+        ],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def writer_kwargs(
+    post_request: dict,
+    images: list[str],
+    prompt: PromptVersion | None,
+    retry_transient: bool = False,
+    link_info: str | None = None,
+) -> dict:
+    """Аргументы generate_post_with_writer из сохранённого запроса."""
+    return dict(
+        infopovod=post_request["infopovod"],
+        topic=post_request["topic"],
+        link=post_request["link"],
+        release_type=post_request["release_type"],
+        photos_count=len(post_request["photos"]),
+        images=images,
+        prompt=prompt,
+        retry_transient=retry_transient,
+        link_info=link_info,
+    )
+
+
+async def generate_post_cached(
+    post_request: dict,
+    images: list[str],
+    prompt: PromptVersion | None,
+    on_text: Callable[[str], None] | None = None,
+    regenerate: bool = False,
+    on_queued: Callable[[int], None] | None = None,
+    retry_transient: bool = False,
+    usage: GenerationUsage | None = None,
+    link_info: str | None = None,
+) -> str:
+    """
+    generate_post_with_writer через кэш; regenerate=True идёт мимо кэша.
+    Промахи кэша встают в общую очередь генераций. При попадании в кэш
+    или в чужой одновременный вызов usage остаётся нулевым.
+    """
+    return await generation_cache.get_or_create(
+        generation_cache_key(post_request, prompt),
+        lambda: generation_queue.run(
+            lambda: generate_post_with_writer(
+                **writer_kwargs(
+                    post_request, images, prompt, retry_transient, link_info
+                ),
+                on_text=on_text,
+                usage=usage,
+            ),
+            on_queued,
+        ),
+        bypass=regenerate,
+    )
+
+
+def queued_notice(position: int) -> str:
+    return f"В очереди, позиция {position}. Пост начнёт писаться чуть позже…"
+
+
+async def log_post_request(
+    tg_user_id: int,
+    tg_username: str | None,
+    post_request: dict,
+    raw_output: str,
+    prompt_version: str | None,
+    usage: GenerationUsage | None = None,
+):
+    try:
+        await log_post_event(
+            tg_user_id=tg_user_id,
+            tg_username=tg_username,
+            infopovod=post_request["infopovod"],
+            topic=post_request["topic"],
+            link=post_request["link"],
+            release_type=post_request["release_type"],
+            photos_count=len(post_request["photos"]),
+            model=MODEL_NAME,
+            raw_output=raw_output,
+            prompt_version=prompt_version,
+            usage=usage,
+        )
+    except Exception as e:
+        # Логирование не должно ломать поток, но и молча теряться тоже
+        DB_ROWS.labels("error").inc()
+        print(f"[DB error] не удалось поставить строку в очередь: {e}")
+
+
+# ===================== ФОНОВЫЕ ЗАДАНИЯ =====================
+
+JOB_ACCEPTED_TEXT = "Заявка принята, скоро начну писать пост…"
+JOB_QUEUE_FULL_TEXT = (
+    f"{GENERATION_ERROR_PREFIX}: сейчас слишком много заявок.\n"
+    "Попробуй ещё раз через пару минут."
+)
+
+
+def current_trace_context() -> dict[str, str]:
+    """traceparent текущего спана — чтобы продолжить трейс в другом процессе."""
+    carrier: dict[str, str] = {}
+    propagate.inject(carrier)
+    return carrier
+
+
+@dataclass
+class PostJob:
+    """Заявка на генерацию: всё, что нужно воркеру без апдейта Telegram."""
+
+    chat_id: int
+    user_id: int
+    username: str | None
+    post_request: dict
+    # Сообщение-заглушка, которое воркер превратит в готовый пост
+    placeholder_id: int
+    regenerate: bool = False
+    variants: int = 1
+    # Трейс апдейта, поставившего заявку: спан задания продолжает его
+    trace_context: dict[str, str] = field(default_factory=current_trace_context)
+    id: int | None = None
+    attempts: int = 0
+
+    def payload(self) -> dict:
+        return {
+            "post_request": self.post_request,
+            "placeholder_id": self.placeholder_id,
+            "regenerate": self.regenerate,
+            "variants": self.variants,
+            "trace_context": self.trace_context,
+        }
+
+
+async def create_and_send_post(
+    bot: Bot,
+    job: PostJob,
+    retry_transient: bool = False,
+) -> str:
+    """Генерирует пост в заглушку заявки и пишет событие в БД."""
+    # Без стриминга заглушка просто один раз заменяется готовым текстом
+    editor = StreamingEditor(bot, job.chat_id, job.placeholder_id)
+    editor.push("Пишу пост…")
+    # Один снимок промпта на всю генерацию, даже если файл подменят
+    prompt = prompt_registry.current
+    images = await photo_store.load_many(bot, job.post_request["photos"])
+    link_info = await link_previews.describe(
+        job.post_request["link"], LINK_PREVIEW_WAIT
+    )
+    usage = GenerationUsage()
+    try:
+        post_output = await generate_post_cached(
+            job.post_request,
+            images,
+            prompt,
+            on_text=editor.push if STREAM_POSTS else None,
+            regenerate=job.regenerate,
+            on_queued=lambda position: editor.push(queued_notice(position)),
+            retry_transient=retry_transient,
+            usage=usage,
+            link_info=link_info,
+        )
+    except BaseException:
+        await editor.finish("")
+        raise
+
+    # Пост уже оплачен: расход и строка в БД — до доставки, которая
+    # может упасть на стороне Telegram
+    usage_ledger.record(
+        job.user_id,
+        job.username,
+        usage_topic(job.post_request, post_output),
+        usage,
+    )
+    await log_post_request(
+        job.user_id,
+        job.username,
+        job.post_request,
+        post_output,
+        prompt.version if prompt else None,
+        usage,
+    )
+    await editor.finish(post_output, reply_markup=regenerate_keyboard())
+    return post_output
+
+
+async def create_and_send_drafts(
+    bot: Bot,
+    job: PostJob,
+    retry_transient: bool = False,
+):
+    """
+    Генерирует job.variants черновиков параллельно и показывает каждый
+    с кнопкой выбора. В БД пишется только выбранный вариант.
+    """
+    editor = StreamingEditor(bot, job.chat_id, job.placeholder_id)
+    editor.push(f"Пишу варианты поста ({job.variants} шт.)…")
+
+    # Мимо кэша: одинаковые запросы здесь должны дать разные тексты.
+    # Каждый вариант — отдельная заявка в общей очереди генераций.
+    started = time.monotonic()
+    prompt = prompt_registry.current
+    images = await photo_store.load_many(bot, job.post_request["photos"])
+    link_info = await link_previews.describe(
+        job.post_request["link"], LINK_PREVIEW_WAIT
     )
-
-
-def create_post_keyboard() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Создать пост")],
-        ],
-        resize_keyboard=True,
+    kwargs = writer_kwargs(
+        job.post_request, images, prompt, retry_transient, link_info
+    )
+    usages = [GenerationUsage() for _ in range(job.variants)]
+    drafts = await asyncio.gather(
+        *(
+            generation_queue.run(
+                lambda usage=usages[i]: generate_post_with_writer(
+                    **kwargs, usage=usage
+                ),
+                # О позиции в очереди достаточно сказать один раз
+                (lambda pos: editor.push(queued_notice(pos))) if i == 0 else None,
+            )
+            for i in range(job.variants)
+        ),
+        return_exceptions=True,
+    )
+    failed = [d for d in drafts if isinstance(d, BaseException)]
+    if failed:
+        # Повторяем задание целиком, чтобы вариантов было столько же
+        await editor.finish("")
+        raise failed[0]
+    print(f"[Drafts] {job.variants} вариантов за {time.monotonic() - started:.2f}s")
+
+    # Платим за все варианты, даже если выберут один; учёт — до доставки
+    total = GenerationUsage()
+    for usage in usages:
+        total.add(usage)
+    usage_ledger.record(
+        job.user_id, job.username, usage_topic(job.post_request, drafts[0]), total
     )
 
+    # Воркер работает вне апдейта, поэтому контекст FSM берём по ключу и сам
+    # берёт замок изоляции: иначе запись гонится с обработчиком того же чата
+    state = dp.fsm.get_context(bot, job.chat_id, job.user_id)
+    async with dp.fsm.events_isolation.lock(state.key):
+        await state.update_data(
+            drafts=list(drafts),
+            drafts_prompt_version=prompt.version if prompt else None,
+            drafts_usage=asdict(total),
+        )
 
-# ===================== ВСПОМОГАТЕЛЬНОЕ ======================
-
+    await editor.finish("Варианты готовы — выберите один ниже.")
+    with telegram_outbound(PRIORITY_POST):
+        for i, draft in enumerate(drafts):
+            parsed = parse_post_output(draft)
+            if parsed is None:
+                # Ошибка или ответ не по формату — выбрать такой нельзя
+                await bot.send_message(
+                    job.chat_id, f"Вариант {i + 1}/{job.variants}\n\n{draft}"
+                )
+                continue
 
-def extract_link(text: str) -> str | None:
-    """Достаём первую ссылку из текста, если есть."""
-    for part in text.split():
-        if part.startswith("http://") or part.startswith("https://"):
-            return part
-    return None
+            await bot.send_message(
+                job.chat_id,
+                f"Вариант {i + 1}/{job.variants}\n\n{parsed.display_text()}",
+                reply_markup=pick_draft_keyboard(i),
+            )
 
 
-async def go_to_photo_step(user_id: int, message: Message):
-    """Переход к шагу загрузки фото."""
-    waiting_photo_or_create.add(user_id)
-    user_photo[user_id] = []
+class MemoryJobStore:
+    """Задания в памяти процесса: без БД, рестарт их не переживает."""
 
-    text = (
-        "Теперь можно отправить фото для поста.\n"
-        "Можно прикрепить не более 3 фотографий.\n"
-        "Если фото не нужно — нажмите «Создать пост»."
-    )
-    await message.answer(text, reply_markup=create_post_keyboard())
+    def __init__(self):
+        # (когда можно брать, порядковый номер, задание)
+        self._heap: list[tuple[float, int, PostJob]] = []
+        self._ids = itertools.count(1)
 
+    def _push(self, job: PostJob, delay: float = 0.0):
+        heapq.heappush(self._heap, (time.monotonic() + delay, job.id, job))
 
-# ===================== ЛОГИРОВАНИЕ В БД =====================
+    async def add(self, job: PostJob):
+        job.id = next(self._ids)
+        self._push(job)
 
+    async def claim(self) -> PostJob | None:
+        if not self._heap or self._heap[0][0] > time.monotonic():
+            return None
+        job = heapq.heappop(self._heap)[2]
+        job.attempts += 1
+        return job
 
-async def log_post_event(
-    tg_user_id: int,
-    tg_username: str | None,
-    infopovod: str | None,
-    topic: str | None,
-    link: str | None,
-    release_type: str | None,
-    photos_count: int,
-    model: str,
-    raw_output: str,
-):
-    db_url = os.getenv("DATABASE_URL")
-    if not db_url:
-        return
+    async def complete(self, job: PostJob, error: str | None = None):
+        pass
 
-    def _insert():
-        with psycopg.connect(db_url) as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    INSERT INTO myasnik_posts (
-                        created_at,
-                        tg_user_id,
-                        tg_username,
-                        infopovod,
-                        topic,
-                        link,
-                        release_type,
-                        photos_count,
-                        model,
-                        raw_output
-                    )
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                    """,
-                    (
-                        datetime.now(timezone.utc),
-                        tg_user_id,
-                        tg_username,
-                        infopovod,
-                        topic,
-                        link,
-                        release_type,
-                        photos_count,
-                        model,
-                        raw_output,
-                    ),
-                )
-                conn.commit()
+    async def retry(self, job: PostJob, delay: float, error: str):
+        self._push(job, delay)
 
-    await asyncio.to_thread(_insert)
+    async def release(self, job: PostJob):
+        job.attempts -= 1
+        self._push(job)
 
+    async def pending(self) -> int:
+        return len(self._heap)
 
-# ===================== ВЫЗОВ МОДЕЛИ =========================
+    async def queued(self) -> int:
+        # Взятые задания из кучи уже вынуты, в ней только ждущие
+        return len(self._heap)
 
 
-async def generate_post_with_writer(
-    infopovod: str | None,
-    topic: str | None,
-    link: str | None,
-    release_type: str | None,
-    photos_count: int,
-) -> str:
+class PostgresJobStore:
     """
-    Генерирует пост через OpenAI Responses API (модель gpt-5.1).
-    Используем system+user в input и стараемся максимально надёжно
-    вытащить текст из ответа.
+    Задания в таблице myasnik_jobs: переживают рестарты, а воркеры
+    в любом числе процессов разбирают их через FOR UPDATE SKIP LOCKED.
+    Взятое задание арендуется на JOB_LEASE; аренда упавшего воркера
+    истекает, и задание достаётся следующему.
     """
 
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        return (
-            "Не удалось сгенерировать пост: отсутствует API-ключ OpenAI.\n"
-            "Проверь переменную OPENAI_API_KEY в Railway."
+    def __init__(self, pool: AsyncConnectionPool):
+        self.pool = pool
+
+    async def add(self, job: PostJob):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(
+                "INSERT INTO myasnik_jobs (chat_id, tg_user_id, tg_username, payload) "
+                "VALUES (%s, %s, %s, %s) RETURNING id",
+                (job.chat_id, job.user_id, job.username, Jsonb(job.payload())),
+            )
+            job.id = (await cur.fetchone())[0]
+
+    async def claim(self) -> PostJob | None:
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(
+                """
+                UPDATE myasnik_jobs SET
+                    status = 'running',
+                    attempts = attempts + 1,
+                    locked_until = now() + %s
+                WHERE id = (
+                    SELECT id FROM myasnik_jobs
+                    WHERE (status = 'queued' AND run_at <= now())
+                       OR (status = 'running' AND locked_until <= now())
+                    ORDER BY run_at
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, chat_id, tg_user_id, tg_username, payload, attempts
+                """,
+                (timedelta(seconds=JOB_LEASE),),
+            )
+            row = await cur.fetchone()
+        if row is None:
+            return None
+        job_id, chat_id, user_id, username, payload, attempts = row
+        return PostJob(
+            chat_id=chat_id,
+            user_id=user_id,
+            username=username,
+            id=job_id,
+            attempts=attempts,
+            **payload,
         )
 
-    infopovod_str = infopovod or "нет"
-    topic_str = topic or "нет"
-    link_str = link or "нет"
-    release_type_str = release_type or "нет"
-    photos_flag = "есть" if photos_count > 0 else "нет"
+    async def complete(self, job: PostJob, error: str | None = None):
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                "UPDATE myasnik_jobs SET status = %s, last_error = %s, "
+                "locked_until = NULL, finished_at = now() WHERE id = %s",
+                ("failed" if error else "done", error, job.id),
+            )
 
-    user_prompt = (
-        f"ИНФОПОВОД: {infopovod_str}\n"
-        f"ТЕМА: {topic_str}\n"
-        f"ССЫЛКА: {link_str}\n"
-        f"ТИП РЕЛИЗА: {release_type_str}\n"
-        f"ФОТО: {photos_flag} (количество: {photos_count})\n\n"
-        "Сгенерируй пост строго по инструкциям из SYSTEM-промпта.\n"
-        "Соблюдай формат OUTPUT FORMAT."
-    )
+    async def retry(self, job: PostJob, delay: float, error: str):
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                "UPDATE myasnik_jobs SET status = 'queued', last_error = %s, "
+                "locked_until = NULL, run_at = now() + %s WHERE id = %s",
+                (error, timedelta(seconds=delay), job.id),
+            )
 
-    try:
-        loop = asyncio.get_running_loop()
+    async def release(self, job: PostJob):
+        # Остановка процесса — не попытка: возвращаем задание как было
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                "UPDATE myasnik_jobs SET status = 'queued', "
+                "attempts = attempts - 1, locked_until = NULL "
+                "WHERE id = %s AND status = 'running'",
+                (job.id,),
+            )
 
-        # ВАЖНО: system-промпт передаём как отдельное сообщение
-        response = await loop.run_in_executor(
-            None,
-            lambda: openai_client.responses.create(
-                model=MODEL_NAME,
-                input=[
-                    {"role": "system", "content": WRITER_SYSTEM_PROMPT},
-                    {"role": "user", "content": user_prompt},
-                ],
-                max_output_tokens=400,
-            ),
-        )
+    async def pending(self) -> int:
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(
+                "SELECT count(*) FROM myasnik_jobs "
+                "WHERE status IN ('queued', 'running')"
+            )
+            return (await cur.fetchone())[0]
 
-        # --- Пытаемся вытащить текст максимально надёжно ---
+    async def queued(self) -> int:
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(
+                "SELECT count(*) FROM myasnik_jobs WHERE status = 'queued'"
+            )
+            return (await cur.fetchone())[0]
 
-        text = ""
 
-        # 1) output_text (если SDK это заполняет)
-        ot = getattr(response, "output_text", None)
-        if isinstance(ot, str):
-            text = ot.strip()
-        elif ot is not None:
-            t_candidate = getattr(ot, "text", None) or getattr(ot, "value", None)
-            if isinstance(t_candidate, str):
-                text = t_candidate.strip()
+class JobQueue:
+    """
+    Фоновые задания генерации. Хэндлер только ставит задание и сразу
+    освобождается; воркеры забирают задания из хранилища, пишут пост
+    и доставляют его через bot. Временные ошибки OpenAI повторяются
+    с экспоненциальной паузой, последняя попытка отдаёт ошибку как есть.
+    Ждущих заданий не больше max_size: очередь здесь, а не в
+    GenerationQueue, поэтому и позицию в ней сообщает она.
+    """
 
-        # 2) Разбор response.output[*].content[*]
-        if not text:
-            out_list = getattr(response, "output", None)
-            if out_list:
-                parts: list[str] = []
-                for out_item in out_list:
-                    content_list = getattr(out_item, "content", None)
-                    if not content_list:
-                        continue
-                    for c in content_list:
-                        t_candidate = getattr(c, "text", None) or getattr(
-                            c, "value", None
-                        )
-                        if isinstance(t_candidate, str):
-                            parts.append(t_candidate)
-                if parts:
-                    text = "\n".join(parts).strip()
+    def __init__(
+        self, store: MemoryJobStore | PostgresJobStore, max_size: int
+    ):
+        self.store = store
+        self.max_size = max_size
+        self.workers = 0
+        self.busy = 0
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    async def enqueue(self, job: PostJob):
+        await self.store.add(job)
+        JOBS.labels("queued").inc()
+        # Воркеры этого процесса берут задание сразу, не дожидаясь опроса
+        self._wakeup.set()
+
+    async def position(self) -> int | None:
+        """
+        Позиция новой заявки: 0 — свободный воркер возьмёт её сразу,
+        None — очередь полна. Без своих воркеров (отдельный процесс
+        worker) свободных не видно, и позиция сообщается всегда.
+        """
+        waiting = await self.store.queued()
+        if waiting >= self.max_size:
+            return None
+        if self.busy + waiting < self.workers:
+            return 0
+        return waiting + 1
+
+    def start(self, bot: Bot, workers: int):
+        self.workers = workers
+        # Спан задания берётся из его trace_context, а не от запустившего
+        self._tasks = [
+            asyncio.create_task(self._worker(bot), context=Context())
+            for _ in range(workers)
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.workers = 0
+
+    async def join(self):
+        """Ждёт, пока не останется ни ожидающих, ни выполняемых заданий."""
+        while self.busy or await self.store.pending():
+            await asyncio.sleep(0.05)
+
+    async def _worker(self, bot: Bot):
+        while True:
+            try:
+                job = await self.store.claim()
+            except Exception as e:
+                print(f"[Jobs error] не удалось взять задание: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.busy += 1
+            try:
+                await self._handle(bot, job)
+            except Exception as e:
+                print(f"[Jobs error] задание {job.id}: {e}")
+            finally:
+                self.busy -= 1
+
+    async def _handle(self, bot: Bot, job: PostJob):
+        refusal = usage_ledger.check_budget(job.user_id)
+        if refusal:
+            JOBS.labels("over_budget").inc()
+            await self.store.complete(job, "budget")
+            await self._notify(bot, job, refusal)
+            return
 
-        if not text:
-            # В лог кидаем весь ответ, чтобы можно было посмотреть структуру
-            print("DEBUG: empty text from responses.create:", response)
-            return (
-                "Не удалось сгенерировать пост: модель не вернула текст.\n"
-                "Попробуй ещё раз — я перепроверю формат."
+        # Последняя попытка не пробрасывает ошибку, а доставляет её текст
+        retry_transient = job.attempts < JOB_MAX_ATTEMPTS
+        try:
+            with tracer.start_as_current_span(
+                "job.generate_post",
+                context=propagate.extract(job.trace_context),
+                attributes={"job.id": job.id, "job.attempt": job.attempts},
+            ):
+                if job.variants > 1:
+                    await create_and_send_drafts(bot, job, retry_transient)
+                else:
+                    await create_and_send_post(bot, job, retry_transient)
+        except asyncio.CancelledError:
+            await self.store.release(job)
+            raise
+        except TRANSIENT_OPENAI_ERRORS as e:
+            delay = min(
+                JOB_RETRY_MAX_DELAY, JOB_RETRY_BASE_DELAY * 2 ** (job.attempts - 1)
+            )
+            # Разброс, чтобы отложенные задания не вернулись одной волной
+            delay *= random.uniform(0.5, 1.0)
+            JOBS.labels("retried").inc()
+            print(f"[Jobs] задание {job.id}: {e} — повтор через {delay:.0f}s")
+            await self.store.retry(job, delay, str(e))
+            await self._notify(
+                bot,
+                job,
+                "OpenAI сейчас не отвечает, повторю попытку "
+                f"через {delay:.0f} с…",
             )
+        except Exception as e:
+            JOBS.labels("failed").inc()
+            await self.store.complete(job, str(e))
+            await self._notify(
+                bot,
+                job,
+                f"{GENERATION_ERROR_PREFIX}: техническая ошибка ({e}).\n"
+                "Попробуй ещё раз через /start.",
+            )
+        else:
+            JOBS.labels("done").inc()
+            await self.store.complete(job)
+
+    @staticmethod
+    async def _notify(bot: Bot, job: PostJob, text: str):
+        await StreamingEditor(bot, job.chat_id, job.placeholder_id).finish(text)
+
+
+job_queue = JobQueue(MemoryJobStore(), JOB_QUEUE_SIZE)
 
-        return text
 
+def build_job_store() -> MemoryJobStore | PostgresJobStore:
+    if post_log_writer.pool is None:
+        return MemoryJobStore()
+    return PostgresJobStore(post_log_writer.pool)
+
+
+async def submit_post_job(
+    message: Message,
+    user: User,
+    post_request: dict,
+    regenerate: bool = False,
+):
+    """Ставит заявку на генерацию и отвечает заглушкой, не дожидаясь модели."""
+    try:
+        position = await job_queue.position()
     except Exception as e:
-        err = str(e)
-        print(f"[OpenAI error] {err}")
-        return (
-            "Не удалось сгенерировать пост: "
-            f"техническая ошибка OpenAI ({err}).\n"
-            "Попробуй ещё раз или пришли скрин ошибки."
+        print(f"[Jobs error] не удалось узнать очередь заданий: {e}")
+        position = 0
+    if position is None:
+        JOBS.labels("rejected").inc()
+        await message.answer(JOB_QUEUE_FULL_TEXT, reply_markup=ReplyKeyboardRemove())
+        return
+
+    placeholder = await message.answer(
+        queued_notice(position) if position else JOB_ACCEPTED_TEXT,
+        reply_markup=ReplyKeyboardRemove(),
+    )
+    try:
+        await job_queue.enqueue(
+            PostJob(
+                chat_id=message.chat.id,
+                user_id=user.id,
+                username=user.username,
+                post_request=post_request,
+                placeholder_id=placeholder.message_id,
+                regenerate=regenerate,
+                # «Заново» всегда пишет один пост, как и раньше
+                variants=1 if regenerate else POST_VARIANTS,
+            )
+        )
+    except Exception as e:
+        print(f"[Jobs error] не удалось поставить задание: {e}")
+        await placeholder.edit_text(
+            f"{GENERATION_ERROR_PREFIX}: не получилось поставить заявку.\n"
+            "Попробуй ещё раз через пару минут."
         )
 
 
@@ -291,33 +3275,14 @@ async def generate_post_with_writer(
 
 
 @dp.message(CommandStart())
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, state: FSMContext):
     if not is_allowed(message):
         await message.answer("Доступ к этому боту ограничен.")
         return
 
-    user_id = message.from_user.id
-
     # Сброс всех состояний и данных
-    for s in (
-        waiting_infopovod,
-        waiting_topic_choice,
-        waiting_topic_custom,
-        waiting_release_type,
-        waiting_photo_or_create,
-    ):
-        s.discard(user_id)
-
-    for d in (
-        user_infopovod,
-        user_topic,
-        user_link,
-        user_release_type,
-        user_photo,
-    ):
-        d.pop(user_id, None)
-
-    waiting_infopovod.add(user_id)
+    await state.clear()
+    await state.set_state(PostForm.infopovod)
 
     text = (
         "Привет! Давай сделаем новый пост для Константина.\n\n"
@@ -328,72 +3293,207 @@ async def cmd_start(message: Message):
     await message.answer(text, reply_markup=infopovod_keyboard())
 
 
+# ===================== ХЭНДЛЕР /stats =======================
+
+
+def format_rollup(rollup: UsageRollup) -> str:
+    return f"{rollup.generations} постов, ${rollup.cost_usd:.2f}"
+
+
+def format_usage_period(
+    title: str,
+    totals: dict[tuple[int, str], UsageRollup],
+    usernames: dict[int, str | None],
+) -> str:
+    overall = UsageRollup()
+    by_user: dict[int, UsageRollup] = {}
+    by_topic: dict[str, UsageRollup] = {}
+    for (user_id, topic), rollup in totals.items():
+        for bucket in (
+            overall,
+            by_user.setdefault(user_id, UsageRollup()),
+            by_topic.setdefault(topic, UsageRollup()),
+        ):
+            bucket.add(rollup)
+            bucket.generations += rollup.generations
+
+    cached_ratio = (
+        overall.cached_tokens / overall.input_tokens if overall.input_tokens else 0.0
+    )
+    lines = [
+        f"{title}: {format_rollup(overall)}",
+        f"токены: вход {overall.input_tokens} (кэш {cached_ratio:.0%}), "
+        f"выход {overall.output_tokens}, reasoning {overall.reasoning_tokens}",
+    ]
+    for user_id, rollup in sorted(by_user.items(), key=lambda x: -x[1].cost_usd):
+        name = f"@{usernames[user_id]}" if usernames.get(user_id) else user_id
+        lines.append(f"  {name} — {format_rollup(rollup)}")
+    for topic, rollup in sorted(by_topic.items(), key=lambda x: -x[1].cost_usd):
+        lines.append(f"  «{topic}» — {format_rollup(rollup)}")
+    return "\n".join(lines)
+
+
+@dp.message(Command("stats"))
+async def cmd_stats(message: Message):
+    if not is_admin(message):
+        await message.answer("Доступ к этому боту ограничен.")
+        return
+
+    # Отвечаем из суточных сводок, а не сканированием myasnik_posts
+    try:
+        today = await usage_ledger.summary(utc_today())
+        month = await usage_ledger.summary(month_start())
+    except Exception as e:
+        print(f"[DB error] не удалось прочитать сводку расходов: {e}")
+        await message.answer("Не удалось получить статистику, попробуй позже.")
+        return
+
+    budgets = (
+        f"Бюджет на пользователя: ${USER_DAILY_BUDGET_USD:.2f}/день, "
+        f"${USER_MONTHLY_BUDGET_USD:.2f}/месяц (0 — без лимита)"
+    )
+    await message.answer(
+        "\n\n".join(
+            [
+                format_usage_period("Сегодня (UTC)", *today),
+                format_usage_period("С начала месяца", *month),
+                budgets,
+            ]
+        )
+    )
+
+
 # ===================== ХЭНДЛЕР ФОТО ========================
 
 
 @dp.message(F.photo)
-async def handle_photo(message: Message):
+async def handle_photo(message: Message, state: FSMContext):
     if not is_allowed(message):
         await message.answer("Доступ к этому боту ограничен.")
         return
 
-    user_id = message.from_user.id
-
-    if user_id not in waiting_photo_or_create:
+    if await state.get_state() != PostForm.photo_or_create.state:
         return
 
-    photos = user_photo.get(user_id)
-    if photos is None:
-        photos = []
-        user_photo[user_id] = photos
+    photos = (await state.get_data()).get("photos") or []
 
     if len(photos) >= 3:
-        await message.answer(
-            "Можно прикрепить не более 3 фотографий.\n"
-            "Новое фото я не сохраняю.\n"
-            "Когда будете готовы — нажмите «Создать пост».",
-            reply_markup=create_post_keyboard(),
-        )
+        with telegram_outbound(coalesce="photo_step"):
+            await message.answer(
+                "Можно прикрепить не более 3 фотографий.\n"
+                "Новое фото я не сохраняю.\n"
+                "Когда будете готовы — нажмите «Создать пост».",
+                reply_markup=create_post_keyboard(),
+            )
         return
 
-    file_id = message.photo[-1].file_id
-    photos.append(file_id)
+    photo = message.photo[-1]
+    photos.append({"file_id": photo.file_id, "unique_id": photo.file_unique_id})
+    await state.update_data(photos=photos)
+
+    # Качаем и пережимаем фото сразу, не дожидаясь «Создать пост»
+    photo_store.prefetch(message.bot, photo.file_id, photo.file_unique_id)
 
     if len(photos) < 3:
-        await message.answer(
+        text = (
             f"Фото {len(photos)}/3 принято.\n"
             "Если хотите добавить ещё — отправьте новое фото.\n"
-            "Когда будете готовы — нажмите «Создать пост».",
-            reply_markup=create_post_keyboard(),
+            "Когда будете готовы — нажмите «Создать пост»."
         )
     else:
-        await message.answer(
+        text = (
             "Фото 3/3 принято.\n"
             "Лимит достигнут, новые фото я не буду сохранять.\n"
-            "Можете сразу нажать «Создать пост».",
-            reply_markup=create_post_keyboard(),
+            "Можете сразу нажать «Создать пост»."
+        )
+    # Альбом приходит пачкой апдейтов: из неотправленных подтверждений
+    # уходит только последнее, клавиатура у них всё равно одна
+    with telegram_outbound(coalesce="photo_step"):
+        await message.answer(text, reply_markup=create_post_keyboard())
+
+
+# ===================== КНОПКА «ЗАНОВО» ======================
+
+
+@dp.callback_query(F.data == "regenerate")
+async def handle_regenerate(callback: CallbackQuery, state: FSMContext):
+    if not is_allowed(callback):
+        await callback.answer("Доступ к этому боту ограничен.", show_alert=True)
+        return
+
+    data = await state.get_data()
+    post_request = data.get("last_request")
+    if not post_request or callback.message is None:
+        await callback.answer(
+            "Данные поста устарели. Начните заново с /start.", show_alert=True
+        )
+        return
+
+    # Двойное нажатие приходит двумя апдейтами. Изоляция событий
+    # выполняет их по очереди, и второй видит отметку первого
+    message_id = callback.message.message_id
+    if data.get("regenerated_msg_id") == message_id:
+        await callback.answer("Уже пишу новый вариант…")
+        return
+    await state.update_data(regenerated_msg_id=message_id)
+
+    await callback.answer()
+    await submit_post_job(
+        callback.message, callback.from_user, post_request, regenerate=True
+    )
+
+
+@dp.callback_query(F.data.startswith("pick:"))
+async def handle_pick_draft(callback: CallbackQuery, state: FSMContext):
+    if not is_allowed(callback):
+        await callback.answer("Доступ к этому боту ограничен.", show_alert=True)
+        return
+
+    data = await state.get_data()
+    drafts = data.get("drafts")
+    post_request = data.get("last_request")
+    index = int(callback.data.split(":", 1)[1])
+    if not drafts or not post_request or index >= len(drafts):
+        await callback.answer(
+            "Варианты устарели или уже выбраны. Начните заново с /start.",
+            show_alert=True,
         )
+        return
+
+    # Выбрать можно только один раз
+    await state.update_data(drafts=None)
+    await callback.answer(f"Вариант {index + 1} выбран")
+    if callback.message is not None:
+        await callback.message.edit_reply_markup(reply_markup=None)
+
+    await log_post_request(
+        callback.from_user.id,
+        callback.from_user.username,
+        post_request,
+        drafts[index],
+        data.get("drafts_prompt_version"),
+        GenerationUsage(**data["drafts_usage"]) if data.get("drafts_usage") else None,
+    )
 
 
 # ===================== ОБЩИЙ ХЭНДЛЕР ТЕКСТА =================
 
 
 @dp.message()
-async def handle_any_message(message: Message):
+async def handle_any_message(message: Message, state: FSMContext):
     if not is_allowed(message):
         await message.answer("Доступ к этому боту ограничен.")
         return
 
-    user_id = message.from_user.id
     raw = (message.text or "").strip()
     low = raw.lower()
+    current = await state.get_state()
 
     # 1) Инфоповод
-    if user_id in waiting_infopovod:
+    if current == PostForm.infopovod.state:
         if raw == "Без инфоповода" or low == "нет" or raw == "":
-            waiting_infopovod.discard(user_id)
-            waiting_topic_choice.add(user_id)
-            user_infopovod[user_id] = None
+            await state.set_state(PostForm.topic_choice)
+            await state.update_data(infopovod=None)
 
             text = "Инфоповода нет.\nВыберите тему поста или введите свою:"
             await message.answer(text, reply_markup=topic_keyboard())
@@ -401,6 +3501,8 @@ async def handle_any_message(message: Message):
 
         link = extract_link(raw)
         if link:
+            # Метаданные грузятся, пока отвечают про премьеру и шлют фото
+            link_previews.prefetch(link)
             # убираем ссылку из текста инфоповода
             parts = [
                 p
@@ -413,11 +3515,8 @@ async def handle_any_message(message: Message):
             else:
                 infopovod_text = "Продвижение по ссылке"
 
-            user_infopovod[user_id] = infopovod_text
-            user_link[user_id] = link
-
-            waiting_infopovod.discard(user_id)
-            waiting_release_type.add(user_id)
+            await state.update_data(infopovod=infopovod_text, link=link)
+            await state.set_state(PostForm.release_type)
 
             text = (
                 "Принял инфоповод и увидел ссылку.\n\n"
@@ -427,25 +3526,22 @@ async def handle_any_message(message: Message):
             )
             await message.answer(text, reply_markup=release_type_keyboard())
         else:
-            user_infopovod[user_id] = raw
-            user_link[user_id] = None
-            user_release_type[user_id] = None
-            waiting_infopovod.discard(user_id)
+            await state.update_data(infopovod=raw, link=None, release_type=None)
 
             await message.answer(
                 "Принял инфоповод.\n"
                 "Тема не требуется, переходим к фото.",
                 reply_markup=ReplyKeyboardRemove(),
             )
-            await go_to_photo_step(user_id, message)
+            await go_to_photo_step(state, message)
         return
 
     # 2) Тип релиза (если была ссылка)
-    if user_id in waiting_release_type:
+    if current == PostForm.release_type.state:
         if raw == "Да, премьера":
-            user_release_type[user_id] = "премьера"
+            await state.update_data(release_type="премьера")
         elif raw == "Нет, уже вышло":
-            user_release_type[user_id] = "обычный релиз"
+            await state.update_data(release_type="обычный релиз")
         else:
             await message.answer(
                 "Пожалуйста, выбери один из вариантов:",
@@ -453,17 +3549,15 @@ async def handle_any_message(message: Message):
             )
             return
 
-        waiting_release_type.discard(user_id)
-
         await message.answer(
             "Принял тип релиза. Переходим к фото.",
             reply_markup=ReplyKeyboardRemove(),
         )
-        await go_to_photo_step(user_id, message)
+        await go_to_photo_step(state, message)
         return
 
     # 3) Выбор темы (ветка без инфоповода)
-    if user_id in waiting_topic_choice:
+    if current == PostForm.topic_choice.state:
         if raw in [
             "Путь мужчины и сила",
             "Семья и дети",
@@ -471,19 +3565,17 @@ async def handle_any_message(message: Message):
             "Город, дорога и музыка",
         ]:
             topic = raw
-            waiting_topic_choice.discard(user_id)
-            user_topic[user_id] = topic
+            await state.update_data(topic=topic)
 
             await message.answer(
                 f"Принял тему: «{topic}».\nПереходим к фото.",
                 reply_markup=ReplyKeyboardRemove(),
             )
-            await go_to_photo_step(user_id, message)
+            await go_to_photo_step(state, message)
             return
 
         if raw == "Ввести свою тему" or low == "ввести свою тему":
-            waiting_topic_choice.discard(user_id)
-            waiting_topic_custom.add(user_id)
+            await state.set_state(PostForm.topic_custom)
 
             await message.answer(
                 "Введите тему поста одним сообщением.",
@@ -498,66 +3590,34 @@ async def handle_any_message(message: Message):
         return
 
     # 4) Ручной ввод темы
-    if user_id in waiting_topic_custom:
+    if current == PostForm.topic_custom.state:
         topic = raw
-        waiting_topic_custom.discard(user_id)
-        user_topic[user_id] = topic
+        await state.update_data(topic=topic)
 
         await message.answer(
             f"Принял тему: «{topic}».\nПереходим к фото.",
             reply_markup=ReplyKeyboardRemove(),
         )
-        await go_to_photo_step(user_id, message)
+        await go_to_photo_step(state, message)
         return
 
     # 5) Фото / Создать пост
-    if user_id in waiting_photo_or_create:
+    if current == PostForm.photo_or_create.state:
         if raw == "Создать пост":
-            waiting_photo_or_create.discard(user_id)
-
-            infopovod = user_infopovod.get(user_id)
-            topic = user_topic.get(user_id)
-            link = user_link.get(user_id)
-            rtype = user_release_type.get(user_id)
-            photos = user_photo.get(user_id) or []
-            photos_count = len(photos)
-
-            post_output = await generate_post_with_writer(
-                infopovod=infopovod,
-                topic=topic,
-                link=link,
-                release_type=rtype,
-                photos_count=photos_count,
-            )
-
-            await message.answer(post_output, reply_markup=ReplyKeyboardRemove())
-
-            try:
-                await log_post_event(
-                    tg_user_id=user_id,
-                    tg_username=message.from_user.username,
-                    infopovod=infopovod,
-                    topic=topic,
-                    link=link,
-                    release_type=rtype,
-                    photos_count=photos_count,
-                    model=MODEL_NAME,
-                    raw_output=post_output,
-                )
-            except Exception:
-                # Логирование не должно ломать поток
-                pass
-
-            # Чистим данные пользователя
-            for d in (
-                user_infopovod,
-                user_topic,
-                user_link,
-                user_release_type,
-                user_photo,
-            ):
-                d.pop(user_id, None)
-
+            # Забираем данные и сразу чистим сессию пользователя
+            data = await state.get_data()
+            post_request = {
+                "infopovod": data.get("infopovod"),
+                "topic": data.get("topic"),
+                "link": data.get("link"),
+                "release_type": data.get("release_type"),
+                "photos": data.get("photos") or [],
+            }
+            await state.clear()
+            # Запоминаем запрос для кнопки «Сгенерировать заново»
+            await state.update_data(last_request=post_request)
+
+            await submit_post_job(message, message.from_user, post_request)
             return
 
         await message.answer(
@@ -574,16 +3634,266 @@ async def handle_any_message(message: Message):
     )
 
 
+# ===================== WEBHOOK ==============================
+
+
+async def health(request: web.Request) -> web.Response:
+    try:
+        jobs_pending = await job_queue.store.pending()
+    except Exception as e:
+        print(f"[Jobs error] не удалось посчитать задания: {e}")
+        jobs_pending = None
+    return web.json_response(
+        {
+            "status": "ok",
+            "generation_cache": generation_cache.stats(),
+            "models": model_router.stats(),
+            "jobs": {"pending": jobs_pending, "busy": job_queue.busy},
+            "startup": startup_timings,
+        }
+    )
+
+
+def build_service_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics)
+    return app
+
+
+async def serve_app(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, port)
+    await site.start()
+    return runner
+
+
+def build_webhook_app(bot: Bot) -> web.Application:
+    app = build_service_app()
+    # Апдейты без правильного секрета отбрасываются с 401
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(bot: Bot):
+    runner = await serve_app(build_webhook_app(bot), WEBHOOK_PORT)
+
+    # Каждая реплика выставляет один и тот же адрес — это идемпотентно
+    await bot.set_webhook(
+        WEBHOOK_BASE_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    print(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+# ===================== ХОЛОДНЫЙ СТАРТ =======================
+
+# Фазы старта в секундах: в лог, в /health и в myasnik_startup_seconds
+startup_timings: dict[str, float] = {"import": IMPORT_SECONDS}
+
+
+def validate_config() -> list[str]:
+    """Все ошибки настроек, из-за которых бот не сможет работать."""
+    problems = []
+    db_url = os.getenv("DATABASE_URL")
+    if not os.getenv("TELEGRAM_BOT_TOKEN"):
+        problems.append("не задан TELEGRAM_BOT_TOKEN")
+    if prompt_registry.current is None:
+        problems.append(f"не загружен системный промпт из {PROMPT_PATH}")
+    if not os.getenv("OPENAI_API_KEY") and any(
+        route.uses_openai for route in model_router.routes
+    ):
+        problems.append("не задан OPENAI_API_KEY для моделей OpenAI")
+    if BOT_MODE not in ("polling", "webhook", "worker"):
+        problems.append(f"неизвестный BOT_MODE={BOT_MODE}")
+    if BOT_MODE == "webhook" and not (WEBHOOK_BASE_URL and WEBHOOK_SECRET):
+        problems.append("для BOT_MODE=webhook нужны WEBHOOK_BASE_URL и WEBHOOK_SECRET")
+    if FSM_STORAGE not in ("memory", "redis", "postgres"):
+        problems.append(f"неизвестный FSM_STORAGE={FSM_STORAGE}")
+    if FSM_STORAGE == "postgres" and not db_url:
+        problems.append("для FSM_STORAGE=postgres нужен DATABASE_URL")
+    if not db_url and (BOT_MODE == "worker" or not JOB_WORKERS):
+        # Задания в памяти разбирает только этот процесс
+        problems.append("отдельные воркеры и JOB_WORKERS=0 требуют DATABASE_URL")
+    if BOT_MODE == "worker" and FSM_STORAGE == "memory" and POST_VARIANTS > 1:
+        # Черновики воркер кладёт в FSM, которую читает хэндлер выбора
+        problems.append("для BOT_MODE=worker с вариантами нужен общий FSM_STORAGE")
+    return problems
+
+
+def import_deferred():
+    """
+    Тяжёлые модули вне пути старта; грузятся в потоке, пока ждём сеть.
+    Старт не валят: битый индекс архива в работе тоже значит «без примеров».
+    """
+    try:
+        importlib.import_module("PIL.Image")
+        index = get_archive_index()
+        if index.exists():
+            with _archive_lock:
+                index.reload_if_changed()
+    except Exception as e:
+        print(f"[Startup] отложенная загрузка не удалась: {e!r}")
+
+
+async def warm_db(db_url: str):
+    # Миграции, пул и сводка расходов; затем ждём min_size готовых соединений
+    await post_log_writer.start(db_url)
+    await usage_ledger.start(post_log_writer.pool)
+    await post_log_writer.pool.wait(timeout=STARTUP_WARMUP_TIMEOUT)
+
+
+async def warm_telegram(bot: Bot):
+    # Неверный токен валит старт, а сетевой сбой переживёт и сам polling
+    try:
+        await bot.get_me()
+    except TelegramNetworkError as e:
+        print(f"[Startup] прогрев Telegram не удался: {e!r}")
+
+
+async def warm_model(route: ModelRoute):
+    """TLS и DNS к провайдеру модели; сетевой сбой старт не валит, ключ — да."""
+    client = route.client.with_options(timeout=STARTUP_WARMUP_TIMEOUT)
+    try:
+        await client.models.list()
+    except AuthenticationError:
+        raise
+    except Exception as e:
+        print(f"[Startup] прогрев {route.name} не удался: {e!r}")
+
+
+async def warm_up(bot: Bot, db_url: str | None):
+    """
+    Соединения к Telegram, БД и моделям цепочки открываются параллельно
+    до приёма апдейтов, чтобы первый пост после деплоя не платил за них.
+    """
+    steps = {
+        "telegram": warm_telegram(bot),
+        "imports": asyncio.to_thread(import_deferred),
+    }
+    if db_url:
+        steps["db"] = warm_db(db_url)
+    # У маршрутов на одном клиенте общий пул соединений
+    routes = {id(route.client): route for route in model_router.routes}
+    for route in routes.values():
+        steps[f"model:{route.name}"] = warm_model(route)
+
+    async def timed(name: str, step: Awaitable):
+        step_started = time.perf_counter()
+        try:
+            await step
+        finally:
+            startup_timings[name] = time.perf_counter() - step_started
+
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(timed(name, step) for name, step in steps.items()),
+        return_exceptions=True,
+    )
+    startup_timings["warmup"] = time.perf_counter() - started
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+def report_startup(main_seconds: float):
+    startup_timings["total"] = IMPORT_SECONDS + main_seconds
+    for phase, seconds in startup_timings.items():
+        STARTUP_SECONDS.labels(phase).set(seconds)
+    steps = ", ".join(
+        f"{phase} {seconds:.2f}s"
+        for phase, seconds in startup_timings.items()
+        if phase not in ("import", "config", "warmup", "total")
+    )
+    print(
+        f"[Startup] импорт {IMPORT_SECONDS:.2f}s, "
+        f"проверка {startup_timings['config']:.2f}s, "
+        f"прогрев {startup_timings['warmup']:.2f}s ({steps}), "
+        f"всего {startup_timings['total']:.2f}s"
+    )
+
+
 # ===================== ТОЧКА ВХОДА ==========================
 
 
 async def main():
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    if not token:
-        raise RuntimeError("Нужно задать TELEGRAM_BOT_TOKEN в переменных окружения")
-
-    bot = Bot(token=token)
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    started = time.perf_counter()
+    problems = validate_config()
+    if problems:
+        # Все ошибки разом, до первого сетевого запроса
+        raise RuntimeError("Ошибки конфигурации:\n- " + "\n- ".join(problems))
+    startup_timings["config"] = time.perf_counter() - started
+
+    bot = Bot(token=os.getenv("TELEGRAM_BOT_TOKEN"))
+    bot.session.middleware(outbound_limiter)
+    try:
+        await warm_up(bot, os.getenv("DATABASE_URL"))
+    except BaseException:
+        await bot.session.close()
+        await usage_ledger.stop()
+        await post_log_writer.stop()
+        await model_router.close()
+        raise
+
+    storage = await build_fsm_storage()
+    dp.fsm.storage = storage
+    job_queue.store = build_job_store()
+
+    background = [
+        asyncio.create_task(loop_lag_monitor()),
+        asyncio.create_task(prompt_registry.watch()),
+    ]
+    if post_log_writer.pool is not None:
+        background.append(
+            asyncio.create_task(db_maintenance_loop(post_log_writer.pool))
+        )
+    if hasattr(storage, "purge_expired"):
+        background.append(asyncio.create_task(purge_fsm_loop(storage)))
+    if hasattr(storage, "count_states"):
+        background.append(asyncio.create_task(fsm_sessions_monitor(storage)))
+
+    generation_queue.start()
+    job_queue.start(bot, JOB_WORKERS)
+    metrics_runner = None
+    report_startup(time.perf_counter() - started)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot)
+        elif BOT_MODE == "worker":
+            if METRICS_PORT:
+                metrics_runner = await serve_app(build_service_app(), METRICS_PORT)
+            print(f"Воркер заданий запущен: {JOB_WORKERS} воркеров")
+            await asyncio.Event().wait()
+        else:
+            if METRICS_PORT:
+                metrics_runner = await serve_app(build_service_app(), METRICS_PORT)
+            await dp.start_polling(
+                bot, allowed_updates=dp.resolve_used_update_types()
+            )
+    finally:
+        for task in background:
+            task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await job_queue.stop()
+        await storage.close()
+        await generation_queue.stop()
+        await usage_ledger.stop()
+        await post_log_writer.stop()
+        await model_router.close()
+        await link_previews.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,337 @@
+"""
+Управляемые миграции схемы Postgres для бота.
+
+Каждая миграция применяется один раз и записывается в
+myasnik_schema_migrations; параллельные реплики ждут друг друга
+на advisory-локе. Бот прогоняет миграции при старте, вручную:
+    python migrations.py
+    python migrations.py --status
+
+POSTS_PARTITIONING=month при создании новой таблицы myasnik_posts
+делает её секционированной по месяцам created_at. Существующую
+таблицу миграции не переделывают — это ручная операция.
+"""
+
+import os
+import sys
+import asyncio
+import argparse
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+from typing import Awaitable, Callable
+
+from psycopg import AsyncConnection
+
+# Секционирование новой таблицы myasnik_posts: "" — нет, month — по месяцам
+POSTS_PARTITIONING = os.getenv("POSTS_PARTITIONING", "").lower()
+# На сколько месяцев вперёд держать готовые секции
+POSTS_PARTITIONS_AHEAD = int(os.getenv("POSTS_PARTITIONS_AHEAD", "3"))
+
+# Ключ advisory-лока: одна реплика мигрирует, остальные ждут
+MIGRATIONS_LOCK_KEY = 0x6D79_6173
+# Как часто ждущая реплика снова пробует взять лок, секунды
+MIGRATIONS_LOCK_POLL = float(os.getenv("MIGRATIONS_LOCK_POLL", "1.0"))
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable[[AsyncConnection], Awaitable[None]]
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    transactional: bool = True
+
+
+async def is_partitioned(conn: AsyncConnection, table: str) -> bool:
+    cur = await conn.execute(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (table,)
+    )
+    row = await cur.fetchone()
+    return bool(row and row[0])
+
+
+async def create_posts_table(conn: AsyncConnection):
+    # Исходные колонки; всё, что добавлялось позже, — в следующей миграции
+    partition = (
+        "PARTITION BY RANGE (created_at)" if POSTS_PARTITIONING == "month" else ""
+    )
+    await conn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS myasnik_posts (
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            tg_user_id BIGINT NOT NULL,
+            tg_username TEXT,
+            infopovod TEXT,
+            topic TEXT,
+            link TEXT,
+            release_type TEXT,
+            photos_count SMALLINT NOT NULL DEFAULT 0,
+            model TEXT NOT NULL,
+            raw_output TEXT NOT NULL
+        ) {partition}
+        """
+    )
+    if await is_partitioned(conn, "myasnik_posts"):
+        # Строки вне заготовленных месяцев не теряются, а ждут здесь
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS myasnik_posts_default "
+            "PARTITION OF myasnik_posts DEFAULT"
+        )
+
+
+async def add_posts_columns(conn: AsyncConnection):
+    # Колонки, которые раньше бот добавлял сам через ADD COLUMN IF NOT EXISTS
+    columns = (
+        ("post_text", "TEXT"),
+        ("hashtags", "TEXT"),
+        ("post_length", "INTEGER"),
+        ("prompt_version", "TEXT"),
+        ("api_calls", "INTEGER"),
+        ("input_tokens", "INTEGER"),
+        ("cached_tokens", "INTEGER"),
+        ("output_tokens", "INTEGER"),
+        ("reasoning_tokens", "INTEGER"),
+        ("generation_seconds", "DOUBLE PRECISION"),
+        ("cost_usd", "DOUBLE PRECISION"),
+    )
+    for name, column_type in columns:
+        await conn.execute(
+            f"ALTER TABLE myasnik_posts ADD COLUMN IF NOT EXISTS {name} {column_type}"
+        )
+
+
+async def create_posts_indexes(conn: AsyncConnection):
+    # На секционированной таблице индекс строится по секциям сам,
+    # на обычной — без блокировки записи
+    concurrently = (
+        "" if await is_partitioned(conn, "myasnik_posts") else "CONCURRENTLY"
+    )
+    statements = (
+        "myasnik_posts_user_created_idx ON myasnik_posts (tg_user_id, created_at)",
+        "myasnik_posts_topic_idx ON myasnik_posts (topic)",
+        "myasnik_posts_release_type_idx ON myasnik_posts (release_type)",
+        # Таблица только дописывается по времени: BRIN крошечный и
+        # отсекает всё вне диапазона дат у отчётов по периоду
+        "myasnik_posts_created_brin ON myasnik_posts USING brin (created_at)",
+    )
+    names = [statement.split()[0] for statement in statements]
+    # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс,
+    # который IF NOT EXISTS молча пропустил бы: удаляем и строим заново
+    for name in await invalid_indexes(conn, names):
+        await conn.execute(f"DROP INDEX {concurrently} IF EXISTS {name}")
+    for statement in statements:
+        await conn.execute(f"CREATE INDEX {concurrently} IF NOT EXISTS {statement}")
+    invalid = await invalid_indexes(conn, names)
+    if invalid:
+        raise RuntimeError(f"индексы построены с ошибкой: {', '.join(invalid)}")
+
+
+async def invalid_indexes(conn: AsyncConnection, names: list[str]) -> list[str]:
+    cur = await conn.execute(
+        "SELECT indexrelid::regclass::text FROM pg_index "
+        "WHERE indexrelid IN (SELECT to_regclass(name) FROM unnest(%s::text[]) name) "
+        "AND NOT indisvalid",
+        (names,),
+    )
+    return [row[0] for row in await cur.fetchall()]
+
+
+async def create_service_tables(conn: AsyncConnection):
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS myasnik_fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}',
+            expires_at TIMESTAMPTZ NOT NULL
+        )
+        """
+    )
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS myasnik_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            tg_user_id BIGINT NOT NULL,
+            tg_username TEXT,
+            payload JSONB NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            locked_until TIMESTAMPTZ,
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        )
+        """
+    )
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS myasnik_jobs_pending_idx "
+        "ON myasnik_jobs (run_at) WHERE status IN ('queued', 'running')"
+    )
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS myasnik_usage_daily (
+            day DATE NOT NULL,
+            tg_user_id BIGINT NOT NULL,
+            topic TEXT NOT NULL,
+            tg_username TEXT,
+            generations INTEGER NOT NULL DEFAULT 0,
+            api_calls INTEGER NOT NULL DEFAULT 0,
+            input_tokens BIGINT NOT NULL DEFAULT 0,
+            cached_tokens BIGINT NOT NULL DEFAULT 0,
+            output_tokens BIGINT NOT NULL DEFAULT 0,
+            reasoning_tokens BIGINT NOT NULL DEFAULT 0,
+            generation_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+            cost_usd DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, tg_user_id, topic)
+        )
+        """
+    )
+
+
+async def create_weekly_rollup(conn: AsyncConnection):
+    # Недельные сводки для отчётов, пересчитываются reports.refresh_rollups
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS myasnik_posts_weekly (
+            week DATE NOT NULL,
+            tg_user_id BIGINT NOT NULL,
+            topic TEXT NOT NULL,
+            release_type TEXT NOT NULL,
+            tg_username TEXT,
+            posts INTEGER NOT NULL,
+            failed_posts INTEGER NOT NULL,
+            parsed_posts INTEGER NOT NULL,
+            total_length BIGINT NOT NULL,
+            cost_usd DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (week, tg_user_id, topic, release_type)
+        )
+        """
+    )
+
+
+MIGRATIONS = (
+    Migration(1, "myasnik_posts", create_posts_table),
+    Migration(2, "myasnik_posts: разобранный ответ и расходы", add_posts_columns),
+    Migration(
+        3, "myasnik_posts: индексы", create_posts_indexes, transactional=False
+    ),
+    Migration(4, "FSM, задания и суточные расходы", create_service_tables),
+    Migration(5, "недельные сводки постов", create_weekly_rollup),
+)
+
+
+async def applied_versions(conn: AsyncConnection) -> set[int]:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS myasnik_schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """
+    )
+    cur = await conn.execute("SELECT version FROM myasnik_schema_migrations")
+    return {row[0] for row in await cur.fetchall()}
+
+
+async def migrate(db_url: str) -> list[Migration]:
+    """Применяет недостающие миграции; возвращает применённые сейчас."""
+    applied: list[Migration] = []
+    async with await AsyncConnection.connect(db_url, autocommit=True) as conn:
+        await acquire_lock(conn)
+        try:
+            done = await applied_versions(conn)
+            for migration in MIGRATIONS:
+                if migration.version in done:
+                    continue
+                print(f"[Migrations] {migration.version}: {migration.name}")
+                if migration.transactional:
+                    async with conn.transaction():
+                        await migration.apply(conn)
+                        await mark_applied(conn, migration)
+                else:
+                    # Шаги с IF NOT EXISTS, упавшую миграцию можно повторить;
+                    # в журнал она попадает, только если дошла до конца
+                    await migration.apply(conn)
+                    await mark_applied(conn, migration)
+                applied.append(migration)
+            await ensure_post_partitions(conn)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_KEY,))
+    return applied
+
+
+async def acquire_lock(conn: AsyncConnection):
+    """
+    Берёт лок миграций, опрашивая pg_try_advisory_lock. Заблокированный
+    pg_advisory_lock держал бы снимок, а CREATE INDEX CONCURRENTLY у
+    реплики с локом ждёт все снимки — и обе ждали бы друг друга вечно.
+    """
+    waiting = False
+    while True:
+        cur = await conn.execute(
+            "SELECT pg_try_advisory_lock(%s)", (MIGRATIONS_LOCK_KEY,)
+        )
+        if (await cur.fetchone())[0]:
+            return
+        if not waiting:
+            print("[Migrations] миграции выполняет другая реплика, ждём")
+            waiting = True
+        await asyncio.sleep(MIGRATIONS_LOCK_POLL)
+
+
+async def mark_applied(conn: AsyncConnection, migration: Migration):
+    await conn.execute(
+        "INSERT INTO myasnik_schema_migrations (version, name) VALUES (%s, %s)",
+        (migration.version, migration.name),
+    )
+
+
+def add_months(day: date, months: int) -> date:
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+async def ensure_post_partitions(conn: AsyncConnection):
+    """Заготавливает месячные секции myasnik_posts на POSTS_PARTITIONS_AHEAD."""
+    if not await is_partitioned(conn, "myasnik_posts"):
+        return
+    month = datetime.now(timezone.utc).date().replace(day=1)
+    for offset in range(POSTS_PARTITIONS_AHEAD + 1):
+        start = add_months(month, offset)
+        end = add_months(month, offset + 1)
+        await conn.execute(
+            f"CREATE TABLE IF NOT EXISTS myasnik_posts_{start:%Y_%m} "
+            "PARTITION OF myasnik_posts "
+            f"FOR VALUES FROM ('{start}') TO ('{end}')"
+        )
+
+
+async def print_status(db_url: str):
+    async with await AsyncConnection.connect(db_url, autocommit=True) as conn:
+        done = await applied_versions(conn)
+    for migration in MIGRATIONS:
+        mark = "x" if migration.version in done else " "
+        print(f"[{mark}] {migration.version}: {migration.name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграции схемы бота")
+    parser.add_argument("--status", action="store_true", help="только показать")
+    args = parser.parse_args()
+
+    db_url = os.getenv("DATABASE_URL")
+    if not db_url:
+        sys.exit("Нужно задать DATABASE_URL")
+
+    if args.status:
+        asyncio.run(print_status(db_url))
+        return
+    applied = asyncio.run(migrate(db_url))
+    print(f"Применено миграций: {len(applied)}")
+
+
+if __name__ == "__main__":
+    main()
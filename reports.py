@@ -0,0 +1,185 @@
+"""
+Отчёты по myasnik_posts поверх недельных сводок и индексов.
+
+Счётчики (темы, пользователи, недели, средняя длина) читаются из
+myasnik_posts_weekly, которую refresh_rollups дописывает инкрементально:
+пересчитываются только последние недели. Перцентили задержки считаются
+по самой myasnik_posts, но только в окне дат — его отсекают BRIN-индекс
+и секции, так что стоимость не растёт вместе с таблицей.
+
+    python reports.py refresh
+    python reports.py topics --weeks 4
+    python reports.py users --weeks 4
+    python reports.py weekly --weeks 12
+    python reports.py latency --days 7
+"""
+
+import os
+import sys
+import asyncio
+import argparse
+from datetime import date, datetime, timedelta, timezone
+
+from psycopg import AsyncConnection
+
+# Так начинаются ответы-ошибки генерации (см. GENERATION_ERROR_PREFIX в main)
+FAILED_OUTPUT_PATTERN = "Не удалось сгенерировать пост%"
+# Пересчёт сводок сериализуется между репликами этим advisory-локом
+ROLLUP_LOCK_KEY = 0x6D79_7277
+
+
+def week_start(day: date) -> date:
+    return day - timedelta(days=day.weekday())
+
+
+def weeks_ago(weeks: int) -> date:
+    return week_start(datetime.now(timezone.utc).date()) - timedelta(weeks=weeks - 1)
+
+
+async def refresh_rollups(conn: AsyncConnection) -> date | None:
+    """
+    Пересчитывает myasnik_posts_weekly с предпоследней известной недели
+    (строки могли дописаться на стыке недель); пустая сводка — полная
+    пересборка. Возвращает, с какой недели пересчитано.
+    """
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock(%s)", (ROLLUP_LOCK_KEY,))
+        cur = await conn.execute("SELECT max(week) FROM myasnik_posts_weekly")
+        last = (await cur.fetchone())[0]
+        since = last - timedelta(weeks=1) if last else None
+        if since is not None:
+            await conn.execute(
+                "DELETE FROM myasnik_posts_weekly WHERE week >= %s", (since,)
+            )
+        await conn.execute(
+            """
+            INSERT INTO myasnik_posts_weekly (
+                week, tg_user_id, topic, release_type, tg_username,
+                posts, failed_posts, parsed_posts, total_length, cost_usd
+            )
+            SELECT
+                date_trunc('week', created_at AT TIME ZONE 'UTC')::date,
+                tg_user_id,
+                coalesce(topic, ''),
+                coalesce(release_type, ''),
+                max(tg_username),
+                count(*),
+                count(*) FILTER (WHERE raw_output LIKE %(failed)s),
+                count(post_length),
+                coalesce(sum(post_length), 0),
+                coalesce(sum(cost_usd), 0)
+            FROM myasnik_posts
+            WHERE %(since)s::date IS NULL
+               OR created_at >= (%(since)s::date)::timestamp AT TIME ZONE 'UTC'
+            GROUP BY 1, 2, 3, 4
+            """,
+            {"since": since, "failed": FAILED_OUTPUT_PATTERN},
+        )
+    return since
+
+
+async def posts_by(conn: AsyncConnection, column: str, since: date) -> list[tuple]:
+    """(ключ, постов, ошибок, средняя длина, $) по колонке сводки с недели since."""
+    order = "1" if column == "week" else "2 DESC"
+    cur = await conn.execute(
+        f"""
+        SELECT {column}, sum(posts), sum(failed_posts),
+               sum(total_length) / nullif(sum(parsed_posts), 0),
+               sum(cost_usd)
+        FROM myasnik_posts_weekly
+        WHERE week >= %s
+        GROUP BY {column}
+        ORDER BY {order}
+        """,
+        (since,),
+    )
+    return await cur.fetchall()
+
+
+async def posts_by_topic(conn: AsyncConnection, since: date) -> list[tuple]:
+    return await posts_by(conn, "topic", since)
+
+
+async def posts_by_user(conn: AsyncConnection, since: date) -> list[tuple]:
+    return await posts_by(conn, "coalesce(tg_username, tg_user_id::text)", since)
+
+
+async def posts_by_week(conn: AsyncConnection, since: date) -> list[tuple]:
+    return await posts_by(conn, "week", since)
+
+
+async def latency_percentiles(conn: AsyncConnection, since: datetime) -> tuple:
+    """(генераций, p50, p95, p99, max) по generation_seconds с момента since."""
+    cur = await conn.execute(
+        """
+        SELECT count(*),
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY generation_seconds),
+               percentile_cont(0.95) WITHIN GROUP (ORDER BY generation_seconds),
+               percentile_cont(0.99) WITHIN GROUP (ORDER BY generation_seconds),
+               max(generation_seconds)
+        FROM myasnik_posts
+        WHERE created_at >= %s AND api_calls > 0
+        """,
+        (since,),
+    )
+    return await cur.fetchone()
+
+
+def print_counts(title: str, rows: list[tuple]):
+    print(f"{title:<28} {'постов':>7} {'ошибок':>7} {'ср.длина':>9} {'$':>9}")
+    for key, posts, failed, avg_length, cost in rows:
+        avg = f"{avg_length:.0f}" if avg_length is not None else "—"
+        print(f"{str(key or '—'):<28} {posts:>7} {failed:>7} {avg:>9} {cost:>9.2f}")
+
+
+async def run(args) -> None:
+    async with await AsyncConnection.connect(args.db_url) as conn:
+        if args.command == "refresh":
+            since = await refresh_rollups(conn)
+            print(f"Сводки пересчитаны с {since or 'начала'}")
+            return
+        if args.command == "latency":
+            since = datetime.now(timezone.utc) - timedelta(days=args.days)
+            count, p50, p95, p99, worst = await latency_percentiles(conn, since)
+            if not count:
+                print("Генераций за период нет")
+                return
+            print(
+                f"генераций={count} p50={p50:.2f}s p95={p95:.2f}s "
+                f"p99={p99:.2f}s max={worst:.2f}s"
+            )
+            return
+
+        since = weeks_ago(args.weeks)
+        report = {
+            "topics": ("тема", posts_by_topic),
+            "users": ("пользователь", posts_by_user),
+            "weekly": ("неделя", posts_by_week),
+        }
+        title, query = report[args.command]
+        print_counts(title, await query(conn, since))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Отчёты по постам")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("refresh", help="дописать недельные сводки")
+    for name, help_text in (
+        ("topics", "постов по темам"),
+        ("users", "постов по пользователям"),
+        ("weekly", "постов по неделям"),
+    ):
+        report = sub.add_parser(name, help=help_text)
+        report.add_argument("--weeks", type=int, default=4)
+    latency = sub.add_parser("latency", help="перцентили времени генерации")
+    latency.add_argument("--days", type=int, default=7)
+    args = parser.parse_args()
+
+    args.db_url = os.getenv("DATABASE_URL")
+    if not args.db_url:
+        sys.exit("Нужно задать DATABASE_URL")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+Общие заглушки для тестов: окружение без внешних сервисов, сессия
+Bot API без сети и клиент OpenAI, который только считает вызовы.
+"""
+
+import os
+import sys
+import json
+import time
+import itertools
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+
+# Конфиг main.py читается при импорте: задаём его до первого import main
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ["FSM_STORAGE"] = "memory"
+os.environ.pop("DATABASE_URL", None)
+os.environ.pop("MODEL_ROUTES", None)
+os.environ.pop("OTEL_EXPORTER_OTLP_ENDPOINT", None)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.fsm.storage.memory import (  # noqa: E402
+    MemoryStorage,
+    SimpleEventIsolation,
+)
+from aiogram.methods import TelegramMethod  # noqa: E402
+from aiogram.types import Message  # noqa: E402
+from openai.types.responses import Response  # noqa: E402
+
+import main  # noqa: E402
+
+POST_REQUEST = {
+    "infopovod": "Без инфоповода",
+    "topic": "Семья и дети",
+    "link": None,
+    "release_type": None,
+    "photos": [],
+}
+
+FAKE_POST = (
+    "TOPIC: Семья и дети\n\n"
+    "POST_TEXT:\n"
+    "Вчера вечером сидели с сыном на кухне, пили чай и молчали о важном. "
+    "Знаете, иногда тишина говорит громче любых слов. Я понял одно — "
+    "время с детьми не возвращается, его можно только прожить. "
+    "Позвоните своим родным сегодня. Просто так. Без повода.\n"
+    "HASHTAGS:\n"
+    "#константинмясник #отецисын #позвонитесвоимдетям #ятакчувствую"
+)
+
+# Разрешённый пользователь из ALLOWED_USERNAMES
+USER = {"id": 42, "is_bot": False, "first_name": "Тест", "username": "dkokhel"}
+
+
+def response_payload(
+    text: str = FAKE_POST,
+    input_tokens: int = 7000,
+    cached_tokens: int = 6912,
+    output_tokens: int = 250,
+) -> dict:
+    """Ответ Responses API в том виде, в каком его присылает OpenAI."""
+    return {
+        "id": "resp_test",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": "test",
+        "status": "completed",
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "output": [
+            {
+                "type": "message",
+                "id": "msg_test",
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }
+        ],
+        "usage": {
+            "input_tokens": input_tokens,
+            "input_tokens_details": {
+                "cached_tokens": cached_tokens,
+                "cache_write_tokens": 0,
+            },
+            "output_tokens": output_tokens,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": input_tokens + output_tokens,
+        },
+    }
+
+
+def too_many_requests(retry_after: int) -> tuple[int, dict]:
+    return 429, {
+        "ok": False,
+        "error_code": 429,
+        "description": f"Too Many Requests: retry after {retry_after}",
+        "parameters": {"retry_after": retry_after},
+    }
+
+
+class FakeSession(BaseSession):
+    """
+    Bot API без сети: запоминает каждый запрос и отвечает успехом.
+    replies — готовые ответы (код, тело) для первых запросов, например
+    429 из too_many_requests; ответ проходит обычный check_response.
+    """
+
+    def __init__(self, replies: list[tuple[int, dict]] | None = None):
+        super().__init__()
+        self.calls: list[TelegramMethod] = []
+        # Когда ушёл каждый запрос (time.monotonic), для проверок темпа
+        self.sent_at: list[float] = []
+        self.replies = list(replies or [])
+        self._message_ids = itertools.count(1000)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout=None):
+        self.calls.append(method)
+        self.sent_at.append(time.monotonic())
+        if self.replies:
+            status, payload = self.replies.pop(0)
+        else:
+            status, payload = 200, {"ok": True, "result": self.result(method)}
+        response = self.check_response(bot, method, status, json.dumps(payload))
+        return response.result
+
+    def result(self, method: TelegramMethod):
+        if method.__returning__ is not Message:
+            return True
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": method.chat_id, "type": "private"},
+            "text": getattr(method, "text", None),
+        }
+
+    async def stream_content(self, *args, **kwargs):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class FakeResponses:
+    def __init__(self):
+        self.calls: list[dict] = []
+
+    async def create(self, **request):
+        self.calls.append(request)
+        return Response.model_validate(response_payload())
+
+
+class FakeOpenAI:
+    """Клиент OpenAI без сети: каждый вызов — ответ с FAKE_POST."""
+
+    def __init__(self):
+        self.responses = FakeResponses()
+
+    async def close(self):
+        pass
+
+
+def make_route(
+    client=None, prices=(1.25, 0.125, 10.0), name: str = "test"
+) -> main.ModelRoute:
+    return main.ModelRoute(
+        name=name,
+        model="test",
+        client=client,
+        timeout=5.0,
+        max_output_tokens=1000,
+        prices=prices,
+    )
+
+
+@pytest.fixture
+def bot():
+    return Bot(token="123456:TEST", session=FakeSession())
+
+
+@pytest.fixture
+def openai_client(monkeypatch):
+    client = FakeOpenAI()
+    monkeypatch.setattr(main, "model_router", main.ModelRouter([make_route(client)]))
+    return client
+
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    """main.dp с чистыми хранилищем и замками: у каждого теста свой цикл."""
+    monkeypatch.setattr(main.dp.fsm, "storage", MemoryStorage())
+    monkeypatch.setattr(main.dp.fsm, "events_isolation", SimpleEventIsolation())
+    return main.dp
+
+
+@pytest_asyncio.fixture
+async def workers(bot, monkeypatch):
+    """Свои очереди заданий и генераций на цикле теста, посты без стриминга."""
+    monkeypatch.setattr(main, "STREAM_POSTS", False)
+    monkeypatch.setattr(main, "generation_queue", main.GenerationQueue(2, 10))
+    jobs = main.JobQueue(main.MemoryJobStore(), 10)
+    monkeypatch.setattr(main, "job_queue", jobs)
+    jobs.start(bot, 2)
+    yield jobs
+    await jobs.stop()
+    await main.generation_queue.stop()
@@ -0,0 +1,60 @@
+import json
+
+import numpy as np
+
+from archive_index import POSTS_FILE, VECTORS_FILE, ArchiveIndex
+
+POSTS = [
+    "Премьера новой песни «Сыну» уже завтра вечером.",
+    "Сидели с сыном на кухне, пили чай и молчали о важном.",
+    "Дорога домой всегда короче, когда тебя ждут.",
+]
+
+
+def posts_lines(index: ArchiveIndex) -> list[dict]:
+    text = (index.path / POSTS_FILE).read_text(encoding="utf-8")
+    return [json.loads(line) for line in text.splitlines()]
+
+
+def test_known_posts_are_skipped(tmp_path):
+    index = ArchiveIndex(tmp_path)
+
+    assert index.add(POSTS[:2]) == 2
+    # Тот же текст с другим регистром и пробелами — тот же пост
+    again = ["  " + POSTS[0].upper() + "  ", POSTS[1], POSTS[1], "", POSTS[2]]
+    assert index.add(again) == 1
+
+    assert index.count == 3
+    assert [line["text"] for line in posts_lines(index)] == POSTS
+
+
+def test_ingest_only_appends(tmp_path):
+    index = ArchiveIndex(tmp_path)
+    index.add(POSTS[:2])
+    posts_before = (tmp_path / POSTS_FILE).read_bytes()
+    vectors_before = (tmp_path / VECTORS_FILE).read_bytes()
+
+    index.add(POSTS[2:])
+
+    assert (tmp_path / POSTS_FILE).read_bytes().startswith(posts_before)
+    assert (tmp_path / VECTORS_FILE).read_bytes().startswith(vectors_before)
+    reloaded = ArchiveIndex(tmp_path).load()
+    assert reloaded.posts == index.posts == POSTS
+    assert np.array_equal(reloaded.vectors, index.vectors)
+
+
+def test_tail_of_interrupted_ingest_is_dropped(tmp_path):
+    index = ArchiveIndex(tmp_path)
+    index.add(POSTS[:2])
+    # Сбой после записи данных, но до meta.json: строки за count не валидны
+    with open(tmp_path / POSTS_FILE, "a", encoding="utf-8") as f:
+        f.write('{"key": "x", "text": "недописанный"}\n{"key": "y", "te')
+    with open(tmp_path / VECTORS_FILE, "ab") as f:
+        f.write(b"\0" * 100)
+
+    fresh = ArchiveIndex(tmp_path)
+    assert fresh.add(POSTS[2:]) == 1
+
+    assert [line["text"] for line in posts_lines(fresh)] == POSTS
+    assert (tmp_path / VECTORS_FILE).stat().st_size == 3 * fresh.dim * 4
+    assert ArchiveIndex(tmp_path).load().query(POSTS[2], 1) == [POSTS[2]]
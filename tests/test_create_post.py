@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import SendMessage
+from aiogram.types import Update
+
+import main
+from conftest import USER
+
+pytestmark = pytest.mark.asyncio
+
+FALLBACK_TEXT = "Чтобы начать, отправь команду /start."
+
+
+class NetworkStorage(MemoryStorage):
+    """Память с паузой на каждом обращении, как у Redis или Postgres."""
+
+    async def get_state(self, key):
+        await asyncio.sleep(0.01)
+        return await super().get_state(key)
+
+    async def get_data(self, key):
+        await asyncio.sleep(0.01)
+        return await super().get_data(key)
+
+
+def create_post_update(update_id: int) -> Update:
+    return Update.model_validate(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": USER["id"], "type": "private"},
+                "from": USER,
+                "text": "Создать пост",
+            },
+        }
+    )
+
+
+async def test_double_create_post_starts_one_generation(
+    bot, dispatcher, openai_client, workers, monkeypatch
+):
+    monkeypatch.setattr(main, "POST_VARIANTS", 1)
+    # Без пауз хранилища обработчики и так не перемежаются
+    monkeypatch.setattr(dispatcher.fsm, "storage", NetworkStorage())
+    state = dispatcher.fsm.get_context(bot, USER["id"], USER["id"])
+    await state.set_state(main.PostForm.photo_or_create)
+    await state.update_data(infopovod="Без инфоповода", topic="Семья и дети")
+
+    await asyncio.gather(
+        dispatcher.feed_update(bot, create_post_update(1)),
+        dispatcher.feed_update(bot, create_post_update(2)),
+    )
+    await workers.join()
+
+    # Второе нажатие видит уже очищенную сессию и не ставит задание
+    assert len(openai_client.responses.calls) == 1
+    replies = [
+        call.text for call in bot.session.calls if isinstance(call, SendMessage)
+    ]
+    assert replies.count(main.JOB_ACCEPTED_TEXT) == 1
+    assert replies.count(FALLBACK_TEXT) == 1
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+import main
+from conftest import POST_REQUEST, USER
+
+pytestmark = pytest.mark.asyncio
+
+
+def drafts_job(variants: int = 2) -> main.PostJob:
+    return main.PostJob(
+        chat_id=USER["id"],
+        user_id=USER["id"],
+        username=USER["username"],
+        post_request=POST_REQUEST,
+        placeholder_id=50,
+        variants=variants,
+    )
+
+
+async def test_drafts_are_saved_after_the_handler_of_the_chat(
+    bot, dispatcher, openai_client, workers
+):
+    state = dispatcher.fsm.get_context(bot, USER["id"], USER["id"])
+
+    # Обработчик того же чата держит замок, пока варианты генерируются:
+    # прочитал данные, ждёт, пишет их обратно целиком
+    async with dispatcher.fsm.events_isolation.lock(state.key):
+        data = await state.get_data()
+        await workers.enqueue(drafts_job())
+        while len(openai_client.responses.calls) < 2:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        await state.set_data({**data, "topic": "Музыка"})
+    await workers.join()
+
+    data = await state.get_data()
+    assert data["topic"] == "Музыка"
+    assert len(data["drafts"]) == 2
@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+import main
+
+pytestmark = pytest.mark.asyncio
+
+
+def cache_results() -> dict[str, float]:
+    return {
+        result: REGISTRY.get_sample_value(
+            "myasnik_generation_cache_total", {"result": result}
+        )
+        or 0.0
+        for result in ("hit", "miss", "coalesced")
+    }
+
+
+async def test_hit_miss_and_coalesced_are_counted():
+    cache = main.GenerationCache(10, 60)
+    calls = 0
+
+    async def generate() -> str:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "пост"
+
+    before = cache_results()
+    # Два одинаковых запроса одновременно — один вызов, второй его ждёт
+    await asyncio.gather(
+        cache.get_or_create("key", generate), cache.get_or_create("key", generate)
+    )
+    await cache.get_or_create("key", generate)
+    after = cache_results()
+
+    assert calls == 1
+    assert {k: after[k] - before[k] for k in after} == {
+        "hit": 1,
+        "miss": 1,
+        "coalesced": 1,
+    }
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1, "shared": 1}
@@ -0,0 +1,71 @@
+import pytest
+
+import migrations
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeCursor:
+    def __init__(self, rows: list[tuple]):
+        self.rows = rows
+
+    async def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    async def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    """Отвечает на запросы по первому подходящему началу SQL из answers."""
+
+    def __init__(self, answers: dict[str, list[list[tuple]]]):
+        self.answers = answers
+        self.executed: list[str] = []
+
+    async def execute(self, sql: str, params=None):
+        self.executed.append(sql)
+        for prefix, replies in self.answers.items():
+            if sql.startswith(prefix):
+                return FakeCursor(replies.pop(0) if len(replies) > 1 else replies[0])
+        return FakeCursor([])
+
+
+INVALID = "SELECT indexrelid"
+PARTITIONED = "SELECT relkind"
+
+
+async def test_lock_is_polled_without_blocking(monkeypatch):
+    monkeypatch.setattr(migrations, "MIGRATIONS_LOCK_POLL", 0)
+    conn = FakeConnection(
+        {"SELECT pg_try_advisory_lock": [[(False,)], [(False,)], [(True,)]]}
+    )
+
+    await migrations.acquire_lock(conn)
+
+    assert conn.executed == ["SELECT pg_try_advisory_lock(%s)"] * 3
+
+
+async def test_invalid_index_is_rebuilt():
+    conn = FakeConnection(
+        {
+            PARTITIONED: [[(False,)]],
+            INVALID: [[("myasnik_posts_topic_idx",)], []],
+        }
+    )
+
+    await migrations.create_posts_indexes(conn)
+
+    assert "DROP INDEX CONCURRENTLY IF EXISTS myasnik_posts_topic_idx" in (
+        conn.executed
+    )
+    assert conn.executed[-1].startswith(INVALID)
+
+
+async def test_index_left_invalid_fails_the_migration():
+    conn = FakeConnection(
+        {PARTITIONED: [[(False,)]], INVALID: [[], [("myasnik_posts_topic_idx",)]]}
+    )
+
+    with pytest.raises(RuntimeError, match="myasnik_posts_topic_idx"):
+        await migrations.create_posts_indexes(conn)
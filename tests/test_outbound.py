@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+import pytest
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import main
+from conftest import USER, FakeSession, too_many_requests
+
+pytestmark = pytest.mark.asyncio
+
+CHAT_ID = USER["id"]
+
+
+def limited_bot(
+    replies: list | None = None, chat_rate: float = 20, max_retries: int = 3
+) -> Bot:
+    """Бот с отдельным лимитером: 20 сообщений в секунду на чат, без запаса."""
+    bot = Bot(token="123456:TEST", session=FakeSession(replies))
+    bot.session.middleware(main.OutboundLimiter(100, chat_rate, 1, max_retries))
+    return bot
+
+
+def sent_texts(bot: Bot) -> list[str]:
+    return [call.text for call in bot.session.calls if isinstance(call, SendMessage)]
+
+
+async def send(bot: Bot, text: str, **outbound):
+    with main.telegram_outbound(**outbound):
+        return await bot.send_message(CHAT_ID, text)
+
+
+async def test_429_is_retried_after_retry_after():
+    bot = limited_bot([too_many_requests(1)])
+
+    started = time.monotonic()
+    message = await send(bot, "пост")
+
+    assert time.monotonic() - started >= 0.9
+    assert message.text == "пост"
+    assert sent_texts(bot) == ["пост", "пост"]
+
+
+async def test_429_pauses_the_whole_chat():
+    bot = limited_bot([too_many_requests(1)])
+
+    started = time.monotonic()
+    first = asyncio.create_task(send(bot, "первое"))
+    await asyncio.sleep(0)
+    await send(bot, "второе")
+
+    # Второе не уходит сразу после 429, а ждёт паузу всего чата
+    assert time.monotonic() - started >= 0.9
+    await first
+    assert sent_texts(bot) == ["первое", "второе", "первое"]
+
+
+async def test_429_after_last_retry_is_raised():
+    bot = limited_bot([too_many_requests(1), too_many_requests(1)], max_retries=1)
+
+    with pytest.raises(TelegramRetryAfter):
+        await send(bot, "пост")
+    assert len(bot.session.calls) == 2
+
+
+async def test_photo_step_replies_are_coalesced():
+    bot = limited_bot()
+    # Первое сообщение тратит квоту чата, остальные ждут своей очереди
+    await send(bot, "начало")
+
+    replies = await asyncio.gather(
+        *(send(bot, f"фото {n}", coalesce="photo_step") for n in range(1, 4))
+    )
+
+    assert sent_texts(bot) == ["начало", "фото 3"]
+    # Склеенные получают ответ на то сообщение, которое ушло вместо них
+    assert {reply.message_id for reply in replies} == {replies[-1].message_id}
+
+
+async def test_coalescing_is_per_key():
+    bot = limited_bot()
+    await send(bot, "начало")
+
+    await asyncio.gather(
+        send(bot, "фото", coalesce="photo_step"),
+        send(bot, "ответ"),
+    )
+
+    assert sorted(sent_texts(bot)[1:]) == ["ответ", "фото"]
+
+
+async def test_post_goes_before_reply_and_progress():
+    bot = limited_bot()
+    await send(bot, "начало")
+
+    await asyncio.gather(
+        send(bot, "прогресс", priority=main.PRIORITY_PROGRESS),
+        send(bot, "ответ", priority=main.PRIORITY_REPLY),
+        send(bot, "пост", priority=main.PRIORITY_POST),
+    )
+
+    assert sent_texts(bot) == ["начало", "пост", "ответ", "прогресс"]
@@ -0,0 +1,115 @@
+from contextlib import asynccontextmanager
+
+import pytest
+import pytest_asyncio
+
+import main
+from conftest import FAKE_POST
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeCopy:
+    def __init__(self, conn: "FakePool", sql: str):
+        self.rows: list[tuple] = []
+        conn.copies.append((sql, self.rows))
+
+    async def write_row(self, row: tuple):
+        self.rows.append(row)
+
+
+class FakePool:
+    """Заменяет AsyncConnectionPool: считает пулы, соединения и COPY."""
+
+    created: list["FakePool"] = []
+
+    def __init__(self, conninfo: str, **kwargs):
+        self.conninfo = conninfo
+        self.kwargs = kwargs
+        self.connections = 0
+        self.copies: list[tuple[str, list[tuple]]] = []
+        self.opened = self.closed = False
+        FakePool.created.append(self)
+
+    async def open(self):
+        self.opened = True
+
+    async def close(self):
+        self.closed = True
+
+    @asynccontextmanager
+    async def connection(self):
+        self.connections += 1
+        yield self
+
+    @asynccontextmanager
+    async def cursor(self):
+        yield self
+
+    @asynccontextmanager
+    async def copy(self, sql: str):
+        yield FakeCopy(self, sql)
+
+
+@pytest_asyncio.fixture
+async def writer(monkeypatch):
+    async def no_migrations(db_url: str):
+        return []
+
+    FakePool.created = []
+    monkeypatch.setattr(main, "AsyncConnectionPool", FakePool)
+    monkeypatch.setattr(main, "migrate", no_migrations)
+    writer = main.PostLogWriter()
+    monkeypatch.setattr(main, "post_log_writer", writer)
+    await writer.start("postgresql://test")
+    yield writer
+    await writer.stop()
+
+
+async def log_posts(count: int):
+    for n in range(count):
+        await main.log_post_event(
+            tg_user_id=n,
+            tg_username="dkokhel",
+            infopovod=None,
+            topic="Семья и дети",
+            link=None,
+            release_type=None,
+            photos_count=0,
+            model="test",
+            raw_output=FAKE_POST,
+            prompt_version="v1",
+            usage=main.GenerationUsage(api_calls=1, input_tokens=100),
+        )
+
+
+async def test_rows_share_one_pool_and_one_copy(writer):
+    await log_posts(10)
+    pool = writer.pool
+    await writer.stop()
+
+    assert FakePool.created == [pool]
+    assert pool.opened and pool.closed
+    assert pool.connections == 1
+    [(sql, rows)] = pool.copies
+    assert sql.startswith("COPY myasnik_posts (created_at, tg_user_id")
+    assert [row[1] for row in rows] == list(range(10))
+    assert all(len(row) == len(main.POST_LOG_COLUMNS) for row in rows)
+
+
+async def test_copy_is_split_by_batch_size(writer, monkeypatch):
+    monkeypatch.setattr(main, "DB_FLUSH_BATCH_SIZE", 4)
+    await log_posts(10)
+    pool = writer.pool
+    await writer.stop()
+
+    assert [len(rows) for _, rows in pool.copies] == [4, 4, 2]
+    assert pool.connections == 3
+
+
+async def test_job_store_reuses_the_writer_pool(writer):
+    store = main.build_job_store()
+
+    assert isinstance(store, main.PostgresJobStore)
+    assert store.pool is writer.pool
+    assert len(FakePool.created) == 1
@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.methods import AnswerCallbackQuery, EditMessageText
+from aiogram.types import Update
+
+from conftest import POST_REQUEST, USER
+
+pytestmark = pytest.mark.asyncio
+
+
+def regenerate_update(update_id: int, message_id: int) -> Update:
+    return Update.model_validate(
+        {
+            "update_id": update_id,
+            "callback_query": {
+                "id": f"cb{update_id}",
+                "from": USER,
+                "chat_instance": "test",
+                "data": "regenerate",
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": USER["id"], "type": "private"},
+                    "text": "пост",
+                },
+            },
+        }
+    )
+
+
+async def remember_request(dispatcher, bot):
+    state = dispatcher.fsm.get_context(bot, USER["id"], USER["id"])
+    await state.update_data(last_request=POST_REQUEST)
+
+
+async def test_double_tap_starts_one_generation(
+    bot, dispatcher, openai_client, workers
+):
+    await remember_request(dispatcher, bot)
+
+    await asyncio.gather(
+        dispatcher.feed_update(bot, regenerate_update(1, 50)),
+        dispatcher.feed_update(bot, regenerate_update(2, 50)),
+    )
+    await workers.join()
+
+    assert len(openai_client.responses.calls) == 1
+    answers = [
+        call.text for call in bot.session.calls if isinstance(call, AnswerCallbackQuery)
+    ]
+    assert sorted(answers, key=str) == [None, "Уже пишу новый вариант…"]
+    edits = [
+        call.text for call in bot.session.calls if isinstance(call, EditMessageText)
+    ]
+    assert "Позвоните своим родным" in edits[-1]
+
+
+async def test_regenerate_of_another_post_is_not_deduplicated(
+    bot, dispatcher, openai_client, workers
+):
+    await remember_request(dispatcher, bot)
+
+    await dispatcher.feed_update(bot, regenerate_update(1, 50))
+    await dispatcher.feed_update(bot, regenerate_update(2, 51))
+    await workers.join()
+
+    assert len(openai_client.responses.calls) == 2
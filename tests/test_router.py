@@ -0,0 +1,165 @@
+import asyncio
+import time
+from collections import Counter
+
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from openai import AsyncOpenAI, InternalServerError
+from prometheus_client import REGISTRY
+
+import main
+from conftest import make_route, response_payload
+
+pytestmark = pytest.mark.asyncio
+
+
+class StandInOpenAI:
+    """
+    Заглушка Responses API на локальном порту. Поведение задаётся по имени
+    модели: задержка ответа и HTTP-код (500 — ошибка сервера), а в texts —
+    текст ответа вместо стандартного.
+    """
+
+    def __init__(self):
+        self.behaviour: dict[str, tuple[float, int]] = {}
+        self.texts: dict[str, str] = {}
+        self.calls: Counter[str] = Counter()
+        self.server = TestServer(self.build_app())
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/responses", self.responses)
+        return app
+
+    async def responses(self, request: web.Request) -> web.Response:
+        model = (await request.json())["model"]
+        self.calls[model] += 1
+        delay, status = self.behaviour.get(model, (0.0, 200))
+        await asyncio.sleep(delay)
+        if status != 200:
+            return web.json_response(
+                {"error": {"message": "stand-in error", "type": "server_error"}},
+                status=status,
+            )
+        text = self.texts.get(model, f"ответ {model}")
+        return web.json_response(response_payload(text=text))
+
+    def client(self) -> AsyncOpenAI:
+        # Без повторов SDK: ими занимается сама цепочка моделей
+        return AsyncOpenAI(
+            base_url=str(self.server.make_url("/v1")), api_key="test", max_retries=0
+        )
+
+
+@pytest_asyncio.fixture
+async def stand_in():
+    server = StandInOpenAI()
+    await server.server.start_server()
+    yield server
+    await server.server.close()
+
+
+@pytest_asyncio.fixture
+async def routes(stand_in, monkeypatch):
+    client = stand_in.client()
+    chain = [make_route(client, name=name) for name in ("primary", "backup")]
+    for route in chain:
+        route.model = route.name
+    monkeypatch.setattr(main, "model_router", main.ModelRouter(chain))
+    yield chain
+    await client.close()
+
+
+def router_events(route: str, event: str) -> float:
+    return REGISTRY.get_sample_value(
+        "myasnik_router_events_total", {"model": route, "event": event}
+    ) or 0.0
+
+
+async def write() -> str:
+    text, _ = await main.call_writer([], 100, "key")
+    return text
+
+
+async def test_hedge_fires_when_primary_is_slow(stand_in, routes, monkeypatch):
+    monkeypatch.setattr(main, "HEDGE_DEFAULT_DELAY", 0.1)
+    stand_in.behaviour["primary"] = (2.0, 200)
+    hedges = router_events("backup", "hedge")
+
+    started = time.monotonic()
+    text = await write()
+
+    assert text == "ответ backup"
+    assert time.monotonic() - started < 1.0
+    # Отменённый primary мог не успеть дойти до сервера — считаем по метрике
+    assert router_events("backup", "hedge") == hedges + 1
+    assert stand_in.calls["backup"] == 1
+
+
+async def test_no_hedge_when_primary_answers_in_time(stand_in, routes, monkeypatch):
+    monkeypatch.setattr(main, "HEDGE_DEFAULT_DELAY", 0.5)
+
+    assert await write() == "ответ primary"
+    assert stand_in.calls == {"primary": 1}
+
+
+async def test_fallback_when_primary_fails(stand_in, routes):
+    primary, backup = routes
+    stand_in.behaviour["primary"] = (0.0, 500)
+
+    assert await write() == "ответ backup"
+    assert primary.failures == 1
+    assert backup.failures == 0
+
+
+async def test_error_of_last_route_is_raised(stand_in, routes):
+    stand_in.behaviour["primary"] = (0.0, 500)
+    stand_in.behaviour["backup"] = (0.0, 500)
+
+    with pytest.raises(InternalServerError):
+        await write()
+
+
+async def test_breaker_opens_and_closes(stand_in, routes, monkeypatch):
+    monkeypatch.setattr(main, "ROUTE_FAILURE_THRESHOLD", 2)
+    monkeypatch.setattr(main, "ROUTE_COOLDOWN", 0.2)
+    primary, _ = routes
+    stand_in.behaviour["primary"] = (0.0, 500)
+
+    await write()
+    await write()
+    # Две ошибки подряд: автомат открыт, primary больше не спрашиваем
+    assert not primary.available()
+    assert await write() == "ответ backup"
+    assert stand_in.calls["primary"] == 2
+
+    # После паузы пробный запрос снова идёт в primary, успех закрывает автомат
+    await asyncio.sleep(0.25)
+    stand_in.behaviour["primary"] = (0.0, 200)
+    assert await write() == "ответ primary"
+    assert primary.failures == 0 and primary.available()
+
+
+async def test_slow_route_moves_to_the_end(routes):
+    primary, backup = routes
+    primary.latencies["total"].extend([main.ROUTE_SLOW_P95 + 5] * 20)
+    backup.latencies["total"].extend([1.0] * 20)
+
+    assert main.model_router.candidates() == [backup, primary]
+
+    primary.latencies["total"].extend([1.0] * 200)
+    assert main.model_router.candidates() == [primary, backup]
+
+
+async def test_empty_answer_is_logged_and_counted(stand_in, routes, capsys):
+    stand_in.texts["primary"] = ""
+    before = router_events("primary", "empty")
+
+    assert await write() == "ответ backup"
+
+    assert router_events("primary", "empty") == before + 1
+    assert "[Router] primary: пустой ответ id=resp_test status=completed" in (
+        capsys.readouterr().out
+    )
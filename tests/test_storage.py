@@ -0,0 +1,146 @@
+import time
+
+import fakeredis
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisEventIsolation, RedisStorage
+from redis.asyncio import ConnectionPool
+
+import main
+from conftest import USER
+
+pytestmark = pytest.mark.asyncio
+
+TTL = 600
+KEY = StorageKey(bot_id=123456, chat_id=USER["id"], user_id=USER["id"])
+
+
+class FakeClock:
+    """Подменяет модуль time в main: monotonic двигается вручную."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(main, "time", clock)
+    return clock
+
+
+# ===================== TTLMemoryStorage ====================
+
+
+async def test_session_expires_after_ttl(clock):
+    storage = main.TTLMemoryStorage(TTL)
+    await storage.set_state(KEY, main.PostForm.topic_choice)
+    await storage.set_data(KEY, {"topic": "Семья и дети"})
+
+    clock.now += TTL - 1
+    assert await storage.get_state(KEY) == main.PostForm.topic_choice.state
+    assert await storage.get_data(KEY) == {"topic": "Семья и дети"}
+
+    clock.now += 1
+    assert await storage.get_state(KEY) is None
+    assert await storage.get_data(KEY) == {}
+
+
+async def test_update_extends_the_session(clock):
+    storage = main.TTLMemoryStorage(TTL)
+    await storage.set_data(KEY, {"topic": "Семья и дети"})
+
+    clock.now += TTL - 1
+    await storage.set_state(KEY, main.PostForm.photo_or_create)
+    clock.now += TTL - 1
+
+    assert await storage.get_data(KEY) == {"topic": "Семья и дети"}
+
+
+async def test_expired_session_starts_clean(clock):
+    storage = main.TTLMemoryStorage(TTL)
+    await storage.set_data(KEY, {"topic": "Семья и дети"})
+
+    clock.now += TTL
+    await storage.set_state(KEY, main.PostForm.infopovod)
+
+    assert await storage.get_data(KEY) == {}
+
+
+async def test_purge_drops_only_expired_sessions(clock):
+    storage = main.TTLMemoryStorage(TTL)
+    stale = StorageKey(bot_id=123456, chat_id=1, user_id=1)
+    await storage.set_state(stale, main.PostForm.topic_choice)
+    clock.now += TTL / 2
+    await storage.set_state(KEY, main.PostForm.infopovod)
+
+    clock.now += TTL / 2
+    assert await storage.count_states() == {main.PostForm.infopovod.state: 1}
+    await storage.purge_expired()
+
+    assert list(storage._records) == [KEY]
+
+
+async def test_data_is_copied_not_shared(clock):
+    storage = main.TTLMemoryStorage(TTL)
+    photos = [{"file_id": "p1"}]
+    await storage.set_data(KEY, {"photos": photos})
+
+    photos.append({"file_id": "p2"})
+    (await storage.get_data(KEY))["photos"].clear()
+
+    assert await storage.get_data(KEY) == {"photos": [{"file_id": "p1"}]}
+
+
+# ===================== Redis ===============================
+
+
+@pytest.fixture
+def redis_server(monkeypatch, dispatcher):
+    """FSM_STORAGE=redis поверх fakeredis: общий сервер для всех «реплик»."""
+    server = fakeredis.FakeServer()
+
+    def from_url(url, **kwargs):
+        return ConnectionPool(
+            server=server, connection_class=fakeredis.FakeAsyncRedisConnection
+        )
+
+    monkeypatch.setattr(main, "FSM_STORAGE", "redis")
+    monkeypatch.setattr(ConnectionPool, "from_url", from_url)
+    return server
+
+
+async def test_redis_backend_round_trip_with_ttl(redis_server, dispatcher):
+    storage = await main.build_fsm_storage()
+    try:
+        assert isinstance(storage, RedisStorage)
+        assert isinstance(dispatcher.fsm.events_isolation, RedisEventIsolation)
+
+        await storage.set_state(KEY, main.PostForm.topic_choice)
+        await storage.set_data(KEY, {"topic": "Семья и дети"})
+
+        assert await storage.get_state(KEY) == main.PostForm.topic_choice.state
+        assert await storage.get_data(KEY) == {"topic": "Семья и дети"}
+        for part in ("state", "data"):
+            ttl = await storage.redis.ttl(storage.key_builder.build(KEY, part))
+            assert 0 < ttl <= main.FSM_TTL
+    finally:
+        await storage.close()
+
+
+async def test_redis_sessions_are_shared_between_replicas(redis_server):
+    first = await main.build_fsm_storage()
+    second = await main.build_fsm_storage()
+    try:
+        await first.set_data(KEY, {"topic": "Семья и дети"})
+
+        assert await second.get_data(KEY) == {"topic": "Семья и дети"}
+    finally:
+        await first.close()
+        await second.close()
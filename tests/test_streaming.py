@@ -0,0 +1,148 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.methods import EditMessageText
+from openai.types.responses import Response
+
+import main
+from conftest import FAKE_POST, USER, make_route, response_payload
+
+pytestmark = pytest.mark.asyncio
+
+INTERVAL = 0.05
+
+
+def delta(text: str):
+    return SimpleNamespace(type="response.output_text.delta", delta=text)
+
+
+def finished(kind: str, **fields):
+    """Событие конца потока с ответом, как его присылает Responses API."""
+    payload = response_payload(**fields)
+    if kind == "response.failed":
+        payload.update(
+            status="failed", error={"code": "server_error", "message": "упала"}
+        )
+    elif kind == "response.incomplete":
+        payload.update(
+            status="incomplete", incomplete_details={"reason": "max_output_tokens"}
+        )
+    return SimpleNamespace(type=kind, response=Response.model_validate(payload))
+
+
+def chunks(text: str, size: int = 40) -> list:
+    return [delta(text[i : i + size]) for i in range(0, len(text), size)]
+
+
+class StreamingResponses:
+    """responses.create(stream=True): события сценария с паузой между ними."""
+
+    def __init__(self, events: list, pause: float = 0.01):
+        self.events = events
+        self.pause = pause
+        self.calls = 0
+
+    async def create(self, **request):
+        assert request["stream"] is True
+        self.calls += 1
+        return self._stream()
+
+    async def _stream(self):
+        for event in self.events:
+            await asyncio.sleep(self.pause)
+            yield event
+
+
+class StreamingClient:
+    def __init__(self, events: list, pause: float = 0.01):
+        self.responses = StreamingResponses(events, pause)
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def fast_edits(monkeypatch):
+    monkeypatch.setattr(main, "STREAM_EDIT_INTERVAL", INTERVAL)
+
+
+def use_routes(monkeypatch, *clients) -> list[main.ModelRoute]:
+    routes = [make_route(client, name=f"route{n}") for n, client in enumerate(clients)]
+    monkeypatch.setattr(main, "model_router", main.ModelRouter(routes))
+    return routes
+
+
+async def stream_post(bot, usage: main.GenerationUsage) -> str:
+    editor = main.StreamingEditor(bot, USER["id"], 1)
+    text, _ = await main.call_writer([], 100, "key", editor.push, usage)
+    await editor.finish(text)
+    return text
+
+
+def edits(bot) -> list[EditMessageText]:
+    return [call for call in bot.session.calls if isinstance(call, EditMessageText)]
+
+
+async def test_stream_edits_are_throttled(bot, monkeypatch):
+    events = chunks(FAKE_POST) + [finished("response.completed")]
+    use_routes(monkeypatch, StreamingClient(events))
+    usage = main.GenerationUsage()
+
+    text = await stream_post(bot, usage)
+
+    assert text == FAKE_POST.strip()
+    sent = [
+        at
+        for call, at in zip(bot.session.calls, bot.session.sent_at)
+        if isinstance(call, EditMessageText)
+    ]
+    # Промежуточные правки склеиваются и идут не чаще раза в INTERVAL
+    assert 2 <= len(sent) < len(events)
+    gaps = [later - earlier for earlier, later in zip(sent, sent[1:-1])]
+    assert all(gap >= INTERVAL * 0.9 for gap in gaps)
+    assert edits(bot)[-1].text == FAKE_POST.strip()
+    assert usage.api_calls == 1
+
+
+async def test_failed_stream_falls_back_and_keeps_usage(bot, monkeypatch):
+    primary = StreamingClient(
+        chunks(FAKE_POST[:80]) + [finished("response.failed", output_tokens=20)]
+    )
+    fallback = StreamingClient(chunks(FAKE_POST) + [finished("response.completed")])
+    first, second = use_routes(monkeypatch, primary, fallback)
+    usage = main.GenerationUsage()
+
+    text = await stream_post(bot, usage)
+
+    # Оборванный текст не выдаётся за ответ: на экране итог запасной модели
+    assert text == FAKE_POST.strip()
+    assert edits(bot)[-1].text == FAKE_POST.strip()
+    assert first.failures == 1 and second.failures == 0
+    assert len(first.latencies["total"]) == 0
+    # Токены упавшего потока посчитаны вместе с успешным вызовом
+    assert usage.api_calls == 2
+    assert usage.output_tokens == 20 + 250
+
+
+@pytest.mark.parametrize(
+    "event, reason",
+    [
+        (finished("response.incomplete"), "incomplete: max_output_tokens"),
+        (
+            SimpleNamespace(type="error", code="server_error", message="сбой"),
+            "error server_error: сбой",
+        ),
+    ],
+)
+async def test_broken_stream_is_a_route_failure(bot, monkeypatch, event, reason):
+    client = StreamingClient(chunks(FAKE_POST[:80]) + [event])
+    (route,) = use_routes(monkeypatch, client)
+    usage = main.GenerationUsage()
+
+    with pytest.raises(main.StreamFailedError, match=reason):
+        await stream_post(bot, usage)
+
+    assert route.failures == 1
+    # У события error ответа нет, у incomplete — есть и он оплачен
+    assert usage.api_calls == (1 if event.type == "response.incomplete" else 0)
@@ -0,0 +1,140 @@
+import asyncio
+import re
+
+import pytest
+from openai.types.responses import Response
+from prometheus_client import REGISTRY
+
+import main
+from conftest import FakeOpenAI, make_route, response_payload
+
+# Цены за 1M токенов: вход, кэшированный вход, выход
+PRICES = (1.25, 0.125, 10.0)
+
+
+@pytest.fixture(autouse=True)
+def fresh_totals(monkeypatch):
+    monkeypatch.setattr(
+        main,
+        "usage_totals",
+        {"calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0},
+    )
+
+
+def recorded(**tokens) -> Response:
+    return Response.model_validate(response_payload(**tokens))
+
+
+class RecordedResponses:
+    """Отдаёт записанные ответы по очереди, каждый со своей задержкой."""
+
+    def __init__(self, replies: list[tuple[float, Response]]):
+        self.replies = list(replies)
+        self.calls: list[dict] = []
+
+    async def create(self, **request):
+        self.calls.append(request)
+        delay, response = self.replies.pop(0)
+        await asyncio.sleep(delay)
+        return response
+
+
+def latency_samples(route: str) -> float:
+    return REGISTRY.get_sample_value(
+        "myasnik_openai_request_seconds_count", {"model": route, "status": "ok"}
+    ) or 0.0
+
+
+def test_cached_tokens_are_billed_at_cached_price():
+    response = recorded(input_tokens=7000, cached_tokens=6912, output_tokens=250)
+
+    usage = main.record_usage(response, 1.5, make_route(prices=PRICES))
+
+    assert usage.api_calls == 1
+    assert usage.input_tokens == 7000
+    assert usage.cached_tokens == 6912
+    assert usage.output_tokens == 250
+    assert usage.generation_seconds == 1.5
+    # 88 некэшированных по 1.25 + 6912 по 0.125 + 250 выходных по 10
+    assert usage.cost_usd == pytest.approx((88 * 1.25 + 6912 * 0.125 + 2500) / 1e6)
+
+
+def test_cache_ratio_of_call_and_of_process(capsys):
+    route = make_route(prices=PRICES)
+
+    main.record_usage(recorded(input_tokens=1000, cached_tokens=0), 1.0, route)
+    main.record_usage(recorded(input_tokens=1000, cached_tokens=900), 1.0, route)
+
+    assert main.usage_totals == {
+        "calls": 2,
+        "input_tokens": 2000,
+        "cached_tokens": 900,
+        "output_tokens": 500,
+    }
+    last = capsys.readouterr().out.strip().splitlines()[-1]
+    assert "cached=900 (90%)" in last
+    assert "total_cached=45%" in last
+
+
+def test_cold_cache_costs_full_price():
+    response = recorded(input_tokens=7000, cached_tokens=0, output_tokens=0)
+
+    usage = main.record_usage(response, 1.0, make_route(prices=PRICES))
+
+    assert usage.cost_usd == pytest.approx(7000 * 1.25 / 1e6)
+
+
+def test_response_without_usage_counts_only_the_call():
+    response = recorded()
+    response.usage = None
+
+    usage = main.record_usage(response, 2.0, make_route(prices=PRICES))
+
+    assert usage.api_calls == 1
+    assert usage.cost_usd == 0
+    assert main.usage_totals["calls"] == 0
+
+
+@pytest.mark.asyncio
+async def test_repeat_generation_is_cheaper_and_faster(monkeypatch, capsys):
+    # Первый вызов прогревает кэш провайдера, второй попадает в него
+    responses = RecordedResponses(
+        [
+            (0.2, recorded(input_tokens=7000, cached_tokens=0)),
+            (0.05, recorded(input_tokens=7000, cached_tokens=6912)),
+        ]
+    )
+    client = FakeOpenAI()
+    client.responses = responses
+    route = make_route(client, prices=PRICES, name="recorded")
+    monkeypatch.setattr(main, "model_router", main.ModelRouter([route]))
+    prompt = main.prompt_registry.current
+    samples = latency_samples("recorded")
+
+    usages = []
+    for infopovod in ("Премьера песни «Сыну»", "Концерт в Казани"):
+        messages, tokens = main.build_writer_messages(
+            prompt, infopovod, "Семья и дети", None, None, 0, examples=[]
+        )
+        usage = main.GenerationUsage()
+        await main.call_writer(messages, tokens, prompt.cache_key, usage=usage)
+        usages.append(usage)
+
+    # Префикс запроса побайтно тот же, отличается только хвост
+    first, second = responses.calls
+    assert first["input"][0] == second["input"][0]
+    assert first["input"][-1] != second["input"][-1]
+    assert first["prompt_cache_key"] == second["prompt_cache_key"]
+
+    cold, warm = usages
+    assert warm.cost_usd < cold.cost_usd
+    assert warm.generation_seconds < cold.generation_seconds
+    # Время вызова видно и в логе, и в гистограмме задержек
+    assert latency_samples("recorded") == samples + 2
+    logged = [
+        float(re.search(r"latency=([\d.]+)s", line).group(1))
+        for line in capsys.readouterr().out.splitlines()
+        if line.startswith("[OpenAI usage] model=recorded")
+    ]
+    assert len(logged) == 2
+    assert logged[0] >= 0.2 > logged[1]
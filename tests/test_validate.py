@@ -0,0 +1,24 @@
+import pytest
+
+import main
+
+POST_TEXT = "Знаете, иногда тишина говорит громче любых слов. " * 5
+
+
+def post(hashtags: int) -> main.ParsedPost:
+    return main.ParsedPost(
+        infopovod=None,
+        topic="Семья и дети",
+        post_text=POST_TEXT.strip(),
+        hashtags=[f"#тег{n}" for n in range(hashtags)],
+    )
+
+
+@pytest.mark.parametrize("count", [2, 3, 6])
+def test_hashtag_count_allowed_by_prompt_is_not_repaired(count):
+    assert main.validate_post(post(count)) == []
+
+
+@pytest.mark.parametrize("count", [0, 1, 7])
+def test_hashtag_count_outside_range_is_a_violation(count):
+    assert main.validate_post(post(count)) == [f"хэштегов {count}, нужно 2-6"]
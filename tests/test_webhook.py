@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+import pytest
+import pytest_asyncio
+from aiogram.methods import SendMessage
+from aiohttp.test_utils import TestClient, TestServer
+
+import main
+from conftest import USER
+
+pytestmark = pytest.mark.asyncio
+
+SECRET = "test-secret"
+
+START_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": USER["id"], "type": "private"},
+        "from": USER,
+        "text": "/start",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    },
+}
+
+
+@pytest_asyncio.fixture
+async def client(bot, dispatcher, monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_SECRET", SECRET)
+    async with TestClient(TestServer(main.build_webhook_app(bot))) as client:
+        yield client
+
+
+async def sent_messages(bot, timeout: float = 1.0) -> list[SendMessage]:
+    # Апдейт разбирается в фоне уже после ответа 200
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        sent = [call for call in bot.session.calls if isinstance(call, SendMessage)]
+        if sent:
+            return sent
+        await asyncio.sleep(0.01)
+    return []
+
+
+async def test_update_without_secret_is_rejected(client, bot):
+    response = await client.post(main.WEBHOOK_PATH, json=START_UPDATE)
+
+    assert response.status == 401
+    assert await sent_messages(bot, timeout=0.1) == []
+
+
+async def test_update_with_wrong_secret_is_rejected(client, bot):
+    response = await client.post(
+        main.WEBHOOK_PATH,
+        json=START_UPDATE,
+        headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"},
+    )
+
+    assert response.status == 401
+
+
+async def test_update_with_secret_reaches_handler(client, bot, dispatcher):
+    response = await client.post(
+        main.WEBHOOK_PATH,
+        json=START_UPDATE,
+        headers={"X-Telegram-Bot-Api-Secret-Token": SECRET},
+    )
+
+    assert response.status == 200
+    sent = await sent_messages(bot)
+    assert sent and sent[0].text.startswith("Привет!")
+    state = dispatcher.fsm.get_context(bot, USER["id"], USER["id"])
+    assert await state.get_state() == main.PostForm.infopovod.state
+
+
+async def test_health_is_served_next_to_webhook(client):
+    response = await client.get("/health")
+
+    assert response.status == 200